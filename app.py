@@ -8,28 +8,36 @@ import json
 import textwrap
 import time
 import random
-import base64
+import hashlib
+import atexit
+import bisect
+import functools
 import os
+import urllib.parse
+import shutil
+import sys
 import numpy as np
 import concurrent.futures
+from collections import OrderedDict
 import threading 
-from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from streamlit.runtime.scriptrunner import add_script_run_ctx
 import queue
 import streamlit.components.v1 as components
-from bs4 import BeautifulSoup
+import scan_workers
 from sqlalchemy import create_engine
 from sqlalchemy import text
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-
-import google.generativeai as genai
+# ★変更: selenium / google.generativeai / bs4 は使う関数の中で import する (最初の画面を待たせない。Gemini は import だけで 0.2秒以上かかる)
 
 # ★ secretsからキーを読み込むようにする
-if "GEMINI_API_KEY" in st.secrets:
-    GEMINI_API_KEY = st.secrets["GEMINI_API_KEY"]
-else:
-    # secretsがない場合（ここにはキーを書かない！）
-    GEMINI_API_KEY = None 
+try:
+    if "GEMINI_API_KEY" in st.secrets:
+        GEMINI_API_KEY = st.secrets["GEMINI_API_KEY"]
+    else:
+        # secretsがない場合（ここにはキーを書かない！）
+        GEMINI_API_KEY = None 
+except:
+    # secrets.toml 自体がない場合 (学習スクリプト等から import したとき)
+    GEMINI_API_KEY = None
 
 def generate_gemini_comment(row):
     """
@@ -127,6 +135,8 @@ def generate_gemini_comment(row):
     8. 「注目ポイント」に記載がある場合は、500文字程度で語る。
     """
 
+    try: import google.generativeai as genai
+    except ImportError as e: return f"致命的エラー: {e}", "-"
     genai.configure(api_key=api_key)
 
     # 修正版ループ処理
@@ -135,11 +145,15 @@ def generate_gemini_comment(row):
         try:
             model = genai.GenerativeModel(model_name)
             response = model.generate_content(prompt)
+            get_metrics().inc('keiba_gemini_requests_total', model=model_name, result='ok')
             return response.text, model_name 
 
         except Exception as e:
             error_msg = str(e)
             errors.append(f"{model_name}: {error_msg}") # エラーを記録
+            # ★追加: 利用枠切れ (429 / Quota) を数える
+            result = 'quota' if "429" in error_msg or "Quota" in error_msg else 'not_found' if "404" in error_msg or "not found" in error_msg else 'error'
+            get_metrics().inc('keiba_gemini_requests_total', model=model_name, result=result)
             
             # フォールバック処理（次へ）
             if "429" in error_msg or "Quota" in error_msg or "404" in error_msg or "not found" in error_msg:
@@ -161,6 +175,191 @@ st.set_page_config(
 
 BACKTEST_PERIOD = "2024/01 ～ Present"
 
+# ---------------------------------------------------------
+# ★追加: メトリクス (全セッション・全スレッド共通の件数・所要時間)
+# counter / gauge / histogram をラベル付きで持ち、Prometheus のテキスト形式で出す。
+# data/metrics/app.prom に定期的に書き出し (node_exporter の textfile と同じ形式)、METRICS_PORT を設定すれば /metrics でも返す。
+# 外部サービスなしで metrics_scraper.py がどちらからでも読める。
+# ---------------------------------------------------------
+METRICS_FILE = 'data/metrics/app.prom'
+METRICS_WRITE_SECONDS = 15
+try: METRICS_PORT = int(st.secrets.get("METRICS_PORT", 0)) # 0 なら HTTP では公開しない
+except: METRICS_PORT = 0
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+METRIC_HELP = {
+    'keiba_http_requests_total': ('counter', "HTTP requests by host and status"),
+    'keiba_http_request_seconds': ('histogram', "HTTP request latency by host"),
+    'keiba_page_fetch_total': ('counter', "Page fetches by path (requests / selenium / failed)"),
+    'keiba_chrome_started_total': ('counter', "Chrome drivers started"),
+    'keiba_db_queries_total': ('counter', "SQL statements by calling function"),
+    'keiba_db_query_seconds': ('histogram', "SQL latency by calling function"),
+    'keiba_db_pool_checked_out': ('gauge', "DB connections in use"),
+    'keiba_db_pool_size': ('gauge', "DB pool size (excluding overflow)"),
+    'keiba_db_pool_overflow': ('gauge', "DB overflow connections in use"),
+    'keiba_cache_calls_total': ('counter', "st.cache_data calls by function"),
+    'keiba_cache_misses_total': ('counter', "st.cache_data calls that ran the function"),
+    'keiba_prediction_cache_hits_total': ('counter', "Shared prediction cache hits"),
+    'keiba_prediction_cache_disk_hits_total': ('counter', "Shared prediction cache hits served from disk"),
+    'keiba_prediction_cache_misses_total': ('counter', "Shared prediction cache misses"),
+    'keiba_prediction_cache_evictions_total': ('counter', "Shared prediction cache evictions"),
+    'keiba_prediction_cache_entries': ('gauge', "Shared prediction cache entries"),
+    'keiba_prediction_cache_bytes': ('gauge', "Shared prediction cache estimated size"),
+    'keiba_scan_duration_seconds': ('histogram', "Full scan duration by final status"),
+    'keiba_scan_races_total': ('counter', "Scanned races by outcome"),
+    'keiba_scan_stage_seconds': ('histogram', "Scan pipeline stage latency"),
+    'keiba_scan_timeouts_total': ('counter', "Scan stage timeouts"),
+    'keiba_scans_running': ('gauge', "Scan jobs currently running"),
+    'keiba_gemini_requests_total': ('counter', "Gemini calls by model and result (ok / quota / not_found / error)"),
+    'keiba_process_resident_bytes': ('gauge', "Resident memory of this process"),
+    'keiba_process_start_time_seconds': ('gauge', "Process start time (unix)"),
+}
+
+def _metric_labels(labels):
+    if not labels: return ""
+    esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}"
+
+class MetricsRegistry:
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.lock = threading.Lock()
+        self.values = {} # (名前, ラベル) -> 値 (counter / gauge)
+        self.histograms = {} # (名前, ラベル) -> [バケットごとの件数..., +Inf, 合計, 件数]
+        self.collectors = {} # 書き出す直前に gauge を更新する関数 (名前で登録するので再実行しても増えない)
+        self.buckets = buckets
+        self.set('keiba_process_start_time_seconds', time.time())
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock: self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock: self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None: h = self.histograms[key] = [0] * (len(self.buckets) + 3)
+            h[bisect.bisect_left(self.buckets, value)] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def collector(self, name, fn):
+        self.collectors[name] = fn
+
+    def render(self):
+        """Prometheus のテキスト形式"""
+        for fn in list(self.collectors.values()):
+            try: fn(self)
+            except Exception: pass
+        with self.lock:
+            series = {}
+            for (name, labels), v in self.values.items(): series.setdefault(name, []).append((labels, v))
+            for (name, labels), h in self.histograms.items(): series.setdefault(name, []).append((labels, list(h)))
+        lines = []
+        for name in sorted(series):
+            kind, help_text = METRIC_HELP.get(name, ('untyped', name))
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for labels, v in sorted(series[name]):
+                if not isinstance(v, list):
+                    lines.append(f"{name}{_metric_labels(labels)} {v}")
+                    continue
+                cum = 0
+                for le, c in zip(self.buckets + ('+Inf',), v):
+                    cum += c
+                    lines.append(f"{name}_bucket{_metric_labels(labels + (('le', le if isinstance(le, str) else f'{le:g}'),))} {cum}")
+                lines += [f"{name}_sum{_metric_labels(labels)} {v[-2]:.6f}", f"{name}_count{_metric_labels(labels)} {v[-1]}"]
+        return "\n".join(lines) + "\n"
+
+@st.cache_resource
+def get_metrics():
+    return MetricsRegistry()
+
+def write_metrics_file(path=METRICS_FILE):
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f: f.write(get_metrics().render())
+        os.replace(tmp, path)
+        return True
+    except Exception: return False
+
+@st.cache_resource
+def start_metrics_exporter(path=METRICS_FILE, interval=METRICS_WRITE_SECONDS, port=METRICS_PORT):
+    """1プロセスに1回: ファイルへ定期的に書き出すスレッドと、port があれば /metrics を返す HTTP サーバー"""
+    def loop():
+        while True:
+            write_metrics_file(path)
+            time.sleep(interval)
+    metrics = get_metrics()
+    metrics.collector('process', lambda m: m.set('keiba_process_resident_bytes', process_rss_bytes() or 0))
+    metrics.collector('prediction_cache', prediction_cache_gauges)
+    metrics.collector('scan_jobs', lambda m: m.set('keiba_scans_running', sum(j.status == 'running' for j in list(get_scan_job_manager().jobs.values()))))
+    threading.Thread(target=loop, daemon=True, name='metrics-writer').start()
+    atexit.register(write_metrics_file, path)
+    if not port: return None
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_response(404); self.end_headers(); return
+            body = get_metrics().render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args): pass
+
+    try:
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True, name='metrics-http').start()
+        return server
+    except OSError: return None # 同じポートを別プロセスが使用中
+
+def metered_cache_data(**kwargs):
+    """st.cache_data と同じ。関数ごとに呼び出し回数と実行回数 (= キャッシュミス) を数える"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def run(*args, **kw):
+            get_metrics().inc('keiba_cache_misses_total', cache=fn.__name__)
+            return fn(*args, **kw)
+        cached = st.cache_data(**kwargs)(run)
+
+        @functools.wraps(fn)
+        def call(*args, **kw):
+            get_metrics().inc('keiba_cache_calls_total', cache=fn.__name__)
+            return cached(*args, **kw)
+        call.clear = cached.clear
+        return call
+    return decorator
+
+def metered_get(url, **kwargs):
+    """requests.get と同じ。ホスト別・ステータス別の件数と所要時間を記録する"""
+    host = url.split('/')[2] if '://' in url else ''
+    status = 'error'
+    t0 = time.perf_counter()
+    try:
+        res = requests.get(url, **kwargs)
+        status = res.status_code
+        return res
+    finally:
+        metrics = get_metrics()
+        metrics.inc('keiba_http_requests_total', host=host, status=str(status))
+        metrics.observe('keiba_http_request_seconds', time.perf_counter() - t0, host=host)
+
+def process_rss_bytes():
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError: pass
+    try:
+        with open('/proc/self/statm') as f: return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except Exception: return None
+
 # ---------------------------------------------------------
 # 2. UI/UX 定義 (CSS & JS)
 # ---------------------------------------------------------
@@ -432,6 +631,7 @@ def render_waiting_trivia():
 # ---------------------------------------------------------
 MODEL_PATH = 'models/lgbm_pace_tuned.pkl'
 ENCODER_PATH = 'models/pace_encoders.pkl'
+COMPACT_MODEL_DIR = 'models/compact' # ★追加: モデル本体(テキスト) + 配列(.npy) + meta.json の軽量版
 
 # クラウドDB接続先 (ローカル実行時のエラー回避対応)
 try:
@@ -525,6 +725,40 @@ MANUAL_JOCKEY_MAP = {
     "杉原": "杉原誠人",
 }
 
+# 特徴量名の日本語マッピング (重要度・寄与の表示用)
+FEATURE_NAME_MAP = {
+    'odds': '単勝オッズ', 'popularity': '人気順', 'interval_weeks': '間隔(週)',
+    'std_recent_rank': '近走着順(偏差)', 'recent_rank_avg': '近走着順',
+    'prev_rank': '前走着順',
+    'tag_win_rate': '騎手×調教師', 'jockey_course_win_rate': '騎手(コース)',
+    'jockey_course_rentai_rate': '騎手連対(コース)', '調教師': '調教師ID', '騎手': '騎手ID',
+    'std_jockey_win': '騎手勝率(偏差)', 'avg_pos_rate': '平均位置取り',
+    'win_ratio': '馬勝率', 'nige_rate': '逃げ率', 'senko_rate': '先行率',
+    'senko_count': '先行回数', 'std_recent_3f': '近走上がり(偏差)',
+    'recent_3f_avg': '近走上がり', 'horse_count': '頭数',
+    'std_sire_win': '種牡馬(偏差)', 'sire_win_rate': '種牡馬勝率',
+    'sire_course_win_rate': '種牡馬(コース)', 'bms_win_rate': '母父勝率',
+    'course_waku_win_rate': '枠番(コース)', 'クラス': 'クラス',
+    'prev_margin': '前走着差', 'prev_3f': '前走上がり', 'prev_distance': '前走距離',
+    'dist_change': '距離増減', 'course_change': '芝ダ替わり',
+    'rotation': 'ローテ', 'trainer_win_rate': '調教師勝率', 'jockey_win_rate': '騎手勝率',
+    'total_wins': '通算勝利', 'total_money': '獲得賞金',
+    'age': '馬齢', 'weight': '斤量', 'run_style_ratio': '脚質傾向',
+    'crs_rate': 'コース実績', 'dist_to_first_corner': '初角距離',
+    'is_high_pace_forecast': 'ハイペース予', 'is_slow_pace_forecast': 'スローペース予'
+}
+
+# 購入判定ルール (旧 get_rec のハードコード閾値)
+REC_PACE = "🚀 展開ブースト"
+REC_HOLE = "💣 穴馬ブースト"
+REC_GOLD = "💎 黄金法則"
+BET_RULES = {
+    'pace': {'min_prob': 0.10, 'odds_min': 10.0, 'odds_max': 50.0},   # 展開利あり が前提
+    'hole': {'min_prob': 0.08, 'odds_min': 50.0, 'odds_max': 150.0},
+    'gold': {'min_prob': 0.20, 'odds_min': 5.0, 'odds_max': 30.0},
+    'ai':   {'odds_min': 3.0, 'odds_max': 30.0},                     # 鉄板の軸 (AI No.1) の購入対象オッズ帯
+}
+
 # ---------------------------------------------------------
 # 4. ヘルパー関数
 # ---------------------------------------------------------
@@ -582,42 +816,38 @@ def get_html_content(url, driver=None):
 
     # 1. まずは高速な requests でトライ
     try:
-        res = requests.get(url, headers=HEADERS, timeout=5)
+        with trace_span('http.page', url=url) as span:
+            res = metered_get(url, headers=HEADERS, timeout=5)
+            span.set(status=res.status_code)
         if res.status_code == 200:
             for enc in ['euc-jp', 'utf-8', 'shift_jis', 'cp932']:
                 try: 
                     decoded = res.content.decode(enc)
                     # 中身が空っぽ(ダミー)じゃないか確認
                     if is_valid_html(decoded):
+                        get_metrics().inc('keiba_page_fetch_total', via='requests')
                         return decoded
                 except: continue
     except: pass # requests失敗時は何もしないで次へ
 
     # 2. ダメなら Selenium (Chrome) を起動して確実に取る
+    via = 'failed' # ★追加: フォールバック率のメトリクス用
     try:
         # ドライバが渡されていない場合のみ、ここで新規作成・破棄を行う（単発利用）
         local_driver = False
         if driver is None:
             local_driver = True
-            options = Options()
-            options.add_argument('--headless')
-            options.add_argument('--no-sandbox')
-            options.add_argument('--disable-dev-shm-usage')
-            options.add_argument('--disable-gpu')
-            options.add_argument('--window-size=1920,1080')
-            options.add_argument('--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36')
-            
-            from selenium.webdriver.chrome.service import Service
-            service = Service()
-            driver = webdriver.Chrome(options=options, service=service)
+            driver = create_chrome_driver()
         
         try:
-            driver.get(url)
-            time.sleep(2) # 読み込み待ち
-            html = driver.page_source
+            with trace_span('selenium', url=url):
+                driver.get(url)
+                time.sleep(2) # 読み込み待ち
+                html = driver.page_source
             
             # Seleniumでも一応中身チェック
             if is_valid_html(html):
+                via = 'selenium'
                 return html
             else:
                 return None
@@ -627,6 +857,8 @@ def get_html_content(url, driver=None):
                 driver.quit()
     except Exception:
         return None
+    finally:
+        get_metrics().inc('keiba_page_fetch_total', via=via)
 
 def render_grade_badge_html(grade):
     cls = get_grade_class_name(grade)
@@ -810,44 +1042,10 @@ def render_feature_importance_sidebar(model_pack):
     
     with st.expander("🔍 モデル特徴量の重要度", expanded=False):
         try:
-            model = model_pack['model']
-            feature_names = model_pack['features']
-            importance = model.feature_importance(importance_type='gain')
-            
-            # 日本語マッピング
-            NAME_MAP = {
-                'odds': '単勝オッズ', 'popularity': '人気順', 'interval_weeks': '間隔(週)',
-                'std_recent_rank': '近走着順(偏差)', 'recent_rank_avg': '近走着順',
-                'prev_rank': '前走着順',
-                'tag_win_rate': '騎手×調教師', 'jockey_course_win_rate': '騎手(コース)',
-                'jockey_course_rentai_rate': '騎手連対(コース)', '調教師': '調教師ID', '騎手': '騎手ID',
-                'std_jockey_win': '騎手勝率(偏差)', 'avg_pos_rate': '平均位置取り',
-                'win_ratio': '馬勝率', 'nige_rate': '逃げ率', 'senko_rate': '先行率',
-                'senko_count': '先行回数', 'std_recent_3f': '近走上がり(偏差)',
-                'recent_3f_avg': '近走上がり', 'horse_count': '頭数',
-                'std_sire_win': '種牡馬(偏差)', 'sire_win_rate': '種牡馬勝率',
-                'sire_course_win_rate': '種牡馬(コース)', 'bms_win_rate': '母父勝率',
-                'course_waku_win_rate': '枠番(コース)', 'クラス': 'クラス',
-                'prev_margin': '前走着差', 'prev_3f': '前走上がり', 'prev_distance': '前走距離',
-                'dist_change': '距離増減', 'course_change': '芝ダ替わり',
-                'rotation': 'ローテ', 'trainer_win_rate': '調教師勝率', 'jockey_win_rate': '騎手勝率',
-                'total_wins': '通算勝利', 'total_money': '獲得賞金',
-                'age': '馬齢', 'weight': '斤量', 'run_style_ratio': '脚質傾向',
-                'crs_rate': 'コース実績', 'dist_to_first_corner': '初角距離',
-                'is_high_pace_forecast': 'ハイペース予', 'is_slow_pace_forecast': 'スローペース予'
-            }
-            
-            # データフレーム化
-            df_imp = pd.DataFrame({'Feature': feature_names, 'Gain': importance})
-            df_imp['Name'] = df_imp['Feature'].map(lambda x: NAME_MAP.get(x, x))
-            df_imp = df_imp.sort_values('Gain', ascending=False).head(20)
-            
-            # 正規化して表示(対数スケールを使って小規模な特徴量も可視化)
-            # Gainが極端に偏るため、np.log1p を使用
-            log_gains = np.log1p(df_imp['Gain'])
-            max_log = log_gains.max()
-            df_imp['Score'] = (log_gains / max_log * 100).astype(int)
-            
+            # ★変更: 重要度テーブルはロード時に1回だけ作る (再実行のたびに計算しない)
+            df_imp = model_pack.get('importance')
+            if df_imp is None: df_imp = build_importance_table(model_pack['model'], model_pack['features'])
+
             # 表示
             st.dataframe(
                 df_imp[['Name', 'Score']].set_index('Name'),
@@ -859,6 +1057,33 @@ def render_feature_importance_sidebar(model_pack):
         except Exception as e:
             st.error(f"Error: {e}")
 
+def build_importance_table(model, feature_names, top_n=20):
+    """サイドバー用の重要度テーブル (Gain を対数スケールで 0-100 に正規化)"""
+    df_imp = pd.DataFrame({'Feature': feature_names, 'Gain': model.feature_importance(importance_type='gain')})
+    df_imp['Name'] = df_imp['Feature'].map(lambda x: FEATURE_NAME_MAP.get(x, x))
+    df_imp = df_imp.sort_values('Gain', ascending=False).head(top_n)
+    # Gainが極端に偏るため、np.log1p を使用
+    log_gains = np.log1p(df_imp['Gain'])
+    max_log = log_gains.max()
+    df_imp['Score'] = (log_gains / max_log * 100).astype(int) if max_log > 0 else 0
+    return df_imp
+
+def render_contribution_detail(res, contrib, top_n=10):
+    """1頭ずつの特徴量寄与 (predict 時にキャッシュ済み) を表示する"""
+    with st.expander("🧬 AI判断の内訳 (特徴量ごとの寄与)", expanded=False):
+        horses = res[['馬番', '馬名']].drop_duplicates()
+        options = {f"#{int(r['馬番'])} {r['馬名']}": int(r['馬番']) for _, r in horses.iterrows()}
+        label = st.selectbox("馬を選択", list(options.keys()), key="contrib_horse")
+        pos = np.flatnonzero(contrib['umaban'] == options[label])
+        if len(pos) == 0:
+            st.info("寄与データがありません"); return
+        values = contrib['values'][pos[0]].astype(float)
+        df_c = pd.DataFrame({'Feature': contrib['features'], '寄与': values})
+        df_c['特徴量'] = df_c['Feature'].map(lambda x: FEATURE_NAME_MAP.get(x, x))
+        df_c = df_c.reindex(df_c['寄与'].abs().sort_values(ascending=False).index).head(top_n)
+        st.bar_chart(df_c.set_index('特徴量')['寄与'], horizontal=True)
+        st.caption(f"※ LightGBM の pred_contrib (SHAP値)。ベース値 {float(contrib['base']):.3f} に各特徴量の寄与を足したものが生スコアになります")
+
 def render_report_card_dual(label, hit_count, bets, win_roi, place_roi):
     if bets > 0:
         hit_rate_str = f"{(hit_count / bets * 100):.1f}%"
@@ -896,28 +1121,188 @@ def render_report_card_dual(label, hit_count, bets, win_roi, place_roi):
     """
     return html.replace('\n', '')
 
-def get_base64_video(file_paths):
-    valid_paths = [p for p in file_paths if os.path.exists(p)]
-    if not valid_paths: return None
-    selected = random.choice(valid_paths)
+# ★変更: ヘッダー動画は base64 でページに埋め込まず static/ から配信する (再実行のたびに数MBを送らない)
+# .streamlit/config.toml の server.enableStaticServing で static/ が /app/static/ に出る (Range 要求・ETag 対応、ブラウザがキャッシュする)
+HEADER_VIDEO_DIR = 'static'
+HEADER_VIDEO_FALLBACK = "https://videos.pexels.com/video-files/5230349/5230349-uhd_2560_1440_25fps.mp4"
+
+def header_video_url(file_names):
+    """流す動画はセッションごとに1回だけ選ぶ (再実行で src が変わると読み直しになる)"""
+    if 'header_video' not in st.session_state:
+        valid = [f for f in file_names if os.path.exists(os.path.join(HEADER_VIDEO_DIR, f))]
+        st.session_state.header_video = random.choice(valid) if valid else None
+    name = st.session_state.header_video
+    if not name or not st.get_option('server.enableStaticServing'): return HEADER_VIDEO_FALLBACK
+    return f"app/static/{urllib.parse.quote(name)}"
+
+def detect_output_transform(model):
+    """
+    生スコア(寄与の合計)から predict() の出力に戻す変換を objective から決める。
+    ダミー1行で predict() と突き合わせ、一致しなければ None (寄与とは別に predict する)。
+    """
     try:
-        with open(selected, "rb") as f: return base64.b64encode(f.read()).decode()
-    except: return None
+        head = model.model_to_string(num_iteration=1)
+        m = re.search(r'^objective=(\S+)(.*)$', head, re.M)
+        obj, params = (m.group(1), m.group(2)) if m else ('', '')
+        if obj in ('binary', 'cross_entropy', 'xentropy'):
+            sm = re.search(r'sigmoid:([\d.]+)', params)
+            transform = ('sigmoid', float(sm.group(1)) if sm else 1.0)
+        elif obj in ('poisson', 'gamma', 'tweedie'):
+            transform = ('exp', 1.0)
+        else:
+            transform = ('identity', 1.0)
+
+        dummy = np.zeros((1, model.num_feature()))
+        margin = np.asarray(model.predict(dummy, pred_contrib=True)).sum(axis=1)
+        if np.allclose(apply_output_transform(margin, transform), model.predict(dummy), atol=1e-6):
+            return transform
+    except Exception: pass
+    return None
+
+def apply_output_transform(margin, transform):
+    kind, scale = transform
+    if kind == 'sigmoid': return 1.0 / (1.0 + np.exp(-scale * margin))
+    if kind == 'exp': return np.exp(margin)
+    return margin
+
+def predict_with_contrib(model_pack, X):
+    """
+    1回の predict(pred_contrib=True) で予測値と馬ごとの特徴量寄与を同時に求める。
+    戻り値: (raw_preds, 寄与 float32 [頭数 x 特徴量], ベース値)
+    """
+    model = model_pack['model']
+    with trace_span('model.predict', rows=len(X)):
+        contrib = np.asarray(model.predict(X, pred_contrib=True))
+        transform = model_pack.get('output_transform')
+        if transform:
+            raw_preds = apply_output_transform(contrib.sum(axis=1), transform)
+        else:
+            raw_preds = model.predict(X)
+    base = float(contrib[0, -1]) if len(contrib) else 0.0
+    return raw_preds, contrib[:, :-1].astype(np.float32), base
+
+def top_contrib_labels(values, feature_names, k=3):
+    """寄与がプラスに大きい特徴量を k 個まで日本語名で並べる (注目点の補足)"""
+    if values.size == 0: return [''] * len(values)
+    names = [FEATURE_NAME_MAP.get(f, f) for f in feature_names]
+    top_idx = np.argsort(-values, axis=1)[:, :k]
+    top_val = np.take_along_axis(values, top_idx, axis=1)
+    return [" ".join(f"{names[i]}↑" for i, v in zip(idx_row, val_row) if v > 0) for idx_row, val_row in zip(top_idx, top_val)]
+
+# ---------------------------------------------------------
+# ★追加: 軽量モデル形式 (起動時の joblib 展開を避ける)
+#   model.txt    : LightGBM のモデルテキスト
+#   calib_x/y.npy: isotonic キャリブレーターの閾値テーブル
+#   enc_N.npy    : エンコーダーのクラス配列 (固定長文字列)
+#   meta.json    : 特徴量リスト・バージョンなど
+# ---------------------------------------------------------
+class LookupCalibrator:
+    """IsotonicRegression(out_of_bounds='clip') を閾値テーブルの線形補間で再現する"""
+    def __init__(self, x, y):
+        self.x, self.y = x, y
+    def transform(self, raw):
+        return np.interp(np.asarray(raw, dtype=float), self.x, self.y)
+    predict = transform
+
+def export_compact_model(pack, encoders, out_dir=COMPACT_MODEL_DIR):
+    """joblib のモデルパック + エンコーダーを軽量形式で書き出す"""
+    os.makedirs(out_dir, exist_ok=True)
+    model, calibrator = pack['model'], pack['calibrator']
+    model_text = model.model_to_string()
+    with open(os.path.join(out_dir, 'model.txt'), 'w', encoding='utf-8') as f: f.write(model_text)
+
+    if hasattr(calibrator, 'X_thresholds_'):
+        calib_x, calib_y = calibrator.X_thresholds_, calibrator.y_thresholds_
+    else:
+        calib_x, calib_y = calibrator.x, calibrator.y
+    np.save(os.path.join(out_dir, 'calib_x.npy'), np.asarray(calib_x, dtype=np.float64))
+    np.save(os.path.join(out_dir, 'calib_y.npy'), np.asarray(calib_y, dtype=np.float64))
+
+    enc_files = {}
+    for i, (col, enc) in enumerate(encoders.items()):
+        enc_files[col] = f"enc_{i}.npy"
+        np.save(os.path.join(out_dir, enc_files[col]), np.asarray(getattr(enc, 'classes_', enc)).astype(str))
+
+    meta = {
+        'features': list(pack['features']),
+        'encoders': enc_files,
+        'version': hashlib.sha1(model_text.encode('utf-8')).hexdigest()[:12],
+        'output_transform': detect_output_transform(model),
+    }
+    with open(os.path.join(out_dir, 'meta.json'), 'w', encoding='utf-8') as f: json.dump(meta, f, ensure_ascii=False, indent=1)
+    return meta
+
+def load_compact_model(model_dir=COMPACT_MODEL_DIR):
+    """軽量形式を読み込む。配列は mmap で開くのでワーカーやプロセス間でページを共有できる"""
+    import lightgbm as lgb
+    with open(os.path.join(model_dir, 'meta.json'), encoding='utf-8') as f: meta = json.load(f)
+    model = lgb.Booster(model_file=os.path.join(model_dir, 'model.txt'))
+    load = lambda name: np.load(os.path.join(model_dir, name), mmap_mode='r')
+    calibrator = LookupCalibrator(load('calib_x.npy'), load('calib_y.npy'))
+    encoders = {col: load(name) for col, name in meta['encoders'].items()}
+    transform = meta.get('output_transform')
+    model_pack = {
+        'model': model, 'calibrator': calibrator, 'features': meta['features'],
+        'output_transform': tuple(transform) if transform else None, 'version': meta['version'],
+    }
+    return model_pack, encoders
+
+def model_artifact_mtime():
+    """キャッシュキー用: モデルファイルが差し替わったら load_resources を作り直す"""
+    for p in (os.path.join(COMPACT_MODEL_DIR, 'meta.json'), MODEL_PATH):
+        if os.path.exists(p): return os.path.getmtime(p)
+    return 0
 
 @st.cache_resource
 def load_resources(mtime):
     logs = {}
     try:
-        if os.path.exists(MODEL_PATH):
+        if os.path.exists(os.path.join(COMPACT_MODEL_DIR, 'meta.json')):
+            model_pack, encoders = load_compact_model()
+            logs['format'] = 'compact'
+        elif os.path.exists(MODEL_PATH):
             pack = joblib.load(MODEL_PATH)
             model = pack['model']
             calibrator = pack['calibrator']
             feature_cols = pack['features']
-            return {'model': model, 'calibrator': calibrator, 'features': feature_cols}, joblib.load(ENCODER_PATH), create_engine(DATABASE_URL), logs
+            model_pack = {'model': model, 'calibrator': calibrator, 'features': feature_cols, 'output_transform': detect_output_transform(model),
+                          'version': hashlib.sha1(model.model_to_string().encode('utf-8')).hexdigest()[:12]}
+            encoders = joblib.load(ENCODER_PATH)
+            logs['format'] = 'joblib'
         else: return None, None, None, {}
+        model_pack['importance'] = build_importance_table(model_pack['model'], model_pack['features'])
+        return model_pack, encoders, instrument_engine(create_engine(DATABASE_URL)), logs
     except Exception as e: return None, None, None, {'error': str(e)}
 
-@st.cache_data(ttl=600)
+# ★追加: 起動時のウォームアップ (モデル・DB・全体集計をバックグラウンドで先に読み込む)
+class Warmup:
+    def __init__(self):
+        self.done = threading.Event()
+        self.seconds = None
+        self.error = None
+
+@st.cache_resource
+def start_warmup():
+    """1プロセスに1回。ヘッダー等を描いている間に load_resources と騎手・調教師・血統の全体集計を済ませておく
+    (同じキャッシュを使うので、メインスレッドが先に呼んでも二重には読み込まず、終わるのを待つだけ)"""
+    state = Warmup()
+    def run():
+        t0 = time.time()
+        try:
+            _, _, engine, logs = load_resources(model_artifact_mtime())
+            if engine is not None:
+                get_global_jockey_stats(engine)
+                get_global_trainer_stats(engine)
+                get_global_pedigree_stats(engine)
+            state.error = logs.get('error')
+        except Exception as e: state.error = str(e)
+        finally:
+            state.seconds = time.time() - t0
+            state.done.set()
+    threading.Thread(target=run, daemon=True, name='warmup').start()
+    return state
+
+@metered_cache_data(ttl=600)
 def get_race_list_by_date(target_date):
     date_str = target_date.strftime('%Y%m%d')
     race_list = []
@@ -929,6 +1314,7 @@ def get_race_list_by_date(target_date):
         found_ids = re.findall(r'(20\d{10})', content)
         unique_ids = sorted(list(set(found_ids)))
         if unique_ids:
+            from bs4 import BeautifulSoup
             try: soup = BeautifulSoup(content, 'lxml')
             except: soup = BeautifulSoup(content, 'html.parser')
             for race_id in unique_ids:
@@ -970,12 +1356,13 @@ def get_race_list_by_date(target_date):
                 return race_list
     return race_list
 
-@st.cache_data(ttl=600)
+@metered_cache_data(ttl=600)
 def scrape_race_result(race_id):
     url = f"https://race.netkeiba.com/race/result.html?race_id={race_id}"
     try:
         content = get_html_content(url)
         if not content: return None, None, None, []
+        from bs4 import BeautifulSoup
         soup = BeautifulSoup(content, 'lxml')
         table = soup.find('table', class_='RaceTable01')
         rank_map = {}
@@ -1015,36 +1402,62 @@ def scrape_race_result(race_id):
         return (rank_map if rank_map else None), (win_map if win_map else None), (fukusho_map if fukusho_map else None), []
     except: return None, None, None, []
 
+def fetch_odds_api(race_id, odds_type=1):
+    """オッズAPIの生データ ({組番: [オッズ, ...]})。odds_type: 1=単勝 4=馬連 5=ワイド 6=馬単 7=三連複"""
+    if not race_id: return {}
+    try:
+        ts = int(time.time() * 1000)
+        api_url = f"https://race.netkeiba.com/api/api_get_jra_odds.html?race_id={race_id}&type={odds_type}&action=init&_={ts}"
+
+        # Refererを正しく設定（重要）
+        current_headers = HEADERS.copy()
+        current_headers.update({
+            'Referer': f"https://race.netkeiba.com/race/shutuba.html?race_id={race_id}",
+            'Pragma': 'no-cache',
+            'Cache-Control': 'no-cache'
+        })
+
+        with trace_span('http.odds', type=odds_type):
+            r_api = metered_get(api_url, headers=current_headers, timeout=5)
+        if r_api.status_code == 200:
+            return r_api.json().get('data', {}).get('odds', {}).get(str(odds_type), {}) or {}
+    except: pass
+    return {}
+
+def fetch_win_odds(race_id, record=True):
+    """オッズAPIから単勝オッズだけを取得する ({馬番: オッズ文字列})。record=False ならオッズの時系列に残さない"""
+    api_odds_map = {}
+    try:
+        for h, i in fetch_odds_api(race_id, 1).items(): api_odds_map[int(h)] = i[0]
+    except: pass
+    if api_odds_map and record: record_odds(race_id, api_odds_map) # ★追加: オッズの時系列を残す
+    return api_odds_map
+
+def fetch_race_page(url, driver=None):
+    """出馬表HTMLと単勝オッズを取得する (通信のみ)。戻り値: (HTML or None, オッズmap)"""
+    content = get_html_content(url, driver=driver)
+    if not content: return None, {}
+    race_id_match = re.search(r'race_id=(\d+)', url)
+    rid = race_id_match.group(1) if race_id_match else None
+    # ★修正: 一括スキャン時(driverあり)でもオッズが0になるのを防ぐため、
+    # 常にAPIを叩いてデータを確保するように戻します
+    return content, fetch_win_odds(rid)
+
 def scrape_race_data(url, driver=None):
     try:
-        content = get_html_content(url, driver=driver)
+        content, api_odds_map = fetch_race_page(url, driver=driver)
         if not content: return None
+        return parse_race_page(content, url, api_odds_map)
+    except: return None
+
+def parse_race_page(content, url, api_odds_map):
+    """出馬表HTMLを DataFrame にする (通信なし)"""
+    try:
+        from bs4 import BeautifulSoup
         soup = BeautifulSoup(content, 'lxml')
-        api_odds_map = {}
         race_id_match = re.search(r'race_id=(\d+)', url)
         rid = race_id_match.group(1) if race_id_match else None
-        
-        # ★修正: 一括スキャン時(driverあり)でもオッズが0になるのを防ぐため、
-        # 常にAPIを叩いてデータを確保するように戻します
-        if rid:
-            try:
-                ts = int(time.time() * 1000)
-                api_url = f"https://race.netkeiba.com/api/api_get_jra_odds.html?race_id={rid}&type=1&action=init&_={ts}"
-                
-                # Refererを正しく設定（重要）
-                current_headers = HEADERS.copy()
-                current_headers.update({
-                    'Referer': f"https://race.netkeiba.com/race/shutuba.html?race_id={rid}",
-                    'Pragma': 'no-cache', 
-                    'Cache-Control': 'no-cache'
-                })
-                
-                r_api = requests.get(api_url, headers=current_headers, timeout=5)
-                if r_api.status_code == 200:
-                    raw_odds = r_api.json().get('data', {}).get('odds', {}).get('1', {})
-                    for h, i in raw_odds.items(): api_odds_map[int(h)] = i[0]
-            except: pass
-        
+
         intro = soup.find('div', class_='RaceData01')
         intro_text = intro.get_text().replace('\n', '').strip() if intro else ""
         dist_match = re.search(r'(芝|ダ|障)(\d+)m', intro_text)
@@ -1136,13 +1549,19 @@ def scrape_race_data(url, driver=None):
         return pd.DataFrame(data_list) if data_list else None
     except: return None
 
-@st.cache_data(ttl=3600)
+# ★変更: DB の騎手・調教師一覧は session_state ではなく共有キャッシュに置く (バックグラウンドのスキャンからも使える)
+@metered_cache_data(ttl=3600)
+def get_db_jockeys(_engine):
+    return pd.read_sql('SELECT DISTINCT "騎手" FROM raw_race_results', _engine)['騎手'].dropna().unique().tolist()
+
+@metered_cache_data(ttl=3600)
+def get_db_trainers(_engine):
+    return pd.read_sql("SELECT DISTINCT REPLACE(\"調教師\", ']  ', '] ') as \"調教師\" FROM raw_race_results", _engine)['調教師'].dropna().unique().tolist()
+
+@metered_cache_data(ttl=3600)
 def resolve_jockey_names(_engine, target_jockeys_tuple):
     target_jockeys = list(target_jockeys_tuple)
-    try: 
-        if 'db_jockeys' not in st.session_state:
-            st.session_state.db_jockeys = pd.read_sql('SELECT DISTINCT "騎手" FROM raw_race_results', _engine)['騎手'].dropna().unique().tolist()
-        db_jockeys = st.session_state.db_jockeys
+    try: db_jockeys = get_db_jockeys(_engine)
     except: return {}, []
     mapping = {}
     missing = []
@@ -1155,13 +1574,11 @@ def resolve_jockey_names(_engine, target_jockeys_tuple):
         missing.append(target); mapping[target] = target
     return mapping, missing
 
-@st.cache_data(ttl=3600)
+@metered_cache_data(ttl=3600)
 def resolve_trainer_names(_engine, target_trainers_tuple):
     target_trainers = list(target_trainers_tuple)
     try: 
-        if 'db_trainers' not in st.session_state:
-            st.session_state.db_trainers = pd.read_sql("SELECT DISTINCT REPLACE(\"調教師\", ']  ', '] ') as \"調教師\" FROM raw_race_results", _engine)['調教師'].dropna().unique().tolist()
-        db_trainers = st.session_state.db_trainers
+        db_trainers = get_db_trainers(_engine)
         
         db_map_clean = {}
         for db_name in db_trainers:
@@ -1230,7 +1647,7 @@ def process_passage_rank(passage):
     try: return int(passage.split('-')[0])
     except: return np.nan
 
-@st.cache_data(ttl=600)
+@metered_cache_data(ttl=600)
 def calc_horse_history(_engine, horse_names_tuple, target_date):
     horse_names = list(horse_names_tuple)
     # Python側でも強力に空白除去 (タブや改行を含む)
@@ -1357,31 +1774,273 @@ def calc_horse_history(_engine, horse_names_tuple, target_date):
     except Exception as e:
         return pd.DataFrame(), {'error': str(e)}
 
-@st.cache_data(ttl=3600)
+@metered_cache_data(ttl=3600)
 def get_global_jockey_stats(_engine):
     return pd.read_sql('SELECT "騎手", AVG(CASE WHEN "着順"=\'1\' THEN 1.0 ELSE 0.0 END) as jockey_win_rate, AVG(CASE WHEN "着順" IN (\'1\', \'2\') THEN 1.0 ELSE 0.0 END) as jockey_rentai_rate FROM raw_race_results GROUP BY "騎手"', _engine)
 
-@st.cache_data(ttl=3600)
+@metered_cache_data(ttl=3600)
 def get_global_trainer_stats(_engine):
     return pd.read_sql("SELECT REPLACE(\"調教師\", ']  ', '] ') as \"調教師\", AVG(CASE WHEN \"着順\"='1' THEN 1.0 ELSE 0.0 END) as trainer_win_rate FROM raw_race_results GROUP BY REPLACE(\"調教師\", ']  ', '] ')", _engine)
 
-@st.cache_data(ttl=3600)
+@metered_cache_data(ttl=3600)
 def get_global_pedigree_stats(_engine):
     s_stats = pd.read_sql('SELECT sire_name, AVG(CASE WHEN "着順"=\'1\' THEN 1.0 ELSE 0.0 END) as sire_win_rate, AVG(CASE WHEN "着順" IN (\'1\', \'2\') THEN 1.0 ELSE 0.0 END) as sire_rentai_rate FROM raw_race_results r JOIN horses h ON r."馬名"=h.horse_name GROUP BY sire_name', _engine)
     b_stats = pd.read_sql('SELECT bms_name, AVG(CASE WHEN "着順"=\'1\' THEN 1.0 ELSE 0.0 END) as bms_win_rate, AVG(CASE WHEN "着順" IN (\'1\', \'2\') THEN 1.0 ELSE 0.0 END) as bms_rentai_rate FROM raw_race_results r JOIN horses h ON r."馬名"=h.horse_name GROUP BY bms_name', _engine)
     return s_stats, b_stats
 
-@st.cache_data(ttl=3600)
+@metered_cache_data(ttl=3600)
 def get_horse_pedigree_info(_engine, horse_names_tuple):
     names_str = "', '".join([n.replace("'", "''") for n in horse_names_tuple])
     query = f"SELECT horse_name, sire_name, bms_name FROM horses WHERE horse_name IN ('{names_str}')"
     return pd.read_sql(query, _engine)
 
+# ---------------------------------------------------------
+# 特徴量の組み立て (predict_race とオフラインの学習データ生成で共通)
+# ---------------------------------------------------------
+HISTORY_COLS_DEFAULTS = {
+    'prev_distance': 1600, 'prev_course_type': 'Unknown', 'prev_jockey': 'Unknown',
+    'nige_rate': 0, 'senko_rate': 0, 'avg_pos_rate': 0.5, 'run_style_ratio': 0,
+    'recent_rank_avg': 8.0, 'std_recent_3f': 0
+}
+FILL_ZERO_COLS = ['jockey_win_rate', 'jockey_rentai_rate', 'trainer_win_rate',
+                  'sire_win_rate', 'sire_rentai_rate', 'bms_win_rate', 'bms_rentai_rate',
+                  'interval_weeks', 'prev_rank', 'prev_3f', 'prev_margin',
+                  'recent_3f_avg', 'recent_rank_avg', 'run_style_ratio', 'total_wins', 'total_money', 'win_ratio',
+                  'dist_change', 'is_dist_shorten', 'is_dist_extend', 'course_change', 'is_same_jockey', 'crs_rate']
+CATEGORICAL_COLS = ['開催場所', 'コース区分', '回り', 'クラス']
+
+def derive_race_features(df):
+    """
+    結合済みの出走表 (騎手/調教師/血統/過去走の統計つき) から派生特徴量を作る。
+    レース単位の集計 (先行馬の数・ペース予測・偏差) は race_id ごとに計算するので、
+    1レース分でも複数年分でも同じ結果になる。
+    """
+    if 'sire_name' not in df.columns: df['sire_name'] = '-'
+    if 'bms_name' not in df.columns: df['bms_name'] = '-'
+
+    # 履歴カラムのデフォルト初期化 (fillnaで強制的に埋める)
+    for c, v in HISTORY_COLS_DEFAULTS.items():
+        if c not in df.columns:
+            df[c] = v
+        else:
+            df[c] = df[c].fillna(v)
+
+    df['距離'] = pd.to_numeric(df['距離'], errors='coerce').fillna(1600)
+    df['prev_distance'] = pd.to_numeric(df['prev_distance'], errors='coerce').fillna(df['距離'])
+    df['dist_change'] = df['距離'] - df['prev_distance']
+    df['is_dist_shorten'] = (df['dist_change'] < 0).astype(int)
+    df['is_dist_extend'] = (df['dist_change'] > 0).astype(int)
+
+    df['prev_course_type'] = df['prev_course_type'].fillna(df['コース区分'])
+    df['course_change'] = (df['コース区分'] != df['prev_course_type']).astype(int)
+
+    df['騎手_clean'] = df['騎手_db'].fillna(df['騎手']).astype(str).str.replace(" ", "").str.replace("　", "")
+    df['prev_jockey'] = df['prev_jockey'].fillna(df['騎手_clean'])
+    df['is_same_jockey'] = (df['騎手_clean'] == df['prev_jockey']).astype(int)
+
+    # レース単位の集計
+    race_key = df['race_id'].astype(str) if 'race_id' in df.columns else pd.Series(0, index=df.index)
+    grp_is_nige = (df['nige_rate'] > 0.5).astype(int).groupby(race_key)
+    grp_is_senko = (df['senko_rate'] > 0.5).astype(int).groupby(race_key)
+    df['nige_count'] = grp_is_nige.transform('sum')
+    df['senko_count'] = grp_is_senko.transform('sum')
+    df['horse_count'] = grp_is_senko.transform('size')
+    df['senko_ratio_in_race'] = df['senko_count'] / df['horse_count']
+
+    is_high = (df['senko_ratio_in_race'] >= 0.4).astype(int)
+    is_slow = (df['senko_ratio_in_race'] <= 0.2).astype(int)
+    df['is_high_pace_forecast'] = is_high
+    df['is_slow_pace_forecast'] = is_slow
+
+    df['dist_to_first_corner'] = [COURSE_START_TO_CORNER.get(k, 300) for k in zip(df['開催場所'], df['コース区分'], df['距離'])]
+
+    df['枠番'] = pd.to_numeric(df['枠番'], errors='coerce').fillna(0)
+    df['dist_to_corner_x_waku'] = df['dist_to_first_corner'] * df['枠番']
+
+    mask_slow = (is_slow == 1) & (df['avg_pos_rate'] <= 0.3)
+    mask_high = (is_high == 1) & (df['avg_pos_rate'] > 0.6)
+    df['is_pace_advantage'] = (mask_slow | mask_high).astype(int)
+
+    adv_cols = ['jockey_course_rentai_rate', 'sire_surface_win_rate', 'tag_win_rate']
+    for c in adv_cols:
+        if c not in df.columns: df[c] = 0.0
+
+    for c in FILL_ZERO_COLS:
+        if c not in df.columns: df[c] = 0
+        df[c] = pd.to_numeric(df[c], errors='coerce').fillna(0)
+
+    # レース内の偏差 (標準偏差0なら0)
+    def calc_std(col):
+        x = df[col].astype(float)
+        grp = x.groupby(race_key)
+        mean, std = grp.transform('mean'), grp.transform('std')
+        return pd.Series(np.where(std == 0, 0.0, (x - mean) / std), index=df.index)
+
+    df['std_recent_3f'] = calc_std('recent_3f_avg')
+    df['std_recent_rank'] = calc_std('recent_rank_avg')
+    df['std_jockey_win'] = calc_std('jockey_win_rate')
+    df['std_trainer_win'] = calc_std('trainer_win_rate')
+    df['std_sire_win'] = calc_std('sire_win_rate')
+    return df
+
+def encode_categoricals(df, encoders):
+    """カテゴリ列を学習時のラベル番号に変換する (未知の値は 'Unknown'、それも無ければ 0)"""
+    for c in CATEGORICAL_COLS:
+        if c in encoders:
+            classes = getattr(encoders[c], 'classes_', encoders[c])
+            index = {v: i for i, v in enumerate(classes)}
+            df[c] = df[c].astype(str).map(index).fillna(index.get('Unknown', 0)).astype(int)
+        else:
+            df[c] = 0
+    return df
+
+def feature_matrix(df, feature_cols):
+    """モデルに渡す入力行列。数値化できない値・欠損は 0 (学習と推論で同じ扱いにする)"""
+    return df[list(feature_cols)].apply(pd.to_numeric, errors='coerce').fillna(0).astype(float)
+
+# ---------------------------------------------------------
+# ★追加: as-of 集計 (各レースの前日までの結果だけを使う。学習データ生成とバックテストで共通)
+# ---------------------------------------------------------
+ASOF_RESULT_COLS = ['date', 'race_id', '馬名', '着順', '上り', '着差', '通過', '賞金(万円)', '距離', 'コース区分',
+               '騎手', '調教師', '開催場所', '枠番', '馬番', '回り', 'クラス']
+
+# calc_horse_history で過去走が無い馬に入れる値
+NO_HISTORY_DEFAULTS = {
+    'interval_weeks': 0, 'prev_rank': 0, 'prev_3f': 36.0, 'prev_margin': 0.5,
+    'recent_3f_avg': 36.0, 'recent_rank_avg': 8.0, 'run_style_ratio': 0,
+    'total_wins': 0, 'total_money': 0, 'win_ratio': 0,
+    'prev_distance': 1600, 'prev_course_type': 'Unknown', 'prev_jockey': 'Unknown',
+    'nige_rate': 0, 'senko_rate': 0, 'avg_pos_rate': 0.5,
+}
+
+
+def load_asof_results(engine, end_date):
+    """end_date より前の全レース結果を読み込み、predict_race 側と同じ正規化をかける"""
+    available = pd.read_sql('SELECT * FROM raw_race_results LIMIT 0', engine).columns
+    cols = ", ".join(f'"{c}"' for c in ASOF_RESULT_COLS if c in available)
+    df = pd.read_sql(f'SELECT {cols} FROM raw_race_results WHERE "date" < \'{end_date}\'', engine)
+    for c in ASOF_RESULT_COLS:
+        if c not in df.columns: df[c] = 'Unknown' if c in ('回り', 'クラス') else np.nan
+
+    df['date'] = pd.to_datetime(df['date'])
+    df['race_id'] = df['race_id'].astype(str)
+    df['着順_num'] = pd.to_numeric(df['着順'], errors='coerce')
+    df['上り'] = pd.to_numeric(df['上り'], errors='coerce')
+    df['着差'] = df['着差'].apply(convert_raw_margin)
+    df['money'] = pd.to_numeric(df['賞金(万円)'], errors='coerce').fillna(0)
+    # SQL 側の AVG(CASE WHEN "着順"='1' ...) と同じく文字列で判定する
+    rank_str = df['着順'].astype(str).str.strip()
+    df['is_win'] = (rank_str == '1').astype(int)
+    df['is_rentai'] = rank_str.isin(['1', '2']).astype(int)
+    df['is_top3'] = rank_str.isin(['1', '2', '3']).astype(int)
+    df['馬名_clean'] = df['馬名'].astype(str).str.replace(r'\s+', '', regex=True)
+    df['騎手_clean'] = df['騎手'].astype(str).str.replace(r'\s+', '', regex=True)
+    df['調教師_norm'] = df['調教師'].astype(str).str.replace(']  ', '] ', regex=False)
+    return df.sort_values(['date', 'race_id']).reset_index(drop=True)
+
+def load_horse_pedigree(engine):
+    try: return pd.read_sql('SELECT horse_name, sire_name, bms_name FROM horses', engine)
+    except Exception: return None
+
+def asof_mean(hist, keys, values, names):
+    """keys ごとに「前日まで」の平均を求める。戻り値は keys + date で結合できる DataFrame"""
+    work = hist[keys + ['date'] + values].copy()
+    work['_n'] = 1
+    daily = work.groupby(keys + ['date'], sort=True)[values + ['_n']].sum()
+    prior = daily.groupby(level=list(range(len(keys)))).cumsum() - daily
+    rates = prior[values].div(prior['_n'].where(prior['_n'] > 0), axis=0)
+    rates.columns = names
+    return rates.reset_index()
+
+def attach_asof(target, stats, left_keys, right_keys):
+    stats = stats.rename(columns=dict(zip(right_keys, left_keys)))
+    return target.merge(stats, on=left_keys + ['date'], how='left')
+
+def horse_history_features(hist):
+    """calc_horse_history を全レース分まとめて計算する (1頭ずつのループなし)"""
+    h = hist.copy()
+    headcount = h.groupby('race_id')['馬名'].transform('size').astype(float)
+    h['first_pos'] = h['通過'].apply(process_passage_rank)
+    h['pos_rate'] = h['first_pos'] / headcount
+    h['is_nige'] = (h['first_pos'] == 1).astype(int)
+    h['is_senko'] = (h['pos_rate'] <= 0.3).astype(int)
+
+    h = h.sort_values(['馬名_clean', 'date'], kind='mergesort')
+    g = h.groupby('馬名_clean', sort=False)
+    prev = g[['date', '着順_num', '上り', '着差', '距離', 'コース区分', '騎手_clean']].shift(1)
+
+    def rolling_prev(col, window):
+        shifted = g[col].shift(1)
+        return shifted.groupby(h['馬名_clean']).rolling(window, min_periods=1).mean().reset_index(level=0, drop=True)
+
+    n_prev = g.cumcount()
+    out = pd.DataFrame({
+        '馬名_clean': h['馬名_clean'], 'date': h['date'],
+        'interval_weeks': (h['date'] - prev['date']).dt.days / 7,
+        'prev_rank': prev['着順_num'], 'prev_3f': prev['上り'], 'prev_margin': prev['着差'],
+        'prev_distance': prev['距離'], 'prev_course_type': prev['コース区分'], 'prev_jockey': prev['騎手_clean'],
+        'recent_3f_avg': rolling_prev('上り', 3), 'recent_rank_avg': rolling_prev('着順_num', 3),
+        'nige_rate': rolling_prev('is_nige', 5), 'senko_rate': rolling_prev('is_senko', 5),
+        'avg_pos_rate': rolling_prev('pos_rate', 5),
+        'total_wins': g['is_win'].cumsum() - h['is_win'],
+        'total_money': g['money'].cumsum() - h['money'],
+    }, index=h.index)
+    out['run_style_ratio'] = out['senko_rate']
+    out['win_ratio'] = np.where(n_prev > 0, out['total_wins'] / n_prev.clip(lower=1), 0)
+
+    # 過去走なしの馬は calc_horse_history と同じ固定値
+    first = n_prev == 0
+    for c, v in NO_HISTORY_DEFAULTS.items():
+        out[c] = out[c].astype(object if isinstance(v, str) else float)
+        out.loc[first, c] = v
+    return out.drop_duplicates(['馬名_clean', 'date'])
+
+def build_asof_frame(hist, horses, since=None):
+    """対象の各出走行 (since 以降) に、predict_race が SQL で付けている統計を as-of で結合する"""
+    target = hist[hist['着順_num'].notna()]
+    if since is not None: target = target[target['date'] >= pd.Timestamp(since)]
+    target = target.copy()
+    target['騎手_db'] = target['騎手']
+    target['調教師_db'] = target['調教師_norm']
+
+    # 騎手・調教師 (get_global_jockey_stats / get_global_trainer_stats)
+    target = attach_asof(target, asof_mean(hist, ['騎手'], ['is_win', 'is_rentai'], ['jockey_win_rate', 'jockey_rentai_rate']), ['騎手'], ['騎手'])
+    target = attach_asof(target, asof_mean(hist, ['調教師_norm'], ['is_win'], ['trainer_win_rate']), ['調教師_norm'], ['調教師_norm'])
+
+    # 過去走 (calc_horse_history)
+    target = target.merge(horse_history_features(hist), on=['馬名_clean', 'date'], how='left')
+
+    # crs_rate / jockey_course_* / tag_win_rate / course_waku_win_rate
+    target = attach_asof(target, asof_mean(hist, ['馬名', '開催場所', 'コース区分'], ['is_top3'], ['crs_rate']), ['馬名', '開催場所', 'コース区分'], ['馬名', '開催場所', 'コース区分'])
+    target = attach_asof(target, asof_mean(hist, ['騎手', '開催場所', 'コース区分'], ['is_win', 'is_rentai'], ['jockey_course_win_rate', 'jockey_course_rentai_rate']), ['騎手', '開催場所', 'コース区分'], ['騎手', '開催場所', 'コース区分'])
+    tag = asof_mean(hist, ['騎手', '調教師'], ['is_win'], ['tag_win_rate'])
+    target = attach_asof(target, tag, ['騎手', '調教師'], ['騎手', '調教師'])
+    # predict_race は正規化済みの調教師名で生の調教師名に結合するため、表記が違う行は欠損になる
+    target.loc[target['調教師'].astype(str) != target['調教師_norm'], 'tag_win_rate'] = np.nan
+    hist_waku = hist.assign(枠番=pd.to_numeric(hist['枠番'], errors='coerce'), 距離=pd.to_numeric(hist['距離'], errors='coerce'))
+    target['枠番'] = pd.to_numeric(target['枠番'], errors='coerce')
+    target['距離'] = pd.to_numeric(target['距離'], errors='coerce')
+    target = attach_asof(target, asof_mean(hist_waku, ['開催場所', 'コース区分', '距離', '枠番'], ['is_win'], ['course_waku_win_rate']), ['開催場所', 'コース区分', '距離', '枠番'], ['開催場所', 'コース区分', '距離', '枠番'])
+
+    # 血統 (get_horse_pedigree_info / get_global_pedigree_stats / sire_surface_win_rate)
+    if horses is not None and not horses.empty:
+        ped = horses.drop_duplicates('horse_name')[['horse_name', 'sire_name', 'bms_name']]
+        hist_ped = hist.merge(ped, left_on='馬名', right_on='horse_name', how='inner')
+        target = target.merge(ped, left_on='馬名', right_on='horse_name', how='left')
+        target = attach_asof(target, asof_mean(hist_ped, ['sire_name'], ['is_win', 'is_rentai'], ['sire_win_rate', 'sire_rentai_rate']), ['sire_name'], ['sire_name'])
+        target = attach_asof(target, asof_mean(hist_ped, ['bms_name'], ['is_win', 'is_rentai'], ['bms_win_rate', 'bms_rentai_rate']), ['bms_name'], ['bms_name'])
+        target = attach_asof(target, asof_mean(hist_ped, ['sire_name', 'コース区分'], ['is_win'], ['sire_surface_win_rate']), ['sire_name', 'コース区分'], ['sire_name', 'コース区分'])
+
+    for col in ['jockey_course_win_rate', 'tag_win_rate', 'course_waku_win_rate', 'crs_rate']:
+        target[col] = target[col].fillna(0.0)
+    return target
+
 def predict_race(df, model_pack, encoders, _engine):
-    model = model_pack['model']
-    calibrator = model_pack['calibrator']
-    feature_cols = model_pack['features']
+    df, diag_data, missing_info = build_race_features(df, encoders, _engine)
+    return score_race(df, model_pack, diag_data, missing_info)
 
+def build_race_features(df, encoders, _engine):
+    """DB 集計の結合 + 派生特徴量 + カテゴリ変換 (モデルは使わない)"""
     j_map, missing_j = resolve_jockey_names(_engine, tuple(df['騎手'].unique().tolist()))
     df['騎手_db'] = df['騎手'].map(j_map)
     # 修正: 戻り値変更に対応
@@ -1533,115 +2192,41 @@ def predict_race(df, model_pack, encoders, _engine):
             diag_data['pedigree'] = ped_info
     except: pass
 
-    if 'sire_name' not in df.columns: df['sire_name'] = '-'
-    if 'bms_name' not in df.columns: df['bms_name'] = '-'
-    
-    # 履歴カラムのデフォルト初期化 (fillnaで強制的に埋める)
-    history_cols_defaults = {
-        'prev_distance': 1600, 'prev_course_type': 'Unknown', 'prev_jockey': 'Unknown',
-        'nige_rate': 0, 'senko_rate': 0, 'avg_pos_rate': 0.5, 'run_style_ratio': 0,
-        'recent_rank_avg': 8.0, 'std_recent_3f': 0
-    }
-    for c, v in history_cols_defaults.items():
-        if c not in df.columns:
-            df[c] = v
-        else:
-            df[c] = df[c].fillna(v)
-
-    df['距離'] = pd.to_numeric(df['距離'], errors='coerce').fillna(1600)
-    df['prev_distance'] = pd.to_numeric(df['prev_distance'], errors='coerce').fillna(df['距離'])
-    df['dist_change'] = df['距離'] - df['prev_distance']
-    df['is_dist_shorten'] = (df['dist_change'] < 0).astype(int)
-    df['is_dist_extend'] = (df['dist_change'] > 0).astype(int)
-    
-    df['prev_course_type'] = df['prev_course_type'].fillna(df['コース区分'])
-    df['course_change'] = (df['コース区分'] != df['prev_course_type']).astype(int)
-    
-    df['騎手_clean'] = df['騎手_db'].fillna(df['騎手']).astype(str).str.replace(" ", "").str.replace("　", "")
-    df['prev_jockey'] = df['prev_jockey'].fillna(df['騎手_clean'])
-    df['is_same_jockey'] = (df['騎手_clean'] == df['prev_jockey']).astype(int)
+    df = derive_race_features(df)
     diag_data['jockey_check_df'] = df[['馬名', '騎手', '騎手_db', 'prev_jockey', 'is_same_jockey']].copy()
 
-    if 'nige_rate' not in df.columns: df['nige_rate'] = 0
-    if 'senko_rate' not in df.columns: df['senko_rate'] = 0
-    
-    nige_count = (df['nige_rate'] > 0.5).sum()
-    senko_count = (df['senko_rate'] > 0.5).sum()
-    horse_count = len(df)
-    senko_ratio = senko_count / horse_count if horse_count > 0 else 0
-    
-    df['nige_count'] = nige_count
-    df['senko_count'] = senko_count
-    df['senko_ratio_in_race'] = senko_ratio
-    df['horse_count'] = horse_count
-    
-    is_high = 1 if senko_ratio >= 0.4 else 0
-    is_slow = 1 if senko_ratio <= 0.2 else 0
-    df['is_high_pace_forecast'] = is_high
-    df['is_slow_pace_forecast'] = is_slow
-    
-    def get_dist(row):
-        key = (row['開催場所'], row['コース区分'], row['距離'])
-        return COURSE_START_TO_CORNER.get(key, 300)
-    df['dist_to_first_corner'] = df.apply(get_dist, axis=1)
-    
-    df['枠番'] = pd.to_numeric(df['枠番'], errors='coerce').fillna(0)
-    df['dist_to_corner_x_waku'] = df['dist_to_first_corner'] * df['枠番']
-    
-    df['is_pace_advantage'] = 0
-    mask_slow = (is_slow == 1) & (df['avg_pos_rate'] <= 0.3)
-    df.loc[mask_slow, 'is_pace_advantage'] = 1
-    mask_high = (is_high == 1) & (df['avg_pos_rate'] > 0.6)
-    df.loc[mask_high, 'is_pace_advantage'] = 1
-
-    adv_cols = ['jockey_course_rentai_rate', 'sire_surface_win_rate', 'tag_win_rate']
-    for c in adv_cols:
-        if c not in df.columns: df[c] = 0.0
-
-    cols_fill_0 = ['jockey_win_rate', 'jockey_rentai_rate', 'trainer_win_rate', 
-                   'sire_win_rate', 'sire_rentai_rate', 'bms_win_rate', 'bms_rentai_rate',
-                   'interval_weeks', 'prev_rank', 'prev_3f', 'prev_margin', 
-                   'recent_3f_avg', 'recent_rank_avg', 'run_style_ratio', 'total_wins', 'total_money', 'win_ratio',
-                   'dist_change', 'is_dist_shorten', 'is_dist_extend', 'course_change', 'is_same_jockey', 'crs_rate']
-    for c in cols_fill_0:
-        if c not in df.columns: df[c] = 0
-        df[c] = pd.to_numeric(df[c], errors='coerce').fillna(0)
-
-    def calc_std(x):
-        if x.std() == 0: return 0
-        return (x - x.mean()) / x.std()
-        
-    df['std_recent_3f'] = calc_std(df['recent_3f_avg'])
-    df['std_recent_rank'] = calc_std(df['recent_rank_avg'])
-    df['std_jockey_win'] = calc_std(df['jockey_win_rate'])
-    df['std_trainer_win'] = calc_std(df['trainer_win_rate'])
-    df['std_sire_win'] = calc_std(df['sire_win_rate'])
-
     if 'クラス' in df.columns and 'race_title_raw' in df.columns:
         diag_data['class_debug'] = df[['race_title_raw', 'クラス']].drop_duplicates().to_dict(orient='records')
         diag_data['raw_class_values'] = df[['race_title_raw', 'クラス']].copy()
 
-    cat_cols = ['開催場所', 'コース区分', '回り', 'クラス']
-    for c in cat_cols:
-        if c in encoders:
-            le = encoders[c]
-            df[c] = df[c].astype(str).map(lambda x: x if x in le.classes_ else 'Unknown')
-            df[c] = df[c].apply(lambda x: le.transform([x])[0] if x in le.classes_ else 0)
-        else:
-            df[c] = 0
+    df = encode_categoricals(df, encoders)
+    return df, diag_data, missing_info
 
-    X = df[feature_cols]
-    for col in X.columns:
-        X[col] = pd.to_numeric(X[col], errors='coerce').fillna(0)
-    
+def score_race(df, model_pack, diag_data, missing_info):
+    """特徴量済みの出走馬にスコア・判定を付ける (DB・通信なし)"""
+    calibrator = model_pack['calibrator']
+    feature_cols = model_pack['features']
+
+    X = feature_matrix(df, feature_cols)
+
+    contrib = {}
     try:
-        raw_preds = model.predict(X)
+        # ★変更: 予測と同じバッチ呼び出しで特徴量寄与も取得する (詳細画面の説明用)
+        raw_preds, contrib_values, contrib_base = predict_with_contrib(model_pack, X)
         df['raw_preds'] = raw_preds # Keep raw for tie-break
         probs = calibrator.transform(raw_preds)
         df['AIスコア'] = probs
+        df['AI根拠'] = top_contrib_labels(contrib_values, feature_cols)
+        contrib = {
+            'umaban': pd.to_numeric(df['馬番'], errors='coerce').fillna(0).to_numpy(dtype=np.int16),
+            'values': contrib_values,
+            'base': np.float32(contrib_base),
+            'features': tuple(feature_cols),
+        }
     except Exception as e:
         df['AIスコア'] = 0
         df['raw_preds'] = 0
+        df['AI根拠'] = ''
         
     df['AI Rating'] = (df['AIスコア'] * 400).clip(0, 99).astype(int)
     
@@ -1662,26 +2247,14 @@ def predict_race(df, model_pack, encoders, _engine):
         return " ".join(r)
     df['BoostReason'] = df.apply(get_reason, axis=1)
     
-    def get_rec(row):
-        p = row['AIスコア']
-        try:
-            o_str = str(row['オッズ']).replace('-','0')
-            if o_str == '0': o = 0.0
-            else: o = float(o_str)
-        except: o = 0.0
-        
-        if row['is_pace_advantage'] == 1 and p >= 0.1 and 10.0 <= o <= 50.0:
-            return "🚀 展開ブースト", "-"
-        if p >= 0.08 and 50.0 <= o <= 150.0:
-            return "-", "💣 穴馬ブースト"
-        if p >= 0.20 and 5.0 <= o <= 30.0:
-            return "💎 黄金法則", "-"
-        return "-", "-"
-
-    df[['判定', '判定_穴']] = df.apply(lambda x: pd.Series(get_rec(x)), axis=1)
-    
+    # オッズ依存の列 (EV・判定) は reprice_race と同じ関数で計算する
+    odds = parse_odds_values(df['オッズ'].tolist())
+    probs = df['AIスコア'].to_numpy(dtype=float)
+    df['EV'] = probs * odds
+    df['判定'], df['判定_穴'] = evaluate_bet_rules(probs, odds, df['is_pace_advantage'].to_numpy())
+
     # ★修正: 展開ブースト（Boost対象）を強制的に最上位に表示する
-    df['is_boost'] = (df['判定'] == "🚀 展開ブースト").astype(int)
+    df['is_boost'] = (df['判定'] == REC_PACE).astype(int)
     
     trace_cols = ['馬名', 'date', 'interval_weeks', 'prev_3f', 'prev_margin', 'recent_3f_avg', 'jockey_win_rate', 'dist_change', 'nige_rate', 'senko_rate', 'is_pace_advantage']
     for c in trace_cols:
@@ -1689,119 +2262,767 @@ def predict_race(df, model_pack, encoders, _engine):
     trace_df = df[trace_cols].copy()
     
     # ソート順: Boost対象 -> AIスコア -> 生スコア
-    return df.sort_values(['is_boost', 'AIスコア', 'raw_preds'], ascending=[False, False, False]), df, X, diag_data, missing_info, trace_df
+    return df.sort_values(['is_boost', 'AIスコア', 'raw_preds'], ascending=[False, False, False]), df, X, diag_data, missing_info, trace_df, contrib
 
-def process_one_race(race, model, encoders, engine, driver=None):
-    """並列処理用の単一レース処理関数"""
+# ---------------------------------------------------------
+# 5. オッズ再評価 (特徴量・モデルを通さずにオッズ依存の出力だけ更新)
+# ---------------------------------------------------------
+def parse_odds_value(o):
     try:
-        df = scrape_race_data(race['url'], driver=driver)
-        if df is not None and not df.empty:
-            res, debug, X_renamed, diag_data, missing_info, trace_df = predict_race(df, model, encoders, engine)
-            
-            # 結果サマリー
-            top_ai = res.iloc[0]
-            
-            # ★変更: 抽出された馬リストの中で、最もAIスコアが高い馬を「購入対象」としてマークする
-            
-            # 1. 展開ブースト (スコア順にソートして先頭1頭をBUY対象にする)
-            pace_hits = res[res['判定'] == "🚀 展開ブースト"].copy()
-            pace_buy_idx = -1
-            if not pace_hits.empty:
-                pace_hits = pace_hits.sort_values(['AIスコア', 'raw_preds'], ascending=[False, False])
-                pace_hits['is_bet_target'] = False
-                # 先頭行(最高スコア)をTrueに
-                pace_hits.iat[0, pace_hits.columns.get_loc('is_bet_target')] = True
-                pace_buy_idx = pace_hits.index[0]
-            
-            # 2. 穴馬 (同様にソートして先頭1頭をBUY対象にする)
-            hole_hits = res[res['判定_穴'] == "💣 穴馬ブースト"].copy()
-            hole_buy_idx = -1
-            if not hole_hits.empty:
-                hole_hits = hole_hits.sort_values(['AIスコア', 'raw_preds'], ascending=[False, False])
-                hole_hits['is_bet_target'] = False
-                hole_hits.iat[0, hole_hits.columns.get_loc('is_bet_target')] = True
-                hole_buy_idx = hole_hits.index[0]
-            
-            try: top_odds = float(str(top_ai['オッズ']).replace('-','0'))
-            except: top_odds = 0
-            is_ai_target = (3.0 <= top_odds <= 30.0)
-            
-            # 3. 鉄板 (条件を満たせばTrue)
-            ai_hit_df = res.iloc[[0]].copy()
-            ai_hit_df['is_bet_target'] = is_ai_target
-            ai_buy_idx = res.index[0] if is_ai_target else -1
-
-            # バッジ処理 (各DFに対して行う)
-            # 注意: リスト内包表記で初期化しないと、全行が同じリストオブジェクトを参照してしまう
-            for df in [pace_hits, hole_hits, ai_hit_df]:
-                if not df.empty:
-                    df['overlap_badges'] = [[] for _ in range(len(df))]
-
-            # Pace Listへのバッジ付与
-            if not pace_hits.empty:
-                for idx in pace_hits.index:
-                    badges = ['pace']
-                    if idx == hole_buy_idx: badges.append('hole')
-                    if idx == ai_buy_idx: badges.append('ai')
-                    pace_hits.at[idx, 'overlap_badges'] = badges
-
-            # Hole Listへのバッジ付与
-            if not hole_hits.empty:
-                for idx in hole_hits.index:
-                    badges = ['hole']
-                    if idx == pace_buy_idx: badges.append('pace')
-                    if idx == ai_buy_idx: badges.append('ai')
-                    hole_hits.at[idx, 'overlap_badges'] = badges
-
-            # AI Listへのバッジ付与
-            if not ai_hit_df.empty:
-                 for idx in ai_hit_df.index:
-                    badges = ['ai']
-                    if idx == pace_buy_idx: badges.append('pace')
-                    if idx == hole_buy_idx: badges.append('hole')
-                    ai_hit_df.at[idx, 'overlap_badges'] = badges
-
-            # 成績集計用データ
-            race_id = df.iloc[0]['race_id']
-            ranks, win_p, place_p, _ = scrape_race_result(race_id)
-            
-            return {
-                'status': 'success',
-                'race': race,
-                'df': res,
-                'pace_hits': pace_hits, # マーク付きDFを返す
-                'hole_hits': hole_hits, # マーク付きDFを返す
-                'ai_hit_df': ai_hit_df, # マーク付きDFを返す
-                'is_ai_target': is_ai_target,
-                'top_ai': top_ai,
-                'ranks': ranks,
-                'win_p': win_p,
-                'place_p': place_p,
-                'missing_info': missing_info,
-                'debug': debug,
-                'X_renamed': X_renamed,
-                'diag_data': diag_data,
-                'trace_df': trace_df
-            }
-        return {'status': 'empty', 'race': race}
-    except Exception as e:
-        return {'status': 'error', 'race': race, 'error': str(e)}
+        o_str = str(o).replace('-', '0')
+        if o_str == '0': return 0.0
+        return float(o_str)
+    except: return 0.0
+
+def parse_odds_values(values):
+    return np.fromiter((parse_odds_value(v) for v in values), dtype=float, count=len(values))
+
+def evaluate_bet_rules(probs, odds, pace_adv, rules=None):
+    """get_rec のベクトル版。ルールは上から優先 (展開ブースト → 穴馬 → 黄金法則)"""
+    rules = rules or BET_RULES
+    probs = np.asarray(probs, dtype=float)
+    odds = np.asarray(odds, dtype=float)
+
+    def in_rule(key):
+        r = rules[key]
+        return (probs >= r['min_prob']) & (odds >= r['odds_min']) & (odds <= r['odds_max'])
+
+    is_pace = (np.asarray(pace_adv) == 1) & in_rule('pace')
+    is_hole = ~is_pace & in_rule('hole')
+    is_gold = ~is_pace & ~is_hole & in_rule('gold')
+    hantei = np.where(is_pace, REC_PACE, np.where(is_gold, REC_GOLD, '-')).astype(object)
+    hantei_ana = np.where(is_hole, REC_HOLE, '-').astype(object)
+    return hantei, hantei_ana
+
+def summarize_race(res, rules=None):
+    """ソート済みの予測結果から、各戦略のヒット馬・購入対象(BUY)・重複バッジを組み立てる"""
+    rules = rules or BET_RULES
+    probs = res['AIスコア'].to_numpy(dtype=float)
+    raw = res['raw_preds'].to_numpy(dtype=float)
+
+    # 抽出された馬リストの中で、最もAIスコアが高い馬を「購入対象」とする
+    def hit_positions(mask):
+        pos = np.flatnonzero(mask)
+        return pos[np.lexsort((-raw[pos], -probs[pos]))]
+
+    pace_pos = hit_positions(res['判定'].to_numpy() == REC_PACE)
+    hole_pos = hit_positions(res['判定_穴'].to_numpy() == REC_HOLE)
+
+    # 鉄板: ソート先頭の馬がオッズ帯に入っていれば購入対象
+    top_odds = parse_odds_value(res['オッズ'].iat[0])
+    is_ai_target = bool(rules['ai']['odds_min'] <= top_odds <= rules['ai']['odds_max'])
+
+    buy = {
+        'pace': pace_pos[0] if len(pace_pos) else -1,
+        'hole': hole_pos[0] if len(hole_pos) else -1,
+        'ai': 0 if is_ai_target else -1,
+    }
+
+    def build(pos, own, bet_flags):
+        hits = res.take(pos)
+        if hits.empty: return hits
+        hits['is_bet_target'] = bet_flags
+        # 注意: リスト内包表記で初期化しないと、全行が同じリストオブジェクトを参照してしまう
+        hits['overlap_badges'] = [[own] + [k for k in ('pace', 'hole', 'ai') if k != own and buy[k] == p] for p in pos]
+        return hits
+
+    return {
+        'pace_hits': build(pace_pos, 'pace', np.arange(len(pace_pos)) == 0),
+        'hole_hits': build(hole_pos, 'hole', np.arange(len(hole_pos)) == 0),
+        'ai_hit_df': build(np.array([0]), 'ai', is_ai_target),
+        'is_ai_target': is_ai_target,
+        'top_ai': res.iloc[0],
+    }
+
+def reprice_race(res, odds_map, rules=None):
+    """
+    キャッシュ済みの予測結果(res)のオッズだけを差し替え、EV・判定・並び順を再計算する。
+    モデルの特徴量はオッズを使わないので AIスコア はそのまま流用できる。
+    odds_map: {馬番: オッズ} または res の行順に並んだオッズ配列
+    """
+    cur = res['オッズ'].to_numpy(dtype=object)
+    if isinstance(odds_map, dict):
+        new = np.array([odds_map.get(int(u), o) for u, o in zip(res['馬番'].to_numpy(), cur)], dtype=object)
+    else:
+        new = np.asarray(odds_map, dtype=object)
+        if len(new) != len(cur): raise ValueError("odds vector length does not match the race")
+
+    odds = parse_odds_values(new)
+    probs = res['AIスコア'].to_numpy(dtype=float)
+    raw = res['raw_preds'].to_numpy(dtype=float)
+    hantei, hantei_ana = evaluate_bet_rules(probs, odds, res['is_pace_advantage'].to_numpy(), rules)
+    is_boost = (hantei == REC_PACE).astype(int)
+
+    # ソート順: Boost対象 -> AIスコア -> 生スコア (predict_race と同じ)
+    order = np.lexsort((-raw, -probs, -is_boost))
+    out = res.take(order)
+    out['オッズ'] = new[order]
+    out['EV'] = (probs * odds)[order]
+    out['判定'] = hantei[order]
+    out['判定_穴'] = hantei_ana[order]
+    out['is_boost'] = is_boost[order]
+    return out
+
+def append_race_hits(results, race, summary):
+    """スキャン結果リスト (pace/hole/ai) にレースのヒット馬を追加する"""
+    item = {'race': race['label'], 'url': race['url'], 'grade': race['grade'], 'time': race.get('time', '99:99')}
+    if not summary['pace_hits'].empty: results['pace'].append({**item, 'hits': summary['pace_hits']})
+    if not summary['hole_hits'].empty: results['hole'].append({**item, 'hits': summary['hole_hits']})
+    if summary['is_ai_target']: results['ai'].append({**item, 'hits': summary['ai_hit_df']})
+
+def reprice_scan_results(race_urls, prediction_cache, max_workers=8):
+    """スキャン済みレースの最新オッズだけを取り直し、スキャン結果を組み直す"""
+    entries = [(u, prediction_cache.get(u)) for u in race_urls]
+    entries = [(u, e) for u, e in entries if e and e.get('race')]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        odds_maps = list(executor.map(lambda ue: fetch_win_odds(ue[1]['race']['id']), entries))
+
+    results = {'pace': [], 'hole': [], 'ai': []}
+    for (url, entry), odds_map in zip(entries, odds_maps):
+        entry = {**entry, 'res': expand_frame(entry['res'])} # 保存済みのスキャン結果 (dict) では圧縮のまま
+        if odds_map:
+            entry['res'] = reprice_race(entry['res'], odds_map) # 元のエントリは書き換えない (共有キャッシュでは別キーになる)
+            prediction_cache[url] = entry
+        append_race_hits(results, entry['race'], summarize_race(entry['res']))
+    for key in results:
+        results[key].sort(key=lambda x: x.get('time', '99:99'))
+    return results
+
+# ---------------------------------------------------------
+# ★追加: 単勝オッズの時系列ストア (data/odds/YYYYMMDD/*.parquet)
+# fetch_win_odds で取れたオッズを (race_id, 馬番, 時刻, オッズ) の列形式で追記する。前回と同じオッズなら書かない。
+# 書き込みはバッファにためてまとめて1ファイル、日ごとに compact で1ファイルへまとめ直す (race_id・馬番・時刻順)。
+# ---------------------------------------------------------
+ODDS_DIR = 'data/odds'
+ODDS_COLUMNS = ('race_id', 'umaban', 'ts', 'odds')
+ODDS_FLUSH_ROWS = 20000 # バッファがこの行数を超えたら書き出す
+ODDS_FLUSH_SECONDS = 60 # 最後の書き出しからこの秒数が経っても書き出す
+BET_PLACE_LEAD_MIN = 2 # 購入想定オッズ: 発走の何分前のオッズで買ったとみなすか
+
+class OddsStore:
+    def __init__(self, root=ODDS_DIR, flush_rows=ODDS_FLUSH_ROWS, flush_seconds=ODDS_FLUSH_SECONDS):
+        self.root = root
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.buffer = [] # append ごとの列配列 (race_id, umaban, ts, odds)
+        self.buffered = 0
+        self.last = {} # race_id -> 直前に記録したオッズ (変化が無ければ書かない)
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+
+    def append(self, race_id, odds_map, ts=None):
+        """{馬番: オッズ} を1スナップショットとして追記する。戻り値は追加した行数"""
+        if not odds_map or not race_id: return 0
+        umaban = np.fromiter((int(u) for u in odds_map), dtype=np.int16, count=len(odds_map))
+        odds = parse_odds_values(list(odds_map.values())).astype(np.float32)
+        odds[odds <= 0] = np.nan # 取消・発売前
+        order = np.argsort(umaban)
+        umaban, odds = umaban[order], odds[order]
+        snapshot = (umaban.tobytes(), odds.tobytes())
+        n = len(umaban)
+        with self.lock:
+            if self.last.get(race_id) == snapshot: return 0
+            self.last[race_id] = snapshot
+            self.buffer.append((np.full(n, int(race_id), np.int64), umaban, np.full(n, int(ts or time.time()), np.int64), odds))
+            self.buffered += n
+            due = self.buffered >= self.flush_rows or time.time() - self.last_flush >= self.flush_seconds
+        if due: self.flush()
+        return n
+
+    def _buffer_frame(self, parts):
+        if not parts: return pd.DataFrame({c: pd.Series(dtype=t) for c, t in zip(ODDS_COLUMNS, ('int64', 'int16', 'int64', 'float32'))})
+        return pd.DataFrame({c: np.concatenate([p[i] for p in parts]) for i, c in enumerate(ODDS_COLUMNS)})
+
+    def flush(self):
+        with self.lock:
+            parts, self.buffer, self.buffered, self.last_flush = self.buffer, [], 0, time.time()
+        if not parts: return
+        frame = self._buffer_frame(parts)
+        days = {t: datetime.datetime.fromtimestamp(t).strftime('%Y%m%d') for t in np.unique(frame['ts'])}
+        try:
+            for day, g in frame.groupby(frame['ts'].map(days)):
+                directory = os.path.join(self.root, day)
+                os.makedirs(directory, exist_ok=True)
+                name = f"part-{time.time_ns()}-{os.getpid()}.parquet"
+                tmp = os.path.join(directory, f".{name}.tmp") # "." 始まりは読み込み時に無視される
+                g.to_parquet(tmp, index=False)
+                os.replace(tmp, os.path.join(directory, name))
+        except Exception:
+            with self.lock: self.buffer[:0] = parts; self.buffered += len(frame) # 次の書き出しで再挑戦
+
+    def compact(self, day):
+        """1日分の part ファイルを odds.parquet にまとめる (race_id・馬番・時刻順なので範囲検索が速い)"""
+        directory = os.path.join(self.root, day.strftime('%Y%m%d'))
+        if not os.path.isdir(directory): return 0
+        files = [f for f in os.listdir(directory) if f.endswith('.parquet') and not f.startswith('.')]
+        if not files or files == ['odds.parquet']: return 0
+        frame = pd.concat([pd.read_parquet(os.path.join(directory, f)) for f in files], ignore_index=True)
+        frame = frame.drop_duplicates().sort_values(['race_id', 'umaban', 'ts'], ignore_index=True)
+        tmp = os.path.join(directory, ".odds.parquet.tmp")
+        frame.to_parquet(tmp, index=False, row_group_size=50000)
+        os.replace(tmp, os.path.join(directory, 'odds.parquet'))
+        for f in files:
+            if f != 'odds.parquet': os.remove(os.path.join(directory, f))
+        return len(frame)
+
+    def query(self, race_ids=None, start=None, end=None):
+        """範囲検索。race_ids: race_id のリスト, start/end: UNIX 秒 (どちらも省略可)。未書き出しのバッファも含める"""
+        days = sorted(d for d in os.listdir(self.root) if d.isdigit()) if os.path.isdir(self.root) else []
+        if start is not None: days = [d for d in days if d >= datetime.datetime.fromtimestamp(start).strftime('%Y%m%d')]
+        if end is not None: days = [d for d in days if d <= datetime.datetime.fromtimestamp(end).strftime('%Y%m%d')]
+        filters = []
+        if race_ids is not None: filters.append(('race_id', 'in', [int(r) for r in race_ids]))
+        if start is not None: filters.append(('ts', '>=', int(start)))
+        if end is not None: filters.append(('ts', '<=', int(end)))
+        frames = []
+        for d in days:
+            try: frames.append(pd.read_parquet(os.path.join(self.root, d), filters=filters or None))
+            except Exception: continue # 空ディレクトリ・書き込み中
+        with self.lock: pending = self._buffer_frame(list(self.buffer))
+        mask = np.ones(len(pending), dtype=bool)
+        if race_ids is not None: mask &= pending['race_id'].isin([int(r) for r in race_ids]).to_numpy()
+        if start is not None: mask &= pending['ts'].to_numpy() >= start
+        if end is not None: mask &= pending['ts'].to_numpy() <= end
+        frames.append(pending[mask])
+        frame = pd.concat([f for f in frames if not f.empty], ignore_index=True) if any(not f.empty for f in frames) else pending.iloc[:0]
+        frame = frame.drop_duplicates().sort_values(['race_id', 'umaban', 'ts'], ignore_index=True)
+        return frame.assign(odds=frame['odds'].astype(float).round(2)) # float32 の端数を表示に出さない
+
+    def odds_at(self, race_id, at, start=None):
+        """時刻 at (UNIX 秒) の時点で最新だった単勝オッズ {馬番: オッズ}。start を渡すとそれより前の日は読まない"""
+        hist = self.query([race_id], start=start, end=at)
+        if hist.empty: return {}
+        last = hist.groupby('umaban')['odds'].last()
+        return {int(u): float(o) for u, o in last.items()}
+
+@st.cache_resource
+def get_odds_store():
+    store = OddsStore()
+    atexit.register(store.flush)
+    return store
+
+def record_odds(race_id, odds_map):
+    try: get_odds_store().append(race_id, odds_map)
+    except Exception: pass # 記録の失敗で予測を止めない
+
+def race_post_timestamp(target_date, hhmm):
+    try: return datetime.datetime.combine(target_date, datetime.datetime.strptime(hhmm, '%H:%M').time()).timestamp()
+    except (TypeError, ValueError): return None # "99:99" (発走時刻不明)
+
+def race_odds_window(race_date):
+    """そのレースのオッズが記録されうる範囲 (前日発売を含めて前日0時〜当日24時) の UNIX 秒"""
+    start = datetime.datetime.combine(race_date - datetime.timedelta(days=1), datetime.time())
+    return start.timestamp(), (start + datetime.timedelta(days=2)).timestamp() - 1
+
+def odds_drift_table(res, race_id, post_ts=None, store=None, race_date=None):
+    """1頭ごとのオッズ・EV の推移 (初回 → 最新) と、発走 BET_PLACE_LEAD_MIN 分前に買った場合のオッズ"""
+    store = store or get_odds_store()
+    # ★変更: 開催日の前後のパーティションだけを読む (記録した日数が増えても読む量は変わらない)
+    if race_date is None and post_ts is not None: race_date = datetime.date.fromtimestamp(post_ts)
+    start, end = race_odds_window(race_date) if race_date else (None, None)
+    hist = store.query([race_id], start=start, end=end)
+    if hist.empty: return pd.DataFrame(), hist
+    g = hist.groupby('umaban')['odds']
+    table = pd.DataFrame({'初回オッズ': g.first(), '最新オッズ': g.last(), '最低': g.min(), '最高': g.max(), '記録数': g.size()})
+    horses = res.assign(umaban=pd.to_numeric(res['馬番'], errors='coerce')).dropna(subset=['umaban']).drop_duplicates('umaban')
+    horses = horses.set_index(horses['umaban'].astype(int))
+    table = table.join(horses[['馬名', 'AIスコア']], how='inner')
+    table['EV(初回)'] = table['AIスコア'] * table['初回オッズ']
+    table['EV(最新)'] = table['AIスコア'] * table['最新オッズ']
+    table['EVドリフト'] = table['EV(最新)'] - table['EV(初回)']
+    if post_ts is not None:
+        placed = store.odds_at(race_id, post_ts - BET_PLACE_LEAD_MIN * 60, start=start)
+        table['購入想定オッズ'] = table.index.map(lambda u: placed.get(int(u), np.nan))
+        table['EV(購入時)'] = table['AIスコア'] * table['購入想定オッズ']
+    return table.rename_axis('馬番').reset_index(), hist
+
+def render_odds_drift(res, race_url, post_ts=None, race_date=None):
+    """詳細画面: オッズ推移のグラフと EV ドリフト表"""
+    with st.expander("📈 オッズ推移・EVドリフト", expanded=False):
+        table, hist = odds_drift_table(res, race_id_from_url(race_url), post_ts, race_date=race_date)
+        if table.empty:
+            st.info("オッズの記録がまだありません (スキャン・再判定のたびに記録されます)"); return
+        chart = hist.assign(時刻=hist['ts'].map(datetime.datetime.fromtimestamp))
+        chart = chart.pivot_table(index='時刻', columns='umaban', values='odds', aggfunc='last').ffill()
+        chart.columns = [f"#{u}" for u in chart.columns]
+        st.line_chart(chart)
+        cols = ['馬番', '馬名', '初回オッズ', '最新オッズ', '最低', '最高', 'EV(初回)', 'EV(最新)', 'EVドリフト', '購入想定オッズ', 'EV(購入時)', '記録数']
+        st.dataframe(table[[c for c in cols if c in table.columns]].sort_values('EV(最新)', ascending=False),
+                     column_config={c: st.column_config.NumberColumn(c, format="%.2f") for c in ['EV(初回)', 'EV(最新)', 'EVドリフト', 'EV(購入時)']},
+                     hide_index=True, use_container_width=True)
+        if post_ts is not None: st.caption(f"※ 購入想定オッズ = 発走{BET_PLACE_LEAD_MIN}分前の時点で最新だったオッズ")
+
+# ---------------------------------------------------------
+# ★追加: 連系馬券 (馬連・ワイド・馬単・三連複) の確率と EV
+# 単勝確率 (AIスコア) から Harville モデルで着順の確率を作る: P(i→j→k) = p_i · p_j/(1-p_i) · p_k/(1-p_i-p_j)
+# 全組み合わせを配列演算でまとめて計算する (レース数 R × 最大頭数 N。頭数が足りない分は確率0で埋める)。
+# ---------------------------------------------------------
+EXOTIC_TYPES = {'umaren': ('馬連', 4), 'wide': ('ワイド', 5), 'umatan': ('馬単', 6), 'sanrenpuku': ('三連複', 7)}
+
+def stack_win_probs(prob_list, n=18):
+    """レースごとの勝率配列を (R, N) にそろえる (足りない馬は 0)"""
+    out = np.zeros((len(prob_list), max([n] + [len(p) for p in prob_list])))
+    for i, p in enumerate(prob_list): out[i, :len(p)] = p
+    return out
+
+def exotic_probabilities(p):
+    """
+    p: (R, N) 単勝確率 (各行を合計1に正規化して使う)
+    戻り値: {'umatan': (R,N,N), 'umaren': (R,N,N), 'wide': (R,N,N), 'sanrenpuku': (R,N,N,N)}
+    umaren / wide / sanrenpuku は対称 (組番の並びを問わない)。同じ馬を含む組は 0。
+    """
+    p = np.asarray(p, dtype=float)
+    p = p / np.clip(p.sum(axis=1, keepdims=True), 1e-12, None)
+    n = p.shape[1]
+    eye = np.eye(n, dtype=bool)
+    exacta = p[:, :, None] * p[:, None, :] / np.clip(1 - p, 1e-12, None)[:, :, None]
+    exacta[:, eye] = 0.0
+    rest = np.clip(1 - p[:, :, None] - p[:, None, :], 1e-12, None)
+    trifecta = exacta[:, :, :, None] * p[:, None, None, :] / rest[:, :, :, None]
+    trifecta *= ~(eye[:, :, None] | eye[:, None, :] | eye[None, :, :])
+    trio = sum(trifecta.transpose(0, *perm) for perm in ((1, 2, 3), (1, 3, 2), (2, 1, 3), (2, 3, 1), (3, 1, 2), (3, 2, 1)))
+    return {'umatan': exacta, 'umaren': exacta + exacta.transpose(0, 2, 1), 'wide': trio.sum(axis=3), 'sanrenpuku': trio}
+
+_combo_cache = {}
+
+def combo_index(n, k, ordered=False):
+    """n頭から k頭の組番 (添字配列のタプル)。ordered=False なら i<j(<k) だけ"""
+    key = (n, k, ordered)
+    if key not in _combo_cache:
+        r = np.arange(n)
+        if k == 2: mask = (r[:, None] != r[None, :]) if ordered else (r[:, None] < r[None, :])
+        else: mask = (r[:, None, None] < r[None, :, None]) & (r[None, :, None] < r[None, None, :])
+        _combo_cache[key] = np.nonzero(mask)
+    return _combo_cache[key]
+
+def fetch_exotic_odds(race_id, bet_type):
+    """{(馬番, 馬番[, 馬番]): オッズ}。組番は "0307" のような2桁区切り。ワイドは下限オッズ"""
+    odds = {}
+    for key, values in fetch_odds_api(race_id, EXOTIC_TYPES[bet_type][1]).items():
+        try:
+            combo = tuple(int(key[i:i + 2]) for i in range(0, len(key), 2))
+            val = parse_odds_value(values[0])
+            if val > 0: odds[combo] = val
+        except Exception: continue
+    return odds
+
+def exotic_table(res, odds_by_type=None, top_n=10):
+    """1レースの連系馬券を券種ごとに EV 順 (オッズが無ければ確率順) に top_n 件ずつ並べる"""
+    horses = res.assign(u=pd.to_numeric(res['馬番'], errors='coerce')).dropna(subset=['u']).drop_duplicates('u')
+    umaban = horses['u'].astype(int).to_numpy()
+    probs = exotic_probabilities(horses['AIスコア'].to_numpy(dtype=float)[None, :])
+    rows = []
+    for bet_type, (label, _) in EXOTIC_TYPES.items():
+        k = 3 if bet_type == 'sanrenpuku' else 2
+        idx = combo_index(len(umaban), k, ordered=bet_type == 'umatan')
+        prob = probs[bet_type][(0,) + idx]
+        combos = np.stack([umaban[i] for i in idx], axis=1)
+        if bet_type != 'umatan': combos = np.sort(combos, axis=1)
+        odds_map = (odds_by_type or {}).get(bet_type) or {}
+        odds = np.array([odds_map.get(tuple(c), np.nan) for c in combos.tolist()]) if odds_map else np.full(len(prob), np.nan)
+        ev = prob * odds
+        order = np.lexsort((-prob, -np.nan_to_num(ev, nan=-1.0)))[:top_n]
+        sep = '→' if bet_type == 'umatan' else '-'
+        rows.append(pd.DataFrame({'券種': label, '組み合わせ': [sep.join(map(str, c)) for c in combos[order]],
+                                  '確率': prob[order], 'オッズ': odds[order], 'EV': ev[order]}))
+    return pd.concat(rows, ignore_index=True)
+
+def render_exotic_bets(res, race_url):
+    """詳細画面: 連系馬券の確率と EV (オッズはボタンで取得)"""
+    with st.expander("🎯 連系馬券 (馬連・ワイド・馬単・三連複)", expanded=False):
+        race_id = race_id_from_url(race_url)
+        if 'exotic_odds' not in st.session_state: st.session_state.exotic_odds = {}
+        if st.button("💹 連系オッズを取得して EV を計算", key="fetch_exotic_odds"):
+            with st.spinner("オッズを取得中..."):
+                with concurrent.futures.ThreadPoolExecutor(max_workers=len(EXOTIC_TYPES)) as executor:
+                    st.session_state.exotic_odds[race_id] = dict(zip(EXOTIC_TYPES, executor.map(lambda t: fetch_exotic_odds(race_id, t), EXOTIC_TYPES)))
+        table = exotic_table(res, st.session_state.exotic_odds.get(race_id))
+        for tab, (bet_type, (label, _)) in zip(st.tabs([v[0] for v in EXOTIC_TYPES.values()]), EXOTIC_TYPES.items()):
+            with tab:
+                sub = table[table['券種'] == label].drop(columns=['券種'])
+                st.dataframe(sub.assign(確率=sub['確率'] * 100),
+                             column_config={"確率": st.column_config.NumberColumn("確率", format="%.2f%%"),
+                                            "EV": st.column_config.NumberColumn("EV", format="%.2f")},
+                             hide_index=True, use_container_width=True)
+        st.caption("※ AIスコアを単勝確率とみなした Harville モデルの推定です (人気薄の2・3着を過小評価しやすい点に注意)")
+
+# ---------------------------------------------------------
+# ★追加: モンテカルロ着順シミュレーション (Plackett-Luce)
+# 各馬の強さ = AIスコア (レース内で正規化)。log(強さ) + Gumbel ノイズの降順が Plackett-Luce の着順になる (Gumbel-max)。
+# シード固定・バッチ単位でまとめて乱数を引き、着順分布・複勝率・戦略の回収率の区間を出す。
+# ---------------------------------------------------------
+MC_SIMULATIONS = 100_000 # 1レースあたりの試行回数 (詳細画面)
+MC_SCAN_SIMULATIONS = 20_000 # スキャン全体の回収率区間で使う試行回数
+MC_BATCH = 25_000
+MC_SEED = 42
+
+def place_slots(n_runners):
+    """複勝の払戻対象: 8頭以上は3着まで、5〜7頭は2着まで、4頭以下は発売なし"""
+    return 3 if n_runners >= 8 else (2 if n_runners >= 5 else 0)
+
+def gumbel_keys(log_p, size, rng):
+    return log_p[None, :] + rng.gumbel(size=(size, len(log_p)))
+
+def simulate_race(probs, n_sims=MC_SIMULATIONS, seed=MC_SEED, batch=MC_BATCH):
+    """1レースの着順分布。戻り値: {'position': (N,N) 馬i が r着の確率, 'win', 'place', 'mean_rank', 'n_sims'}"""
+    p = np.clip(np.asarray(probs, dtype=float), 1e-12, None)
+    log_p = np.log(p / p.sum())
+    n = len(p)
+    rng = np.random.default_rng(seed)
+    counts = np.zeros((n, n), dtype=np.int64)
+    done = 0
+    while done < n_sims:
+        size = min(batch, n_sims - done)
+        order = np.argsort(-gumbel_keys(log_p, size, rng), axis=1) # order[s, r] = r+1着の馬
+        counts += np.stack([np.bincount(order[:, r], minlength=n) for r in range(n)], axis=1)
+        done += size
+    position = counts / n_sims
+    slots = place_slots(n)
+    return {'position': position, 'win': position[:, 0], 'place': position[:, :slots].sum(axis=1),
+            'mean_rank': position @ np.arange(1, n + 1), 'n_sims': n_sims}
+
+def strategy_picks(results):
+    """スキャン結果から戦略ごとの購入対象 [(strategy, url, 馬番, 単勝オッズ)]"""
+    picks = []
+    for strategy, items in results.items():
+        for item in items:
+            hits = item['hits']
+            if 'is_bet_target' not in hits.columns: continue
+            for _, row in hits[hits['is_bet_target'].astype(bool)].iterrows():
+                picks.append((strategy, item['url'], int(row['馬番']), parse_odds_value(row['オッズ'])))
+    return picks
+
+def simulate_scan_roi(results, prediction_cache, n_sims=MC_SCAN_SIMULATIONS, seed=MC_SEED, batch=MC_BATCH, ci=0.9):
+    """
+    戦略ごとの単勝回収率・的中数 (3着内) の分布 (各レースを独立に n_sims 回走らせ、同じ試行番号どうしを合算)。
+    的中はスキャン・バックテストの hit_count と同じく頭数によらず3着内で数える。
+    戻り値: {strategy: {'roi_mean', 'roi_lo', 'roi_hi', 'p_profit', 'hits_mean', 'hits_lo', 'hits_hi', 'bets'}}
+    """
+    by_race = {}
+    for strategy, url, umaban, odds in strategy_picks(results):
+        by_race.setdefault(url, []).append((strategy, umaban, odds))
+    strategies = list(results.keys())
+    win_ret = {k: np.zeros(n_sims) for k in strategies}
+    hits = {k: np.zeros(n_sims) for k in strategies}
+    bets = dict.fromkeys(strategies, 0)
+    rng = np.random.default_rng(seed)
+    for url, picks in by_race.items():
+        entry = prediction_cache.get(url)
+        if not entry: continue
+        res = expand_frame(entry['res']) # スキャン中の集計では圧縮のまま渡ってくる
+        umaban = pd.to_numeric(res['馬番'], errors='coerce').fillna(-1).astype(int).to_numpy()
+        p = np.clip(res['AIスコア'].to_numpy(dtype=float), 1e-12, None)
+        log_p = np.log(p / p.sum())
+        slots = min(3, len(p)) # evaluate_backtest / scan_races と同じ「3着内」 (複勝の発売有無は見ない)
+        done = 0
+        while done < n_sims:
+            size = min(batch, n_sims - done)
+            keys = gumbel_keys(log_p, size, rng)
+            winner = umaban[keys.argmax(axis=1)]
+            top = umaban[np.argpartition(-keys, slots - 1, axis=1)[:, :slots]] if slots < len(p) else np.tile(umaban, (size, 1))
+            for strategy, u, odds in picks:
+                win_ret[strategy][done:done + size] += (winner == u) * odds * 100
+                hits[strategy][done:done + size] += (top == u).any(axis=1)
+            done += size
+        for strategy, _, _ in picks: bets[strategy] += 1
+    q = [(1 - ci) / 2 * 100, (1 + ci) / 2 * 100]
+    out = {}
+    for k in strategies:
+        if bets[k] == 0: continue
+        roi = win_ret[k] / (bets[k] * 100) * 100
+        lo, hi = np.percentile(roi, q)
+        h_lo, h_hi = np.percentile(hits[k], q)
+        out[k] = {'roi_mean': float(roi.mean()), 'roi_lo': float(lo), 'roi_hi': float(hi), 'p_profit': float((roi >= 100).mean()),
+                  'hits_mean': float(hits[k].mean()), 'hits_lo': float(h_lo), 'hits_hi': float(h_hi), 'bets': bets[k]}
+    return out
+
+def render_race_simulation(res, n_sims=MC_SIMULATIONS):
+    """詳細画面: 着順シミュレーション (勝率・複勝率・平均着順・着順分布)"""
+    with st.expander("🎲 着順シミュレーション (モンテカルロ)", expanded=False):
+        horses = res.drop_duplicates(subset=['馬番'])
+        t0 = time.time()
+        sim = simulate_race(horses['AIスコア'].to_numpy(dtype=float), n_sims=n_sims)
+        odds = parse_odds_values(horses['オッズ'].to_numpy())
+        se = np.sqrt(sim['place'] * (1 - sim['place']) / n_sims)
+        table = pd.DataFrame({'馬番': horses['馬番'].to_numpy(), '馬名': horses['馬名'].to_numpy(),
+                              '勝率': sim['win'] * 100, '複勝率': sim['place'] * 100, '複勝率±': 1.96 * se * 100,
+                              '平均着順': sim['mean_rank'], '単勝EV': sim['win'] * odds,
+                              '単勝回収の標準偏差': np.sqrt(sim['win'] * (1 - sim['win'])) * odds})
+        for r in range(min(5, len(horses))): table[f"{r + 1}着"] = sim['position'][:, r] * 100
+        pct = {c: st.column_config.NumberColumn(c, format="%.1f%%") for c in ['勝率', '複勝率', '複勝率±'] + [f"{r + 1}着" for r in range(5)]}
+        st.dataframe(table.sort_values('勝率', ascending=False), column_config={**pct, '平均着順': st.column_config.NumberColumn(format="%.2f"),
+                     '単勝EV': st.column_config.NumberColumn(format="%.2f"), '単勝回収の標準偏差': st.column_config.NumberColumn(format="%.2f")},
+                     hide_index=True, use_container_width=True)
+        st.caption(f"※ AIスコアを強さとする Plackett-Luce モデルで {n_sims:,} 回試行 (シード {MC_SEED}, {time.time() - t0:.2f}秒)。"
+                   f"複勝は{place_slots(len(horses)) or '-'}着まで")
 
 # ---------------------------------------------------------
-# 新規追加: レースの塊(チャンク)を1つのブラウザで連続処理する関数
+# ★追加: 処理時間のトレース (ステージ・通信・Selenium・SQL・推論の区間)
+# スキャンのワーカーは処理中のレースの記録先 (item['_spans']) をスレッドに持ち、trace_span はそこへ積む。
+# 無効のときは trace_span がフラグを見て何もしない入れ物を返すだけ。SQL は engine のイベントで1本ずつ拾う (件数・時間はメトリクスにも)。
+# プロセスプールに回したステージは、ステージ全体の時間だけが残る (中の SQL はワーカープロセス側)。
 # ---------------------------------------------------------
+try: TRACE_ENABLED = bool(st.secrets.get("TRACE_ENABLED", False)) # 起動時の既定値。サイドバー / scan_daemon.py --trace でも切り替えられる
+except: TRACE_ENABLED = False
+TRACE_DIR = 'data/traces' # スキャンごとの JSON lines
+
+class TraceState:
+    """トレースの有効/無効と、スレッドごとの記録先 (スクリプトの再実行をまたいで共有する)"""
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.local = threading.local()
+
+@st.cache_resource
+def get_trace_state():
+    return TraceState(TRACE_ENABLED)
+
+class _NoSpan:
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+    def set(self, **attrs): pass
+
+_NO_SPAN = _NoSpan()
+
+class TraceSpan:
+    __slots__ = ('name', 'spans', 'attrs', 't0')
+
+    def __init__(self, name, spans, attrs):
+        self.name, self.spans, self.attrs = name, spans, attrs
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __exit__(self, exc_type, exc, tb):
+        span = {'name': self.name, 't': time.time(), 'sec': time.perf_counter() - self.t0, **self.attrs}
+        if exc_type: span['error'] = exc_type.__name__
+        self.spans.append(span)
+        return False
+
+def set_tracing(enabled):
+    get_trace_state().enabled = bool(enabled)
+
+def tracing_enabled():
+    return get_trace_state().enabled
+
+def trace_span(name, **attrs):
+    """with trace_span('http', host=...): の区間を、このスレッドで処理中のレースに記録する"""
+    state = get_trace_state()
+    if not state.enabled: return _NO_SPAN
+    spans = getattr(state.local, 'spans', None)
+    return _NO_SPAN if spans is None else TraceSpan(name, spans, attrs)
+
+class trace_scope:
+    """この with の間、このスレッドの区間を spans (list) に記録する (None なら記録しない)"""
+    def __init__(self, spans):
+        self.spans = spans
+
+    def __enter__(self):
+        self.local = get_trace_state().local
+        self.prev = getattr(self.local, 'spans', None)
+        self.local.spans = self.spans
+        return self.spans
+
+    def __exit__(self, *exc):
+        self.local.spans = self.prev
+        return False
+
+def _sql_caller():
+    """SQL を発行した app 内の関数名 (calc_horse_history など)"""
+    f = sys._getframe(2)
+    while f is not None and f.f_globals.get('__name__') != __name__: f = f.f_back
+    return f.f_code.co_name if f is not None else '?'
+
+def instrument_engine(engine):
+    """engine の SQL を1本ずつ計測する (件数・時間はメトリクスへ、トレース有効時は区間にも)"""
+    if engine is None or getattr(engine, '_trace_instrumented', False): return engine
+    from sqlalchemy import event
+
+    def before(conn, cursor, statement, parameters, context, executemany):
+        context._query_t0 = time.perf_counter()
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        t0 = getattr(context, '_query_t0', None)
+        if t0 is None: return
+        elapsed, caller = time.perf_counter() - t0, _sql_caller()
+        metrics = get_metrics()
+        metrics.inc('keiba_db_queries_total', caller=caller)
+        metrics.observe('keiba_db_query_seconds', elapsed, caller=caller)
+        state = get_trace_state()
+        spans = getattr(state.local, 'spans', None) if state.enabled else None
+        if spans is not None:
+            spans.append({'name': f"sql.{caller}", 't': time.time(), 'sec': elapsed, 'rows': cursor.rowcount, 'sql': " ".join(statement.split())[:120]})
+
+    def pool_gauges(metrics):
+        pool = engine.pool
+        for name, fn in (('keiba_db_pool_checked_out', 'checkedout'), ('keiba_db_pool_size', 'size'), ('keiba_db_pool_overflow', 'overflow')):
+            if hasattr(pool, fn): metrics.set(name, getattr(pool, fn)())
+
+    event.listen(engine, 'before_cursor_execute', before)
+    event.listen(engine, 'after_cursor_execute', after)
+    get_metrics().collector('db_pool', pool_gauges)
+    engine._trace_instrumented = True
+    return engine
+
+def summarize_spans(spans):
+    """区間を名前ごとに集計する (回数・合計・平均・p90・最大・全体に占める割合)"""
+    if not spans: return pd.DataFrame()
+    df = pd.DataFrame(spans, columns=['name', 'sec'])
+    g = df.groupby('name')['sec']
+    out = pd.DataFrame({'回数': g.size(), '合計(s)': g.sum(), '平均(ms)': g.mean() * 1000,
+                        'p90(ms)': g.quantile(0.9) * 1000, '最大(ms)': g.max() * 1000})
+    stage_total = df.loc[df['name'].str.startswith('stage.'), 'sec'].sum()
+    out['割合'] = out['合計(s)'] / stage_total * 100 if stage_total else 0.0
+    return out.sort_values('合計(s)', ascending=False).reset_index().rename(columns={'name': '区間'})
+
+def race_trace_row(race, spans):
+    """1レース分: ステージごとの秒数と、通信・SQL の合計"""
+    row = {'レース': race['label']}
+    for s in spans:
+        key = s['name'][6:] if s['name'].startswith('stage.') else s['name'].split('.')[0]
+        row[key] = row.get(key, 0.0) + s['sec']
+    return row
+
+def trace_jsonl(trace):
+    """スキャンのトレースを JSON lines にする (1行 = 1区間)"""
+    t0 = trace.get('started', 0)
+    return "\n".join(json.dumps({'date': trace.get('date'), 'race_id': s.get('race_id'), **{k: v for k, v in s.items() if k not in ('t', 'race_id', 'sec')},
+                                 'offset': round(s['t'] - t0, 4), 'ms': round(s['sec'] * 1000, 3)}, ensure_ascii=False, default=str)
+                     for s in trace.get('spans', [])) + "\n"
+
+def save_trace(trace):
+    try:
+        os.makedirs(TRACE_DIR, exist_ok=True)
+        path = os.path.join(TRACE_DIR, f"{trace['date']}_{datetime.datetime.fromtimestamp(trace['started']).strftime('%H%M%S')}.jsonl")
+        with open(path, 'w', encoding='utf-8') as f: f.write(trace_jsonl(trace))
+        return path
+    except Exception: return None
+
+def render_trace_sidebar():
+    """サイドバー: 直近のスキャンの処理時間の内訳と診断ログ"""
+    trace = st.session_state.get('scan_trace')
+    debug_log = st.session_state.get('scan_debug_log') or []
+    if not trace and not debug_log: return
+    with st.expander("⏱ 処理時間の内訳 (直近のスキャン)", expanded=False):
+        if trace:
+            st.caption(f"{trace['races']}レース / {trace['wall']:.1f}秒 · 区間 {len(trace['spans']):,}件")
+            st.dataframe(summarize_spans(trace['spans']), hide_index=True, use_container_width=True,
+                         column_config={c: st.column_config.NumberColumn(format="%.1f") for c in ['合計(s)', '平均(ms)', 'p90(ms)', '最大(ms)']}
+                         | {'割合': st.column_config.NumberColumn(format="%.0f%%")})
+            if trace.get('by_race'):
+                st.dataframe(pd.DataFrame(trace['by_race']).round(2), hide_index=True, use_container_width=True)
+            st.download_button("📥 JSON lines", trace_jsonl(trace), file_name=f"trace_{trace['date']}.jsonl", mime='application/jsonl')
+        else:
+            st.caption("トレース無効時のスキャンです (ステージ別の秒数のみ)")
+        if debug_log: st.dataframe(pd.DataFrame(debug_log), hide_index=True, use_container_width=True)
+
 # ---------------------------------------------------------
-# 新規追加: レースの塊(チャンク)を1つのブラウザで連続処理する関数
+# ★変更: 1レースの処理をステージに分割 (fetch → parse → feature → predict → result)
+# 各ステージは item(dict) を受け取り、更新した item を返す。
+# 'status' が入った item はそこで終了する (empty / error / success)。
 # ---------------------------------------------------------
+def stage_fetch(item, driver=None):
+    item['content'], item['odds_map'] = fetch_race_page(item['race']['url'], driver=driver)
+    if not item['content']: item['status'] = 'empty'
+    return item
+
+def stage_parse(item, pool=None):
+    args = (item['content'], item['race']['url'], item['odds_map'])
+    if pool is None: df = parse_race_page(*args)
+    else: df = scan_workers.arrays_to_frame(pool.submit(scan_workers.parse_task, *args).result())
+    del item['content'], item['odds_map'] # 失敗時の再試行に備えて、成功してから消す
+    if df is None or df.empty: item['status'] = 'empty'
+    else: item['df_raw'] = df
+    return item
+
+def stage_feature(item, encoders, engine, pool=None):
+    df = item['df_raw']
+    item['race_id'] = df.iloc[0]['race_id']
+    if pool is None:
+        item['features'] = build_race_features(df.copy(), encoders, engine)
+    else:
+        packed, diag_data, missing_info = pool.submit(scan_workers.feature_task, scan_workers.frame_to_arrays(df)).result()
+        item['features'] = (scan_workers.arrays_to_frame(packed), diag_data, missing_info)
+    del item['df_raw']
+    return item
+
+def stage_predict(item, model, pool=None):
+    df, diag_data, missing_info = item['features']
+    if pool is None:
+        res, debug, X_renamed, diag_data, missing_info, trace_df, contrib = score_race(df.copy(), model, diag_data, missing_info)
+    else:
+        packed = pool.submit(scan_workers.predict_task, scan_workers.frame_to_arrays(df), diag_data, missing_info).result()
+        res, debug, X_renamed, diag_data, missing_info, trace_df, contrib = scan_workers.unpack_prediction(packed)
+    del item['features']
+    item.update({
+        'df': res,
+        **summarize_race(res), # pace_hits / hole_hits / ai_hit_df (マーク付きDF), is_ai_target, top_ai
+        'missing_info': missing_info,
+        'debug': debug,
+        'X_renamed': X_renamed,
+        'diag_data': diag_data,
+        'trace_df': trace_df,
+        'contrib': contrib
+    })
+    return item
+
+def stage_result(item):
+    # 成績集計用データ
+    ranks, win_p, place_p, _ = scrape_race_result(item['race_id'])
+    item.update({'status': 'success', 'ranks': ranks, 'win_p': win_p, 'place_p': place_p})
+    return item
+
+def process_one_race(race, model, encoders, engine, driver=None):
+    """並列処理用の単一レース処理関数 (ステージを順番に実行する)"""
+    item = {'race': race}
+    try:
+        for fn in (lambda it: stage_fetch(it, driver), stage_parse, lambda it: stage_feature(it, encoders, engine),
+                   lambda it: stage_predict(it, model), stage_result):
+            item = fn(item)
+            if item.get('status'): return item
+        return item
+    except Exception as e:
+        return {'status': 'error', 'race': race, 'error': str(e)}
+
 # ---------------------------------------------------------
-# 新規追加: レースの塊(チャンク)を1つのブラウザで連続処理する関数
+# ★変更: ワークスティーリング型スケジューラ (ステージごとに1つ)
+# 共有キューから空いたワーカーが1件ずつ取り出す。
+# 失敗した件は別のワーカーで再試行し、adaptive なステージは処理時間と空きメモリでワーカー数を増減する。
 # ---------------------------------------------------------
-def process_race_chunk(chunk, model, encoders, engine, ctx, result_queue): # ★変更: result_queue を追加
-    # 別スレッドでもStreamlitの機能が使えるように設定
-    if ctx: add_script_run_ctx(threading.current_thread(), ctx)
+SCAN_MIN_WORKERS = 4
+SCAN_MAX_WORKERS = 8
+SCAN_MAX_RETRIES = 1
+SCAN_WORKER_MEMORY_MB = 400 # Chrome 1つあたりのメモリ目安
+SCAN_TARGET_SECONDS = 20.0 # 残りをこの時間で捌けない見込みならワーカーを足す
+SCAN_QUEUE_SIZE = 4 # ステージ間キューの上限 (上流が先走りすぎないように)
+
+# ステージごとの並列数: 通信待ちのステージは多め、CPU/GIL を使うステージは少なめ
+SCAN_STAGE_WORKERS = {'fetch': SCAN_MIN_WORKERS, 'parse': 2, 'feature': 4, 'predict': 1, 'result': 4}
+
+# ★追加: タイムアウト (秒)。超えたレースは結果なしとして先に進み、固まったワーカーは新しいワーカーと入れ替える
+SCAN_STAGE_TIMEOUTS = {'fetch': 45, 'parse': 20, 'feature': 60, 'predict': 20, 'result': 30}
+SCAN_RACE_DEADLINE = 150 # 1レースが fetch を始めてから result を終えるまでの上限
+SCAN_STALL_TIMEOUT = 180 # どのレースも終わらない状態がこれだけ続いたら打ち切る
+MISSING_STATUS_LABELS = {'timeout': '⏱ タイムアウト', 'cancelled': '⏹ 中止', 'error': '❌ エラー', 'empty': '📭 データなし'}
+
+# ★追加: プロセスプール (GIL を避けて CPU を使うステージを複数コアで回す)
+SCAN_PROCESS_STAGES = ('parse', 'feature') # 'predict' を足すとモデル推論もワーカープロセスで行う
+SCAN_PROCESS_WORKERS = max(2, (os.cpu_count() or 2) - 1)
 
-    # resultsリストは廃止し、随時 queue に入れる
-    # スレッドごとに専用のブラウザを起動
+@st.cache_resource
+def get_process_pool(max_workers=SCAN_PROCESS_WORKERS):
+    """spawn 起動のプロセスプール。各プロセスは scan_workers.init_worker でモデル等を1回だけ読み込む"""
+    import multiprocessing
+    return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'),
+                                                  initializer=scan_workers.init_worker)
+
+def create_chrome_driver():
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.chrome.service import Service
     options = Options()
     options.add_argument('--headless')
     options.add_argument('--no-sandbox')
@@ -1809,186 +3030,1391 @@ def process_race_chunk(chunk, model, encoders, engine, ctx, result_queue): # ★
     options.add_argument('--disable-gpu')
     options.add_argument('--window-size=1920,1080')
     options.add_argument('--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36')
-    
-    driver = None
+    get_metrics().inc('keiba_chrome_started_total')
+    driver = webdriver.Chrome(options=options, service=Service())
+    driver.set_page_load_timeout(SCAN_STAGE_TIMEOUTS['fetch']) # ページが固まっても driver.get が戻ってくるように
+    return driver
+
+def available_memory_mb():
+    """空きメモリ(MB)。取得できない環境では None"""
     try:
-        from selenium.webdriver.chrome.service import Service
-        service = Service()
-        driver = webdriver.Chrome(options=options, service=service)
-        
-        # 起動したブラウザを使い回して、担当分のレースを全て処理
-        for race in chunk:
-            res = process_one_race(race, model, encoders, engine, driver=driver)
-            result_queue.put(res) # ★変更: 処理が終わったら即座にキューへ入れる
-            
+        import psutil
+        return psutil.virtual_memory().available / 1024 / 1024
+    except ImportError: pass
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'): return int(line.split()[1]) / 1024
+    except Exception: pass
+    return None
+
+class RaceScheduler:
+    def __init__(self, work_fn, emit, name='scan', ctx=None, min_workers=SCAN_MIN_WORKERS, max_workers=None,
+                 max_retries=SCAN_MAX_RETRIES, maxsize=0, setup=None, teardown=None, on_done=None, timeout=None, race_deadline=None):
+        self.work_fn = work_fn # (item, state) -> item
+        self.emit = emit # 処理済み item の渡し先
+        self.name = name
+        self.ctx = ctx
+        self.min_workers = max(1, min_workers)
+        self.max_workers = max(self.min_workers, max_workers or self.min_workers) # min == max なら固定
+        self.max_retries = max_retries
+        self.setup, self.teardown, self.on_done = setup, teardown, on_done
+        self.timeout = timeout # 1件あたりの上限 (秒)
+        self.race_deadline = race_deadline # 最初のステージで item に締め切りを付ける
+        self.tasks = queue.Queue(maxsize=maxsize)
+        self.retries = queue.Queue() # 再試行は上限なし (自分のキューが満杯でも詰まらない)
+        self.pending = 0
+        self.closed = False
+        self.finished = False
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.workers = {}
+        self.threads = []
+        self.inflight = {} # wid -> (item, 開始時刻)
+        self.abandoned = set() # タイムアウトで見捨てたワーカー (戻ってきても結果は捨てる)
+        self.next_id = 0
+        self.retire = 0
+        self.latencies = []
+        self.timeouts = 0
+
+    @property
+    def num_workers(self):
+        with self.lock: return len(self.workers)
+
+    def start(self):
+        for _ in range(self.min_workers): self._spawn()
+        return self
+
+    def submit(self, item):
+        """item を投入する。キューが満杯なら空くまで待つ (バックプレッシャー)。停止後は投入せず False を返す"""
+        with self.lock: self.pending += 1
+        item.setdefault('_attempt', 0)
+        item.setdefault('_avoid', set())
+        while not self.stop_event.is_set():
+            try:
+                self.tasks.put(item, timeout=0.5)
+                return True
+            except queue.Full: continue
+        with self.lock: self.pending -= 1
+        return False
+
+    def close(self):
+        """これ以上投入しない。残りを処理し終えたら on_done を呼ぶ"""
+        with self.lock: self.closed = True
+        self._check_done()
+
+    def _check_done(self):
+        with self.lock:
+            if not self.closed or self.pending > 0 or self.finished: return
+            self.finished = True
+        if self.on_done: self.on_done()
+
+    def _spawn(self):
+        with self.lock:
+            wid = self.next_id
+            self.next_id += 1
+            t = threading.Thread(target=self._worker, args=(wid,), daemon=True)
+            self.workers[wid] = t
+        self.threads.append(t)
+        t.start()
+
+    def _next_task(self):
+        try: return self.retries.get_nowait()
+        except queue.Empty: pass
+        return self.tasks.get(timeout=0.5)
+
+    def _worker(self, wid):
+        if self.ctx: add_script_run_ctx(threading.current_thread(), self.ctx)
+        state, setup_failed = None, False
+        try:
+            while not self.stop_event.is_set():
+                with self.lock:
+                    if self.finished: break
+                    if self.retire > 0 and len(self.workers) > 1:
+                        self.retire -= 1
+                        break
+                try: item = self._next_task()
+                except queue.Empty: continue
+
+                # 再試行は前回失敗したワーカー以外で行う (他に誰もいなければ自分でやる)
+                if wid in item['_avoid'] and self.num_workers > 1:
+                    self.retries.put(item)
+                    time.sleep(0.05)
+                    continue
+
+                # ワーカー固有の資源 (ブラウザなど) は1回だけ用意。失敗しても state=None で続行する
+                if self.setup and state is None and not setup_failed:
+                    try: state = self.setup()
+                    except Exception: setup_failed = True
+
+                t0 = time.time()
+                if self.race_deadline and '_deadline' not in item: item['_deadline'] = t0 + self.race_deadline
+                if item.get('_deadline') and t0 > item['_deadline']:
+                    self._finish(self._failed(item, 'timeout', "race deadline exceeded"))
+                    continue
+
+                with self.lock: self.inflight[wid] = (item, t0)
+                spans = item.setdefault('_spans', []) if tracing_enabled() else None
+                try:
+                    with trace_scope(spans), trace_span(f"stage.{self.name}", attempt=item['_attempt']):
+                        out = self.work_fn(item, state)
+                except Exception as e:
+                    out = self._failed(item, 'error', str(e))
+                elapsed = time.time() - t0
+                with self.lock:
+                    self.inflight.pop(wid, None)
+                    if wid in self.abandoned: break # 監視側がタイムアウト扱いにした (交代ワーカーが起動済み)
+
+                if out.get('status') == 'error' and item['_attempt'] < self.max_retries:
+                    item['_attempt'] += 1
+                    item['_avoid'].add(wid)
+                    self.retries.put(item)
+                    # 資源の不調が原因のこともあるので作り直す
+                    if state is not None and self.teardown:
+                        self.teardown(state)
+                        state = None
+                    continue
+
+                out.setdefault('_timings', {})[self.name] = elapsed
+                get_metrics().observe('keiba_scan_stage_seconds', elapsed, stage=self.name)
+                with self.lock: self.latencies.append(elapsed)
+                self._finish(out)
+        finally:
+            if state is not None and self.teardown: self.teardown(state)
+            with self.lock: self.workers.pop(wid, None)
+
+    def _failed(self, item, status, message):
+        return {'status': status, 'race': item['race'], 'error': message, 'stage': self.name,
+                '_attempt': item['_attempt'], '_avoid': item['_avoid'], '_timings': item.get('_timings', {}), '_spans': item.get('_spans', [])}
+
+    def _finish(self, out):
+        try: self.emit(out)
+        finally:
+            with self.lock: self.pending -= 1
+            self._check_done()
+
+    def check_timeouts(self):
+        """処理中の件がステージ上限かレースの締め切りを超えていたら、結果なしで先に進める"""
+        now = time.time()
+        expired = []
+        with self.lock:
+            for wid, (item, t0) in list(self.inflight.items()):
+                if (self.timeout and now - t0 > self.timeout) or (item.get('_deadline') and now > item['_deadline']):
+                    expired.append((item, now - t0))
+                    self.abandoned.add(wid)
+                    self.inflight.pop(wid)
+                    self.workers.pop(wid, None)
+                    self.timeouts += 1
+        for item, elapsed in expired:
+            get_metrics().inc('keiba_scan_timeouts_total', stage=self.name)
+            self._finish(self._failed(item, 'timeout', f"{self.name} timed out after {elapsed:.0f}s"))
+            if not self.finished and not self.stop_event.is_set(): self._spawn()
+
+    def adjust(self):
+        """処理時間と空きメモリからワーカー数を増減する (メインスレッドから定期的に呼ぶ)"""
+        with self.lock:
+            n = len(self.workers)
+            pending = self.pending
+            recent = self.latencies[-10:]
+            finished = self.finished
+        if finished: return
+        if n == 0: return self._spawn()
+        if self.max_workers == self.min_workers or pending <= 0: return
+
+        mem = available_memory_mb()
+        if mem is not None and mem < SCAN_WORKER_MEMORY_MB:
+            if n > 1:
+                with self.lock: self.retire += 1
+            return
+        if n >= self.max_workers or self.tasks.qsize() <= n: return
+        if mem is not None and mem < SCAN_WORKER_MEMORY_MB * 2: return
+        # 処理時間の実績が出るまでは増やさない (start で min_workers 分だけ起動済み)
+        if not recent: return
+        if sum(recent) / len(recent) * pending / n > SCAN_TARGET_SECONDS:
+            self._spawn()
+
+    def stats(self):
+        with self.lock:
+            done = len(self.latencies)
+            avg = sum(self.latencies) / done if done else 0.0
+            return {'stage': self.name, 'workers': len(self.workers), 'queue': self.tasks.qsize() + self.retries.qsize(),
+                    'done': done, 'avg_sec': round(avg, 2), 'timeouts': self.timeouts}
+
+    def shutdown(self, wait=5.0):
+        """ワーカーを止める。固まったスレッド (daemon) は待ち切らずに置いていく"""
+        self.stop_event.set()
+        deadline = time.time() + wait
+        for t in self.threads: t.join(timeout=max(0.0, deadline - time.time()))
+
+def quit_driver(driver):
+    try: driver.quit()
+    except Exception: pass
+
+class ScanPipeline:
+    """
+    ステージごとの RaceScheduler を上限付きキューでつなぐ。
+    通信 (fetch/feature/result) と CPU (parse/predict) が別のレースで同時に進む。
+    """
+    def __init__(self, races, model, encoders, engine, ctx=None, stage_workers=None, queue_size=SCAN_QUEUE_SIZE,
+                 process_pool=None, process_stages=SCAN_PROCESS_STAGES):
+        workers = {**SCAN_STAGE_WORKERS, **(stage_workers or {})}
+        # プロセスに回すステージは、プロセス数ぶんのスレッドがタスクを投げて結果を待つ
+        pools = {name: process_pool for name in process_stages} if process_pool else {}
+        for name in pools: workers[name] = process_pool._max_workers
+        stage_defs = [
+            # (名前, 関数(item, state), 追加オプション)
+            ('fetch', lambda it, driver: stage_fetch(it, driver),
+             {'setup': create_chrome_driver, 'teardown': quit_driver, 'max_workers': SCAN_MAX_WORKERS}),
+            ('parse', lambda it, _: stage_parse(it, pools.get('parse')), {}),
+            ('feature', lambda it, _: stage_feature(it, encoders, engine, pools.get('feature')), {}),
+            ('predict', lambda it, _: stage_predict(it, model, pools.get('predict')), {}),
+            ('result', lambda it, _: stage_result(it), {}),
+        ]
+        self.races = races
+        self.results = queue.Queue()
+        self.stages = []
+        for i, (name, fn, opts) in enumerate(stage_defs):
+            self.stages.append(RaceScheduler(fn, emit=self._make_emit(i), name=name, ctx=ctx, min_workers=workers[name],
+                                             maxsize=queue_size if i > 0 else 0, timeout=SCAN_STAGE_TIMEOUTS.get(name),
+                                             race_deadline=SCAN_RACE_DEADLINE if i == 0 else None, **opts))
+        for upstream, downstream in zip(self.stages, self.stages[1:]):
+            upstream.on_done = downstream.close
+        self.last_adjust = 0.0
+
+    def _make_emit(self, i):
+        def emit(item):
+            if item.get('status') or i == len(self.stages) - 1:
+                self.results.put(item)
+            elif not self.stages[i + 1].submit(item):
+                # 中止後に次のステージへ渡せなかったレースも捨てずに「中止」として返す
+                self.results.put(self.stages[i + 1]._failed(item, 'cancelled', "scan cancelled"))
+        return emit
+
+    @property
+    def num_workers(self):
+        return sum(s.num_workers for s in self.stages)
+
+    def start(self):
+        for s in self.stages: s.start()
+        for race in self.races: self.stages[0].submit({'race': race})
+        self.stages[0].close()
+        return self
+
+    def next_result(self, timeout=180):
+        """次に完了したレースの結果。timeout 秒間どのレースも終わらなければ queue.Empty"""
+        deadline = time.time() + timeout
+        while True:
+            if time.time() - self.last_adjust >= 1.0:
+                self.last_adjust = time.time()
+                for s in self.stages:
+                    s.check_timeouts()
+                    s.adjust()
+            try: return self.results.get(timeout=min(1.0, max(0.01, deadline - time.time())))
+            except queue.Empty:
+                if time.time() >= deadline: raise
+
+    def cancel(self):
+        """全ステージに停止を指示する (処理中の1件が終わったところで各ワーカーが抜ける)"""
+        for s in self.stages: s.stop_event.set()
+
+    def stats(self):
+        return [s.stats() for s in self.stages]
+
+    def status_line(self):
+        return " | ".join(f"{s['stage']} q{s['queue']} w{s['workers']} {s['avg_sec']:.1f}s" for s in self.stats())
+
+    def shutdown(self, wait=5.0):
+        deadline = time.time() + wait
+        for s in self.stages: s.shutdown(wait=max(0.0, deadline - time.time()))
+
+# ---------------------------------------------------------
+# ★変更: スキャンはバックグラウンドのジョブとして実行する
+# スクリプトの再実行・ブラウザ更新でも処理は止まらず、同じ開催日のスキャンは全セッションで1本にまとめる。
+# ジョブは session_state に触らず、結果を job.state に貯める (完了後に各セッションへコピー)。
+# ---------------------------------------------------------
+SCAN_JOB_TTL = 1800 # 完了したスキャン結果を使い回す時間(秒)
+
+class ScanJob:
+    def __init__(self, key, target_date):
+        self.key = key
+        self.target_date = target_date
+        self.status = 'running' # running / done / cancelled / error
+        self.total = 0
+        self.completed = 0
+        self.started = time.time()
+        self.finished = None
+        self.stage_line = ""
+        self.error = None
+        self.state = {} # session_state に反映する値 (scan_results, report_stats ...)
+        self.cancel_event = threading.Event()
+
+    @property
+    def progress(self):
+        return min(1.0, self.completed / self.total) if self.total else 0.0
+
+    def cancel(self):
+        self.cancel_event.set()
+
+class ScanJobManager:
+    def __init__(self):
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock: return self.jobs.get(key)
+
+    def submit(self, target_date, race_list, model, encoders, engine, pool=None, force=False):
+        """同じキーのジョブが実行中 or 完了直後ならそれを返し、なければ新しく開始する"""
+        key = scan_job_key(target_date, model)
+        with self.lock:
+            job = self.jobs.get(key)
+            if job and not force:
+                if job.status == 'running': return job
+                if job.status == 'done' and time.time() - job.finished < SCAN_JOB_TTL: return job
+            job = ScanJob(key, target_date)
+            self.jobs[key] = job
+        threading.Thread(target=run_scan_job, args=(job, race_list, model, encoders, engine, pool), daemon=True).start()
+        return job
+
+    def get_or_load(self, target_date, model):
+        """メモリ上のジョブ、なければ共有ストアの事前スキャン結果を返す (ストアの方が新しければ読み直す)"""
+        key = scan_job_key(target_date, model)
+        with self.lock: job = self.jobs.get(key)
+        if job and job.status == 'running': return job
+        mtime = scan_store_mtime(target_date)
+        if mtime is None or (job and job.finished and job.finished >= mtime): return job
+        state = load_scan_state(target_date, model)
+        if state is None: return job
+        absorb_predictions(state, model)
+        stored = ScanJob(key, target_date)
+        stored.state, stored.status, stored.finished = state, 'done', mtime
+        stored.total = stored.completed = len(state.get('scanned_race_urls', []))
+        with self.lock:
+            current = self.jobs.get(key)
+            if current and current.status == 'running': return current
+            self.jobs[key] = stored
+        return stored
+
+    def submit_backtest(self, start_date, end_date, model, encoders, engine):
+        """期間バックテスト。同じ期間が実行中ならそれに合流する (完了済みの日は保存済みの予測を読むだけなので毎回作り直す)"""
+        key = f"backtest:{start_date.strftime('%Y%m%d')}-{end_date.strftime('%Y%m%d')}:{(model or {}).get('version', '-')}"
+        with self.lock:
+            job = self.jobs.get(key)
+            if job and job.status == 'running': return job
+            job = ScanJob(key, start_date)
+            self.jobs[key] = job
+        threading.Thread(target=run_backtest_job, args=(job, start_date, end_date, model, encoders, engine), daemon=True).start()
+        return job
+
+@st.cache_resource
+def get_scan_job_manager():
+    return ScanJobManager()
+
+def scan_job_key(target_date, model):
+    return f"{target_date.strftime('%Y%m%d')}:{(model or {}).get('version', '-')}"
+
+def run_scan_job(job, race_list, model, encoders, engine, pool=None):
+    try:
+        job.state = scan_races(job, race_list, model, encoders, engine, pool)
+        job.state['race_list'] = race_list
+        job.status = 'cancelled' if job.cancel_event.is_set() else 'done'
+        if job.status == 'done': save_scan_state(job.target_date, model, job.state) # ★追加: 他のサーバープロセスとも共有
+        if job.state.get('scan_trace'): save_trace(job.state['scan_trace']) # ★追加: data/traces/*.jsonl
+        job.state.pop('prediction_cache', None) # 共有キャッシュには scan_races が入れ済み
+        job.state.pop('prediction_diag', None)
     except Exception as e:
-        # エラー時もキューに入れてカウントを進める
-        for race in chunk:
-            result_queue.put({'status': 'error', 'race': race, 'error': str(e)}) # ★変更
+        job.error = str(e)
+        job.status = 'error'
     finally:
-        if driver:
-            driver.quit()
-    
-    return True # 戻り値は使わないので適当に
+        job.finished = time.time()
+        get_metrics().observe('keiba_scan_duration_seconds', job.finished - job.started, status=job.status)
 
-def scan_races(target_date, race_list, model, encoders, engine):
-    if 'report_stats' in st.session_state and st.session_state.report_stats:
-        stats = st.session_state.report_stats
-    else:
-        stats = {k: {'bets':0, 'hit_count':0, 'win_ret':0, 'place_ret':0} for k in ['pace', 'hole', 'ai']}
-        
+# ---------------------------------------------------------
+# ★追加: スキャン結果の共有ストア (data/scans/YYYYMMDD.pkl)
+# scan_daemon.py が前日夜・当日朝・発走前に書き込み、UI はこれを読むだけで結果を表示できる。
+# 書き込みは一時ファイル → os.replace で差し替える (読み込み途中のファイルを見せない)。
+# ---------------------------------------------------------
+SCAN_STORE_DIR = 'data/scans'
+
+def scan_store_path(target_date):
+    return os.path.join(SCAN_STORE_DIR, f"{target_date.strftime('%Y%m%d')}.pkl")
+
+def scan_store_mtime(target_date):
+    path = scan_store_path(target_date)
+    return os.path.getmtime(path) if os.path.exists(path) else None
+
+def save_scan_state(target_date, model, state):
+    try:
+        os.makedirs(SCAN_STORE_DIR, exist_ok=True)
+        path = scan_store_path(target_date)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        joblib.dump({'version': (model or {}).get('version', '-'), 'saved_at': time.time(), 'state': state}, tmp)
+        os.replace(tmp, path)
+        return True
+    except Exception: return False
+
+def load_scan_state(target_date, model):
+    """保存済みのスキャン結果 (モデルのバージョンが違えば None)"""
+    try:
+        payload = joblib.load(scan_store_path(target_date))
+        if payload.get('version') != (model or {}).get('version', '-'): return None
+        return payload['state']
+    except Exception: return None
+
+# ---------------------------------------------------------
+# ★追加: 予測データの圧縮 (キャッシュとスキャン結果にはこの形で置き、詳細画面で開くときに元の DataFrame に戻す)
+# 文字列の繰り返し列は category、float64 は float32、整数は入る最小の型にする (元の dtype は持っておいて戻す)。
+# debug は res と行の並びが違うだけなので、並び順とオッズで変わる列だけを持つ。
+# 騎手・調教師の診断表は全体集計の一部なので、レースごとには名前だけを持ち、表はスキャン (とキャッシュ) に1つだけ置く。
+# ---------------------------------------------------------
+REPRICE_COLS = ('オッズ', 'EV', '判定', '判定_穴', 'is_boost') # reprice_race が書き換える列
+SHARED_DIAG_KEYS = {'jockey': '騎手', 'trainer': '調教師'}
+
+INT_DOWNCASTS = (np.int8, np.int16, np.int32)
+
+def _compact_column(s):
+    """1列分を詰めた配列にする (詰められない列はそのまま)"""
+    values = s.to_numpy()
+    if s.dtype == np.float64: return values.astype(np.float32)
+    if s.dtype == np.int64 and len(values):
+        lo, hi = values.min(), values.max()
+        for t in INT_DOWNCASTS:
+            if np.iinfo(t).min <= lo and hi <= np.iinfo(t).max: return values.astype(t)
+    if (s.dtype == object or isinstance(s.dtype, pd.StringDtype)) and len(values) > 1:
+        try: codes, uniques = pd.factorize(s)
+        except TypeError: return s.array # dict や list が入った列
+        if len(uniques) * 2 <= len(values): return pd.Categorical.from_codes(codes, uniques)
+    return s.array
+
+class CompactFrame:
+    """dtype を詰めた DataFrame。expand() で元の dtype に戻す (float32 は10進の最短表記を経由するので 12.3 は 12.3 に戻る)"""
+    __slots__ = ('frame', 'dtypes')
+
+    def __init__(self, df):
+        self.dtypes = list(df.dtypes) # 列名の重複があっても位置で戻せるように
+        self.frame = pd.DataFrame({i: _compact_column(col) for i, (_, col) in enumerate(df.items())}, index=df.index)
+        self.frame.columns = df.columns
+
+    def expand(self):
+        cols = {}
+        for i, ((_, col), dtype) in enumerate(zip(self.frame.items(), self.dtypes)):
+            if col.dtype == dtype: cols[i] = col.array
+            elif col.dtype == np.float32: cols[i] = col.to_numpy().astype(str).astype(dtype)
+            elif isinstance(col.dtype, pd.CategoricalDtype): cols[i] = pd.array(np.asarray(col, dtype=object), dtype=dtype)
+            else: cols[i] = col.to_numpy().astype(dtype)
+        df = pd.DataFrame(cols, index=self.frame.index)
+        df.columns = self.frame.columns
+        return df
+
+class ResOrder:
+    """debug の代わり: res を元の行順に並べ直し、オッズで変わる列だけ予測時の値に戻す"""
+    __slots__ = ('index', 'reprice')
+
+    def __init__(self, index, reprice):
+        self.index, self.reprice = index, reprice
+
+    @classmethod
+    def of(cls, debug, res):
+        """debug が res の並べ替えになっている場合だけ作る (そうでなければ None)"""
+        try:
+            if list(debug.columns) != list(res.columns) or len(debug) != len(res) or not debug.index.is_unique or not debug.index.isin(res.index).all(): return None
+            if 'AIスコア' in debug.columns and not res.loc[debug.index, 'AIスコア'].equals(debug['AIスコア']): return None # score_race の debug なら一致する
+            cols = [c for c in REPRICE_COLS if c in debug.columns]
+            return cls(debug.index.to_numpy(), CompactFrame(debug[cols]))
+        except Exception: return None
+
+    def expand(self, res):
+        df = res.loc[self.index]
+        reprice = self.reprice.expand()
+        for c in reprice.columns: df[c] = reprice[c]
+        return df
+
+class SharedDiag:
+    """騎手・調教師の診断表の代わりに持つ名前の一覧 (表は tables[kind] に1つだけ)"""
+    __slots__ = ('kind', 'keys', 'columns')
+
+    def __init__(self, kind, keys, columns):
+        self.kind, self.keys, self.columns = kind, keys, columns
+
+    def expand(self, tables):
+        table = tables.get(self.kind)
+        if table is None: return pd.DataFrame(columns=self.columns)
+        keys = [k for k in self.keys if k in table.index]
+        return table.loc[keys].rename_axis(self.columns[0]).reset_index()[self.columns]
+
+def share_diag_tables(tables, new_tables):
+    """診断表をまとめる (同じ名前は新しい方の行で置き換える)"""
+    for kind, new in new_tables.items():
+        old = tables.get(kind)
+        tables[kind] = new if old is None else pd.concat([old[~old.index.isin(new.index)], new])
+
+def compact_prediction(entry, tables):
+    """キャッシュに置く形にする。tables は共有する診断表 ({kind: 名前を index にした DataFrame}) で、ここに行を足していく"""
+    out = dict(entry)
+    res = entry.get('res')
+    if isinstance(entry.get('debug'), pd.DataFrame):
+        out['debug'] = (ResOrder.of(entry['debug'], res) if isinstance(res, pd.DataFrame) else None) or CompactFrame(entry['debug'])
+    for key in ('res', 'X_renamed', 'trace_df'):
+        if isinstance(entry.get(key), pd.DataFrame): out[key] = CompactFrame(entry[key])
+    diag = dict(entry.get('diag_data') or {})
+    for kind, v in diag.items():
+        if not isinstance(v, pd.DataFrame): continue
+        col = SHARED_DIAG_KEYS.get(kind)
+        if col and col in v.columns and v.columns[0] == col and not v.empty and v[col].is_unique:
+            share_diag_tables(tables, {kind: v.set_index(col)})
+            diag[kind] = SharedDiag(kind, v[col].tolist(), list(v.columns))
+        else: diag[kind] = CompactFrame(v)
+    out['diag_data'] = diag
+    return out
+
+def expand_frame(value):
+    return value.expand() if isinstance(value, CompactFrame) else value
+
+def expand_prediction(entry, tables, full=True):
+    """compact_prediction の逆。full=False なら res だけ戻す (一覧・再判定・回収率の計算にはこれで足りる)"""
+    if not entry: return entry
+    out = dict(entry)
+    out['res'] = expand_frame(entry.get('res'))
+    if not full: return out
+    debug = entry.get('debug')
+    out['debug'] = debug.expand(out['res']) if isinstance(debug, ResOrder) else expand_frame(debug)
+    for key in ('X_renamed', 'trace_df'): out[key] = expand_frame(entry.get(key))
+    out['diag_data'] = {k: v.expand(tables) if isinstance(v, SharedDiag) else expand_frame(v) for k, v in (entry.get('diag_data') or {}).items()}
+    return out
+
+# ---------------------------------------------------------
+# ★追加: 予測キャッシュ (プロセス全体で共有 / メモリ上限つき LRU / ディスク保存は任意)
+# キーは (race_id, モデルのバージョン, オッズのスナップショット)。オッズで再判定した結果は別キーで入り、
+# 参照するときはそのレースの最新スナップショットを返す。
+# ---------------------------------------------------------
+PREDICTION_CACHE_MB = 256 # メモリに置く予測データの上限
+PREDICTION_CACHE_DIR = 'data/prediction_cache'
+try: PREDICTION_CACHE_DISK = bool(st.secrets.get("PREDICTION_CACHE_DISK", False)) # 再起動・別プロセスとも共有したいとき
+except: PREDICTION_CACHE_DISK = False
+
+def race_id_from_url(url):
+    m = re.search(r'race_id=(\d+)', url or '')
+    return m.group(1) if m else url
+
+def odds_snapshot(res):
+    """res のオッズ列から作る短いハッシュ (オッズが変われば別のキャッシュになる)。圧縮した res もそのまま渡せる"""
+    if isinstance(res, CompactFrame): res = res.frame
+    if res is None or res.empty or 'オッズ' not in res.columns: return '-'
+    umaban = pd.to_numeric(res['馬番'], errors='coerce').fillna(0).to_numpy(dtype=np.int16)
+    return hashlib.sha1(umaban.tobytes() + parse_odds_values(res['オッズ'].tolist()).tobytes()).hexdigest()[:10]
+
+def estimate_bytes(value):
+    if isinstance(value, pd.DataFrame): return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, CompactFrame): return estimate_bytes(value.frame) + 8 * len(value.dtypes)
+    if isinstance(value, ResOrder): return value.index.nbytes + estimate_bytes(value.reprice)
+    if isinstance(value, SharedDiag): return estimate_bytes(value.keys) + estimate_bytes(value.columns)
+    if isinstance(value, np.ndarray): return value.nbytes
+    if isinstance(value, dict): return sum(estimate_bytes(v) for v in value.values()) + 64 * len(value)
+    if isinstance(value, (list, tuple, set)): return sum(estimate_bytes(v) for v in value) + 8 * len(value)
+    if isinstance(value, str): return len(value) + 49
+    return 64
+
+class PredictionCache:
+    def __init__(self, max_mb=PREDICTION_CACHE_MB, disk_dir=None):
+        self.max_bytes = max_mb * 1024 * 1024
+        self.disk_dir = disk_dir
+        self.entries = OrderedDict() # key -> (entry, bytes)
+        self.latest = {} # (race_id, version) -> snapshot
+        self.bytes = 0
+        self.counters = {'hits': 0, 'misses': 0, 'disk_hits': 0, 'evictions': 0}
+        self.diag_tables = {} # 騎手・調教師の診断表 (全エントリで共有)
+        self.lock = threading.Lock()
+        if disk_dir: os.makedirs(disk_dir, exist_ok=True)
+
+    def _path(self, key, suffix='pkl'):
+        return os.path.join(self.disk_dir, f"{'_'.join(key)}.{suffix}")
+
+    def put(self, race_id, version, entry, snapshot=None):
+        """圧縮して入れ、入れた形を返す (スキャン結果もこれを持てば二重に圧縮しない)。snapshot が分かっていればハッシュを作り直さない"""
+        key = (race_id, version, snapshot or odds_snapshot(entry.get('res')))
+        with self.lock: entry = compact_prediction(entry, self.diag_tables) # ★変更: 圧縮した形で持つ
+        size = estimate_bytes(entry)
+        with self.lock:
+            if key in self.entries: self.bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (entry, size)
+            self.bytes += size
+            self.latest[key[:2]] = key[2]
+            while self.bytes > self.max_bytes and len(self.entries) > 1:
+                self.bytes -= self.entries.popitem(last=False)[1][1]
+                self.counters['evictions'] += 1
+        if self.disk_dir:
+            try:
+                tmp = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with self.lock: diag = {k: v.expand(self.diag_tables) if isinstance(v, SharedDiag) else v for k, v in entry['diag_data'].items()}
+                joblib.dump({**entry, 'diag_data': diag}, tmp) # 診断表は埋め込んでおく (読み込んだ put でまた共有される)
+                os.replace(tmp, self._path(key))
+                with open(self._path(key[:2], 'latest'), 'w') as f: f.write(key[2])
+            except Exception: pass
+        return entry
+
+    def get(self, race_id, version, snapshot=None):
+        """snapshot を省略するとそのレースの最新のオッズで判定した予測を返す"""
+        with self.lock:
+            snapshot = snapshot or self.latest.get((race_id, version))
+            key = (race_id, version, snapshot)
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.counters['hits'] += 1
+                return self.entries[key][0]
+        entry, snapshot = self._load_disk(race_id, version, snapshot)
+        with self.lock: self.counters['disk_hits' if entry is not None else 'misses'] += 1
+        if entry is not None: self.put(race_id, version, entry, snapshot)
+        return entry
+
+    def contains(self, race_id, version):
+        """予測があるかだけを見る (読み込まず、ヒット率にも数えない)"""
+        with self.lock:
+            snapshot = self.latest.get((race_id, version))
+            if snapshot and (race_id, version, snapshot) in self.entries: return True
+        return bool(self.disk_dir) and os.path.exists(self._path((race_id, version), 'latest'))
+
+    def _load_disk(self, race_id, version, snapshot):
+        """(エントリ, オッズのハッシュ)。無ければ (None, None)"""
+        if not self.disk_dir: return None, None
+        try:
+            if not snapshot:
+                with open(self._path((race_id, version), 'latest')) as f: snapshot = f.read().strip()
+            return joblib.load(self._path((race_id, version, snapshot))), snapshot
+        except Exception: return None, None
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counters['hits'] + self.counters['disk_hits'] + self.counters['misses']
+            return {**self.counters, 'entries': len(self.entries), 'mb': self.bytes / 1024 / 1024,
+                    'hit_rate': (self.counters['hits'] + self.counters['disk_hits']) / lookups if lookups else 0.0}
+
+    def view(self, version):
+        return PredictionCacheView(self, version)
+
+    def expand(self, entry, full=True):
+        with self.lock: return expand_prediction(entry, self.diag_tables, full)
+
+    def add_diag_tables(self, tables):
+        with self.lock: share_diag_tables(self.diag_tables, tables)
+
+    def diag_snapshot(self):
+        with self.lock: return dict(self.diag_tables) # 表は置き換えるだけで書き換えないので浅いコピーでよい
+
+class PredictionCacheView:
+    """URL で引ける dict 風の窓口 (モデルのバージョンを固定)"""
+    def __init__(self, cache, version):
+        self.cache, self.version = cache, version
+
+    def get(self, url, default=None):
+        """res だけ元に戻したエントリ (debug・X_renamed・診断表は圧縮のまま。開くときは detail を使う)"""
+        entry = self.cache.get(race_id_from_url(url), self.version)
+        return default if entry is None else self.cache.expand(entry, full=False)
+
+    def detail(self, url):
+        """詳細画面用: すべての DataFrame を元に戻したエントリ"""
+        entry = self.cache.get(race_id_from_url(url), self.version)
+        return None if entry is None else self.cache.expand(entry)
+
+    def __getitem__(self, url):
+        entry = self.get(url)
+        if entry is None: raise KeyError(url)
+        return entry
+
+    def __contains__(self, url):
+        return self.cache.contains(race_id_from_url(url), self.version)
+
+    def __setitem__(self, url, entry):
+        self.cache.put(race_id_from_url(url), self.version, entry)
+
+    def put(self, url, entry):
+        return self.cache.put(race_id_from_url(url), self.version, entry)
+
+    def update(self, entries):
+        for url, entry in entries.items(): self[url] = entry
+
+@st.cache_resource
+def get_prediction_cache():
+    return PredictionCache(disk_dir=PREDICTION_CACHE_DIR if PREDICTION_CACHE_DISK else None)
+
+def prediction_cache_gauges(metrics):
+    cs = get_prediction_cache().stats()
+    for key in ('hits', 'disk_hits', 'misses', 'evictions'): metrics.set(f'keiba_prediction_cache_{key}_total', cs[key])
+    metrics.set('keiba_prediction_cache_entries', cs['entries'])
+    metrics.set('keiba_prediction_cache_bytes', int(cs['mb'] * 1024 * 1024))
+
+def absorb_predictions(state, model):
+    """スキャン結果の予測データを共有キャッシュへ移す (job.state には残さない)"""
+    entries = state.pop('prediction_cache', None)
+    tables = state.pop('prediction_diag', None) # ★追加: スキャン単位の診断表 (エントリは名前だけを持っている)
+    if tables: get_prediction_cache().add_diag_tables(tables)
+    if entries: get_prediction_cache().view((model or {}).get('version', '-')).update(entries)
+
+def scan_races(job, race_list, model, encoders, engine, pool=None):
+    stats = {k: {'bets':0, 'hit_count':0, 'win_ret':0, 'place_ret':0} for k in ['pace', 'hole', 'ai']}
     results = {'pace': [], 'hole': [], 'ai': []}
-    st.session_state.hits_details = []
-    st.session_state.scan_debug_log = [] # ★追加: 診断用ログの初期化
+    hits_details = []
+    scan_debug_log = [] # 診断用ログ
+    prediction_cache = {}
     
     all_missing = {'jockey': set(), 'trainer': set()}
     trainer_debug_list = []
-    
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-    status_text.text("🚀 Initializing parallel workers...")
-    render_waiting_trivia() # ★追加: スキャン中もトリビアを表示
 
     # 新馬・障害を除外したリストを作成
     target_races = [r for r in race_list if "新馬" not in r['label'] and "障害" not in r['label']]
     total_races = len(target_races)
-    
-    if total_races == 0:
-        status_text.text("No target races found.")
-        return results
+    job.total = total_races
+    missing_races = [] # ★追加: 結果が出なかったレース (部分結果として明示する)
+    state = {'scan_results': results, 'report_stats': stats, 'hits_details': hits_details, 'scan_debug_log': scan_debug_log,
+             'missing_data': all_missing, 'prediction_cache': prediction_cache, 'scanned_race_urls': [r['url'] for r in target_races],
+             'missing_races': missing_races, 'scan_cancelled': False}
+    # ★追加: 処理時間のトレース (有効なときだけ)
+    trace = {'date': job.target_date.strftime('%Y%m%d'), 'started': time.time(), 'spans': [], 'by_race': [], 'races': 0, 'wall': 0.0} if tracing_enabled() else None
+    state['scan_trace'] = trace
+    job.state = state # ★追加: 集計途中の結果も画面から見えるようにする
+    live_cache = get_prediction_cache().view((model or {}).get('version', '-')) # スキャン中でも詳細画面がキャッシュを使えるように
+    if total_races == 0: return state
+    finished_urls = set()
+
+    def mark_missing(race, status, stage='', error=''):
+        missing_races.append({'レース': race['label'], '状態': MISSING_STATUS_LABELS.get(status, status), '段階': stage, '詳細': error, 'url': race['url']})
+
+    def collect(data, metric_status=None):
+        """完了した1レースの結果を集計に加える (チェックポイントから復元したレースは metric_status='resumed' で数える)"""
+        finished_urls.add(data['race']['url'])
+        get_metrics().inc('keiba_scan_races_total', status=metric_status or data['status'])
+        if trace is not None and data.get('_spans'):
+            rid = data['race'].get('id') or race_id_from_url(data['race']['url'])
+            for span in data['_spans']: span['race_id'] = rid
+            trace['spans'].extend(data['_spans'])
+            trace['by_race'].append({**race_trace_row(data['race'], data['_spans']), '状態': data['status']})
+            trace['races'] += 1
+        if data['status'] != 'success':
+            mark_missing(data['race'], data['status'], data.get('stage', ''), data.get('error', ''))
+            return
+        res = data['df']
+        race = data['race']
+        top_ai = data['top_ai'] # トップの馬データを確保
+
+        # ★追加: 診断用データを保存 (判定結果に関わらず全レース記録)
+        try:
+            debug_odds = float(str(top_ai['オッズ']).replace('-', '0'))
+        except: debug_odds = 0.0
+        
+        scan_debug_log.append({
+            "レース": race['label'],
+            "トップ馬": top_ai['馬名'],
+            "AIスコア": f"{top_ai['AIスコア']*100:.1f}%",
+            "取得オッズ": debug_odds, # ここが0だと判定落ちします
+            "判定(神)": top_ai['判定'],
+            "判定(穴)": top_ai['判定_穴'],
+            "処理時間": " / ".join(f"{k} {v:.1f}s" for k, v in data.get('_timings', {}).items()) # ★追加: ステージ別
+        })
+        
+        # Missing Info集計
+        m_info = data['missing_info']
+        for j in m_info['jockey']: all_missing['jockey'].add(j)
+        for t in m_info['trainer']: all_missing['trainer'].add(t)
+        if 'trainer_debug' in m_info and not m_info['trainer_debug'].empty:
+            trainer_debug_list.append(m_info['trainer_debug'])
+        
+        # 結果リストへの追加
+        # ★変更: マーク付きのDF (pace_hits, hole_hits, ai_hit_df) を使用する
+        append_race_hits(results, race, data)
+        
+        # ★追加: キャッシュに詳細データを保存
+        entry = {
+            'race': race, # オッズ再評価で使う
+            'res': res,
+            'debug': data['debug'],
+            'X_renamed': data['X_renamed'],
+            'diag_data': data['diag_data'],
+            'missing_info': data['missing_info'],
+            'trace_df': data['trace_df'],
+            'contrib': data['contrib']
+        }
+        prediction_cache[race['url']] = live_cache.put(race['url'], entry) # ★変更: 共有キャッシュと同じ圧縮した形をスキャン結果 (保存ファイル) にも持つ
+        
+        # 成績集計
+        ranks = data['ranks']
+        win_p = data['win_p']
+        place_p = data['place_p']
+        
+        if ranks:
+            def update(cat, horse):
+                stats[cat]['bets'] += 1
+                r = ranks.get(horse['馬番'], 99)
+                if r == 1 and win_p: stats[cat]['win_ret'] += win_p.get(horse['馬番'], 0)
+                if r <= 3:
+                    stats[cat]['hit_count'] += 1
+                    if place_p: stats[cat]['place_ret'] += place_p.get(horse['馬番'], 0)
+                    win_val = win_p.get(horse['馬番'], 0) if win_p else 0
+                    place_val = place_p.get(horse['馬番'], 0) if place_p else 0
+                    hits_details.append({"戦略": cat, "レース": race['label'], "馬名": horse['馬名'], "着順": r, "単勝": win_val, "複勝": place_val})
+
+            if data['is_ai_target']: update('ai', data['top_ai'])
+            if not data['pace_hits'].empty: update('pace', data['pace_hits'].iloc[0])
+            if not data['hole_hits'].empty: 
+                hole_sorted = data['hole_hits'].sort_values(['AIスコア', 'raw_preds'], ascending=[False, False])
+                update('hole', hole_sorted.iloc[0])
+
+    # ★追加: 前回の途中までの結果 (チェックポイント) があれば、そのレースは処理し直さない
+    ckpt_dir = checkpoint_dir(job.target_date, model)
+    stored_at = scan_store_mtime(job.target_date)
+    if stored_at and os.path.isdir(ckpt_dir) and os.path.getmtime(ckpt_dir) <= stored_at:
+        clear_checkpoints(ckpt_dir) # 保存済みスキャンより古い = 中断ではなく再スキャンの指示なので使わない
+    resumed = load_race_checkpoints(ckpt_dir)
+    resumed = reprice_checkpoints({r['url']: resumed[r['url']] for r in target_races if r['url'] in resumed}) # ★追加: 中断から時間が経っているのでオッズは取り直す
+    pending = []
+    for race in target_races:
+        if race['url'] in resumed: collect(resumed[race['url']], metric_status='resumed')
+        else: pending.append(race)
+    state['resumed_races'] = total_races - len(pending)
+    completed_races = job.completed = state['resumed_races']
+
+    def handle(data):
+        nonlocal completed_races
+        try:
+            completed_races += 1
+            job.completed = completed_races
+            collect(data)
+            if data['status'] == 'success': save_race_checkpoint(ckpt_dir, data)
+        except Exception as e:
+            # 1レースの集計エラーでスキャン全体を止めない
+            mark_missing(data['race'], 'error', 'aggregate', str(e))
 
-    # リストを分割する (メモリに余裕があれば並列数を増やす)
-    num_workers = 4
-    chunks = [target_races[i::num_workers] for i in range(num_workers)]
-    
-    # メインスレッドのコンテキストを取得
+    # ステージ分割パイプラインで並列実行 (各ステージが共有キュー + 動的ワーカー数)
+    scheduler = ScanPipeline(pending, model, encoders, engine, process_pool=pool).start() if pending else None
     try:
-        ctx = get_script_run_ctx()
-    except:
-        ctx = None
-
-    # 結果受け取り用のキューを作成
-    result_queue = queue.Queue() # ★追加
-
-    # 並列実行
-    with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
-        # 各チャンクを処理開始 (queueも渡す)
-        # ★変更: process_race_chunk の引数に result_queue を追加
-        futures = [executor.submit(process_race_chunk, chunk, model, encoders, engine, ctx, result_queue) for chunk in chunks]
+        last_progress = time.time()
         
-        completed_races = 0
-        
-        # ★変更: レース数分だけループして、キューから結果を1つずつ取り出す
+        # レース数分だけループして、完了した結果を1つずつ取り出す
         while completed_races < total_races:
+            # ★追加: 中止ボタン
+            if job.cancel_event.is_set():
+                scheduler.cancel()
+                state['scan_cancelled'] = True
+                break
             try:
-                # キューから結果を取得 (タイムアウト付きで無限待ち回避)
-                data = result_queue.get(timeout=180) 
-                
-                completed_races += 1
-                status_text.text(f"Processing... ({completed_races}/{total_races} completed)")
-                
-                if data['status'] == 'success':
-                    res = data['df']
-                    race = data['race']
-                    top_ai = data['top_ai'] # トップの馬データを確保
-
-                    # ★追加: 診断用データを保存 (判定結果に関わらず全レース記録)
-                    try:
-                        debug_odds = float(str(top_ai['オッズ']).replace('-', '0'))
-                    except: debug_odds = 0.0
-                    
-                    st.session_state.scan_debug_log.append({
-                        "レース": race['label'],
-                        "トップ馬": top_ai['馬名'],
-                        "AIスコア": f"{top_ai['AIスコア']*100:.1f}%",
-                        "取得オッズ": debug_odds, # ここが0だと判定落ちします
-                        "判定(神)": top_ai['判定'],
-                        "判定(穴)": top_ai['判定_穴']
-                    })
-                    
-                    # Missing Info集計
-                    m_info = data['missing_info']
-                    for j in m_info['jockey']: all_missing['jockey'].add(j)
-                    for t in m_info['trainer']: all_missing['trainer'].add(t)
-                    if 'trainer_debug' in m_info and not m_info['trainer_debug'].empty:
-                        trainer_debug_list.append(m_info['trainer_debug'])
-                    
-                    # 結果リストへの追加
-                    # ★変更: マーク付きのDF (pace_hits, hole_hits, ai_hit_df) を使用する
-                    if not data['pace_hits'].empty: 
-                        results['pace'].append({'race': race['label'], 'url': race['url'], 'hits': data['pace_hits'], 'grade': race['grade'], 'time': race.get('time', '99:99')})
-                    
-                    if not data['hole_hits'].empty: 
-                        results['hole'].append({'race': race['label'], 'url': race['url'], 'hits': data['hole_hits'], 'grade': race['grade'], 'time': race.get('time', '99:99')})
-                    
-                    if data['is_ai_target']: 
-                        # ここも ai_hit_df を使う
-                        results['ai'].append({'race': race['label'], 'url': race['url'], 'hits': data['ai_hit_df'], 'grade': race['grade'], 'time': race.get('time', '99:99')})
-                    
-                    # ★追加: キャッシュに詳細データを保存
-                    if 'prediction_cache' not in st.session_state:
-                         st.session_state.prediction_cache = {}
-                    st.session_state.prediction_cache[race['url']] = {
-                        'res': res,
-                        'debug': data['debug'],
-                        'X_renamed': data['X_renamed'],
-                        'diag_data': data['diag_data'],
-                        'missing_info': data['missing_info'],
-                        'trace_df': data['trace_df']
-                    }
-                    
-                    # 成績集計
-                    ranks = data['ranks']
-                    win_p = data['win_p']
-                    place_p = data['place_p']
-                    
-                    if ranks:
-                        def update(cat, horse):
-                            stats[cat]['bets'] += 1
-                            r = ranks.get(horse['馬番'], 99)
-                            if r == 1 and win_p: stats[cat]['win_ret'] += win_p.get(horse['馬番'], 0)
-                            if r <= 3:
-                                stats[cat]['hit_count'] += 1
-                                if place_p: stats[cat]['place_ret'] += place_p.get(horse['馬番'], 0)
-                                win_val = win_p.get(horse['馬番'], 0) if win_p else 0
-                                place_val = place_p.get(horse['馬番'], 0) if place_p else 0
-                                st.session_state.hits_details.append({"戦略": cat, "レース": race['label'], "馬名": horse['馬名'], "着順": r, "単勝": win_val, "複勝": place_val})
-
-                        if data['is_ai_target']: update('ai', data['top_ai'])
-                        if not data['pace_hits'].empty: update('pace', data['pace_hits'].iloc[0])
-                        if not data['hole_hits'].empty: 
-                            hole_sorted = data['hole_hits'].sort_values(['AIスコア', 'raw_preds'], ascending=[False, False])
-                            update('hole', hole_sorted.iloc[0])
-            
-                # プログレスバー更新 (1件ごとに進む)
-                progress_bar.progress(min(1.0, completed_races / total_races))
-            
+                # 短い間隔で待ち、その間にタイムアウト監視とワーカー数の調整を行う
+                data = scheduler.next_result(timeout=1.0)
             except queue.Empty:
-                # 万が一タイムアウトしたらループを抜ける
-                break
+                # どのレースも終わらない状態が続いたら打ち切る (残りは未取得として記録)
+                if time.time() - last_progress > SCAN_STALL_TIMEOUT: break
+                continue
+            last_progress = time.time()
+            job.stage_line = f"{scheduler.num_workers} workers | {scheduler.status_line()}"
+            handle(data)
+    finally:
+        if scheduler:
+            scheduler.cancel()
+            scheduler.shutdown(wait=2.0)
+            state['scan_stage_stats'] = scheduler.stats()
+            # ★追加: 中止・打ち切りの時点で完了済みだったレースも集計・チェックポイントに入れる
+            while True:
+                try: handle(scheduler.results.get_nowait())
+                except queue.Empty: break
+
+    # 最後まで結果が返らなかったレース
+    for race in target_races:
+        if race['url'] not in finished_urls:
+            mark_missing(race, 'cancelled' if state['scan_cancelled'] else 'timeout')
     
     # 時系列ソート
     for key in results:
         results[key].sort(key=lambda x: x.get('time', '99:99'))
 
-    status_text.empty()
-    progress_bar.empty()
-    st.session_state.report_stats = stats
-    st.session_state.missing_data = all_missing
     if trainer_debug_list:
-        st.session_state.trainer_debug_all = pd.concat(trainer_debug_list, ignore_index=True)
-    return results
+        state['trainer_debug_all'] = pd.concat(trainer_debug_list, ignore_index=True)
+    if not missing_races: clear_checkpoints(ckpt_dir) # 全レース揃ったら次のスキャンは最初から
+    try: state['roi_simulation'] = simulate_scan_roi(results, prediction_cache) # ★追加: 回収率の予測区間
+    except Exception: state['roi_simulation'] = {}
+    state['prediction_diag'] = get_prediction_cache().diag_snapshot() # ★追加: エントリが名前で指している騎手・調教師の診断表 (スキャンで1つ)
+    if trace is not None: trace['wall'] = time.time() - trace['started']
+    return state
+
+# ---------------------------------------------------------
+# ★追加: レース単位のチェックポイント (data/checkpoints/<日付>_<モデル>/<race_id>.pkl)
+# 完了したレースから順に書き出し、再起動・中断のあとは残りのレースだけをスキャンする。
+# 詳細表示・集計に要る項目だけを残す (HTML などの途中データは捨てる)。
+# ---------------------------------------------------------
+CHECKPOINT_DIR = 'data/checkpoints'
+CHECKPOINT_KEYS = ('status', 'race', 'df', 'top_ai', 'debug', 'X_renamed', 'diag_data', 'missing_info', 'trace_df', 'contrib',
+                   'pace_hits', 'hole_hits', 'ai_hit_df', 'is_ai_target', 'ranks', 'win_p', 'place_p', '_timings')
+
+def checkpoint_dir(target_date, model):
+    return os.path.join(CHECKPOINT_DIR, f"{target_date.strftime('%Y%m%d')}_{(model or {}).get('version', '-')}")
+
+def save_race_checkpoint(directory, data):
+    try:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{data['race'].get('id') or race_id_from_url(data['race']['url'])}.pkl")
+        joblib.dump({k: data[k] for k in CHECKPOINT_KEYS if k in data}, f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+    except Exception: pass
+
+def load_race_checkpoints(directory):
+    """{url: 完了済みのレース結果}。壊れたファイル (書き込み途中で落ちた等) は読み飛ばす"""
+    restored = {}
+    if not os.path.isdir(directory): return restored
+    for name in os.listdir(directory):
+        if not name.endswith('.pkl'): continue
+        try:
+            data = joblib.load(os.path.join(directory, name))
+            restored[data['race']['url']] = data
+        except Exception: continue
+    return restored
+
+def reprice_checkpoints(restored, max_workers=8):
+    """復元したレースの最新オッズを取り直し、判定・ヒット馬を組み直す (reprice_scan_results と同じ流れ)"""
+    done = [(u, d) for u, d in restored.items() if d.get('status') == 'success']
+    if not done: return restored
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        odds_maps = list(executor.map(lambda ud: fetch_win_odds(ud[1]['race'].get('id') or race_id_from_url(ud[0])), done))
+    restored = dict(restored)
+    for (url, data), odds_map in zip(done, odds_maps):
+        if not odds_map: continue
+        try:
+            res = reprice_race(data['df'], odds_map)
+            restored[url] = {**data, 'df': res, **summarize_race(res)}
+        except Exception: continue # 取り直せなければチェックポイントのまま使う
+    return restored
+
+def clear_checkpoints(directory):
+    shutil.rmtree(directory, ignore_errors=True)
+
+def apply_scan_job(job):
+    """完了したジョブの結果をこのセッションに反映する (予測データは共有キャッシュから引く)"""
+    for key, value in job.state.items(): st.session_state[key] = value
+    st.session_state.applied_scan_job = (job.key, job.finished)
+    st.session_state.view_mode = 'list'
+
+@st.fragment(run_every=2)
+def render_scan_job_progress(job):
+    """バックグラウンドのスキャンを2秒ごとに確認し、途中結果を表示する。終わったら画面全体を更新する"""
+    if job.status == 'running':
+        st.progress(job.progress, text=f"Processing... ({job.completed}/{job.total or '-'} completed)")
+        if job.stage_line: st.caption(job.stage_line)
+        if job.cancel_event.is_set(): st.caption("⏹ 中止しています... (処理中のレースが終わり次第、取得済みの結果を表示します)")
+        elif st.button("⏹ スキャンを中止", key="cancel_scan"): job.cancel()
+        # ★追加: 終わったレースから順に表示する (全レースの完了を待たない)
+        state = job.state
+        if state.get('scan_results') and any(state['scan_results'].values()):
+            render_roi_cards(state.get('report_stats'), list(state.get('hits_details', [])), live=True)
+            render_scan_lists(state['scan_results'], live=True)
+    elif job.status in ('done', 'cancelled'):
+        st.rerun()
+    else:
+        st.error(f"スキャンに失敗しました: {job.error}")
+
+# ---------------------------------------------------------
+# 6. 期間バックテスト
+# 日付ごとの予測 (全出走馬 × スコア・オッズ・着順・払戻) を保存し、戦略の判定と払戻は全期間まとめて配列演算で集計する。
+# ---------------------------------------------------------
+BACKTEST_DIR = 'data/backtest_asof' # ★変更: as-of 特徴量での予測表 (旧 data/backtest は当日以降の結果を含む統計で予測していたので読まない)
+STRATEGY_LABELS = {'pace': "🚀 展開ブースト", 'ai': "🦄 鉄板の軸", 'hole': "💣 穴馬ブースト"}
+
+def backtest_day_path(date_str, model):
+    return os.path.join(BACKTEST_DIR, (model or {}).get('version', 'unknown'), f"{date_str}.parquet")
+
+def backtest_feature_frame(start_date, end_date, encoders, engine):
+    """
+    期間内の全出走行の特徴量を DB からまとめて作る。
+    統計は学習データ (build_dataset) と同じ as-of 集計なので、各レースは前日までの結果しか見ない。
+    """
+    hist = load_asof_results(engine, (end_date + datetime.timedelta(days=1)).strftime('%Y-%m-%d'))
+    frame = build_asof_frame(hist, load_horse_pedigree(engine), since=start_date.strftime('%Y-%m-%d'))
+    if frame.empty: return frame
+    # スキャンと同じく新馬・障害は対象外 (クラスの無い DB でも分かるよう、全頭が初出走のレースも新馬戦とみなす)
+    debut = frame['interval_weeks'].eq(0).groupby(frame['race_id']).transform('all')
+    skip = debut | frame['クラス'].astype(str).str.contains('新馬') | frame['コース区分'].astype(str).str.contains('障')
+    frame = frame[~skip].reset_index(drop=True)
+    if frame.empty: return frame
+    race_no = pd.to_numeric(frame['race_id'].str[-2:], errors='coerce').fillna(0).astype(int).astype(str)
+    distance = frame['距離'].fillna(0).astype(int).astype(str)
+    frame['race_label'] = '【' + frame['開催場所'].astype(str) + ' ' + race_no + 'R】 ' + frame['コース区分'].astype(str) + distance + 'm'
+    frame['date_str'] = frame['date'].dt.strftime('%Y%m%d')
+    frame = derive_race_features(frame)
+    return encode_categoricals(frame, encoders)
+
+def fetch_backtest_results(race_ids):
+    """レースごとの確定単勝オッズと単複の払戻 ({race_id: (オッズmap, 単勝map, 複勝map)})。通信はこれだけで、レース単位で並列に取る"""
+    def fetch(race_id):
+        _, win_p, place_p, _ = scrape_race_result(race_id)
+        return race_id, (fetch_win_odds(race_id, record=False), win_p or {}, place_p or {}) # 過去レースの確定オッズはオッズ記録に入れない
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SCAN_STAGE_WORKERS['result']) as executor:
+        return dict(executor.map(fetch, race_ids))
+
+def score_backtest_day(day, model, fetched):
+    """1日分の出走行をまとめて予測し (score_race と同じ入力・キャリブレーション)、バックテスト用の1頭1行の表にする"""
+    raw_preds, _, _ = predict_with_contrib(model, feature_matrix(day, model['features']))
+    race_ids = day['race_id'].to_numpy()
+    umaban = pd.to_numeric(day['馬番'], errors='coerce').fillna(0).astype(int).to_numpy()
+    odds_map, win_p, place_p = zip(*(fetched.get(r, ({}, {}, {})) for r in race_ids))
+    table = pd.DataFrame({
+        'date': day['date_str'].to_numpy(),
+        'race_id': race_ids,
+        'race_label': day['race_label'].to_numpy(),
+        '馬番': umaban.astype(np.int16),
+        '馬名': day['馬名'].to_numpy(),
+        'AIスコア': np.asarray(model['calibrator'].transform(raw_preds), dtype=float),
+        'raw_preds': np.asarray(raw_preds, dtype=float),
+        'odds': parse_odds_values([m.get(u, 0) for m, u in zip(odds_map, umaban)]),
+        'is_pace_advantage': day['is_pace_advantage'].to_numpy(dtype=np.int8),
+        'rank': day['着順_num'].fillna(99).to_numpy(dtype=np.int16),
+        'win_pay': np.array([m.get(u, 0) for m, u in zip(win_p, umaban)], dtype=np.int32),
+        'place_pay': np.array([m.get(u, 0) for m, u in zip(place_p, umaban)], dtype=np.int32),
+        'has_result': np.array([bool(m) for m in win_p], dtype=bool),
+    })
+    return table.sort_values(['race_id', 'AIスコア'], ascending=[True, False], kind='mergesort').reset_index(drop=True)
+
+def group_first(idx, race_codes):
+    """race_codes の順に並んだ idx から、各レースの先頭だけを取り出す"""
+    if len(idx) == 0: return idx
+    codes = race_codes[idx]
+    return idx[np.r_[True, codes[1:] != codes[:-1]]]
+
+def select_strategy_bets(table, rules=None):
+    """
+    全期間の予測表から、戦略ごとの購入馬 (1レース最大1頭) の行番号を返す。
+    summarize_race と同じ選び方: 展開/穴は該当馬のうち AIスコア→生スコア順の先頭、鉄板は表示順の先頭がオッズ帯内なら。
+    """
+    rules = rules or BET_RULES
+    race_codes = pd.factorize(table['race_id'])[0]
+    probs = table['AIスコア'].to_numpy(dtype=float)
+    raw = table['raw_preds'].to_numpy(dtype=float)
+    odds = table['odds'].to_numpy(dtype=float)
+    hantei, hantei_ana = evaluate_bet_rules(probs, odds, table['is_pace_advantage'].to_numpy(), rules)
+    is_boost = (hantei == REC_PACE)
+
+    def first_of(mask, keys):
+        idx = np.flatnonzero(mask)
+        return group_first(idx[np.lexsort(tuple(k[idx] for k in keys) + (race_codes[idx],))], race_codes)
+
+    top = first_of(np.ones(len(table), dtype=bool), (-raw, -probs, -is_boost.astype(int)))
+    return {
+        'pace': first_of(is_boost, (-raw, -probs)),
+        'ai': top[(odds[top] >= rules['ai']['odds_min']) & (odds[top] <= rules['ai']['odds_max'])],
+        'hole': first_of(hantei_ana == REC_HOLE, (-raw, -probs)),
+    }
+
+def evaluate_backtest(table, rules=None):
+    """戦略ごと・日ごとの購入数/的中(3着内)/単複回収額と、累積の的中率・回収率"""
+    cols = ['date', 'strategy', 'bets', 'hit_count', 'win_ret', 'place_ret']
+    if table.empty: return pd.DataFrame(columns=cols)
+    table = table[table['has_result']].reset_index(drop=True)
+    picks = select_strategy_bets(table, rules)
+    rank = table['rank'].to_numpy()
+    frames = []
+    for strategy, idx in picks.items():
+        frames.append(pd.DataFrame({
+            'date': table['date'].to_numpy()[idx], 'strategy': strategy, 'bets': 1,
+            'hit_count': (rank[idx] <= 3).astype(int),
+            'win_ret': np.where(rank[idx] == 1, table['win_pay'].to_numpy()[idx], 0),
+            'place_ret': np.where(rank[idx] <= 3, table['place_pay'].to_numpy()[idx], 0),
+        }))
+    bets = pd.concat(frames, ignore_index=True)
+    daily = bets.groupby(['strategy', 'date'], as_index=False)[['bets', 'hit_count', 'win_ret', 'place_ret']].sum()
+    cum = daily.groupby('strategy')[['bets', 'hit_count', 'win_ret', 'place_ret']].cumsum()
+    daily['hit_rate'] = daily['hit_count'] / daily['bets'] * 100
+    daily['win_roi'] = daily['win_ret'] / (daily['bets'] * 100) * 100
+    daily['place_roi'] = daily['place_ret'] / (daily['bets'] * 100) * 100
+    daily['cum_hit_rate'] = cum['hit_count'] / cum['bets'] * 100
+    daily['cum_win_roi'] = cum['win_ret'] / (cum['bets'] * 100) * 100
+    daily['cum_place_roi'] = cum['place_ret'] / (cum['bets'] * 100) * 100
+    return daily.sort_values(['date', 'strategy']).reset_index(drop=True)
+
+def summarize_backtest(daily):
+    """render_report_card_dual 用の期間合計 {strategy: (的中数, 購入数, 単勝回収率, 複勝回収率)}"""
+    out = {}
+    for strategy in STRATEGY_LABELS:
+        d = daily[daily['strategy'] == strategy]
+        bets = int(d['bets'].sum())
+        if bets == 0: out[strategy] = (0, 0, 0.0, 0.0); continue
+        out[strategy] = (int(d['hit_count'].sum()), bets, d['win_ret'].sum() / (bets * 100) * 100, d['place_ret'].sum() / (bets * 100) * 100)
+    return out
+
+def run_backtest_job(job, start_date, end_date, model, encoders, engine):
+    """
+    ★変更: ライブのスキャン (出馬表スクレイピング + 全期間統計) を使わず、
+    DB の as-of 特徴量を期間分まとめて作り、日ごとにバッチで予測する。保存済みの日はそれを読む
+    """
+    try:
+        dates = [start_date + datetime.timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+        job.total = len(dates)
+        paths = {d: backtest_day_path(d.strftime('%Y%m%d'), model) for d in dates}
+        missing = [d for d in dates if not os.path.exists(paths[d])]
+        by_day = {}
+        if missing:
+            job.stage_line = "DB から特徴量を作成中..."
+            frame = backtest_feature_frame(missing[0], missing[-1], encoders, engine)
+            if not frame.empty: by_day = {k: v for k, v in frame.groupby('date_str', sort=False)}
+        tables = []
+        for i, d in enumerate(dates):
+            if job.cancel_event.is_set(): break
+            date_str = d.strftime('%Y%m%d')
+            if os.path.exists(paths[d]): day = pd.read_parquet(paths[d])
+            elif date_str in by_day:
+                job.stage_line = f"{d.strftime('%Y/%m/%d')} を予測中..."
+                rows = by_day.pop(date_str)
+                day = score_backtest_day(rows, model, fetch_backtest_results(rows['race_id'].unique().tolist()))
+                # 払戻が全レース取れた日だけ保存する (取れなかった日は次回取り直す)
+                if day['has_result'].all():
+                    os.makedirs(os.path.dirname(paths[d]), exist_ok=True)
+                    day.to_parquet(paths[d], index=False)
+            else: day = pd.DataFrame() # DB に結果が無い日 (開催なし・未取り込み)
+            if not day.empty: tables.append(day)
+            job.completed = i + 1
+        table = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+        job.state = {'table': table, 'daily': evaluate_backtest(table), 'start': start_date, 'end': end_date}
+        job.status = 'cancelled' if job.cancel_event.is_set() else 'done'
+    except Exception as e:
+        job.error = str(e)
+        job.status = 'error'
+    finally:
+        job.finished = time.time()
+        get_metrics().observe('keiba_scan_duration_seconds', job.finished - job.started, status=job.status)
+
+def render_backtest_panel(model, encoders, engine):
+    with st.expander("📊 期間バックテスト", expanded=False):
+        st.caption("DB に結果のある期間の全レースを、各レースの前日までの成績だけで作った特徴量 (学習データと同じ as-of 集計) で予測し (保存済みの日は再利用)、3つの戦略の日別・累積の的中率と回収率を集計します")
+        today = datetime.date.today()
+        period = st.date_input("期間", (today - datetime.timedelta(days=30), today - datetime.timedelta(days=1)), key="backtest_period")
+        manager = get_scan_job_manager()
+        if st.button("▶ バックテスト開始", key="backtest_start", disabled=not model) and isinstance(period, (list, tuple)) and len(period) == 2:
+            st.session_state.backtest_job_key = manager.submit_backtest(period[0], period[1], model, encoders, engine).key
+
+        job = manager.get(st.session_state.get('backtest_job_key')) if st.session_state.get('backtest_job_key') else None
+        if not job: return
+        if job.status == 'running':
+            render_scan_job_progress(job)
+            return
+        if job.status == 'error':
+            st.error(f"バックテストに失敗しました: {job.error}"); return
+
+        daily = job.state['daily']
+        if daily.empty:
+            st.info("結果の確定したレースがありません"); return
+        if job.status == 'cancelled': st.warning("⏹ 中止しました (取得済みの日だけの集計です)")
+        st.markdown(f"**{job.state['start'].strftime('%Y/%m/%d')} ～ {job.state['end'].strftime('%Y/%m/%d')}** / {job.state['table']['race_id'].nunique()}レース")
+        summary = summarize_backtest(daily)
+        for col, (strategy, label) in zip(st.columns(3), STRATEGY_LABELS.items()):
+            with col: st.markdown(render_report_card_dual(label, *summary[strategy]), unsafe_allow_html=True)
+        chart = daily.assign(date=pd.to_datetime(daily['date']), strategy=daily['strategy'].map(STRATEGY_LABELS))
+        st.markdown("##### 累積回収率 (単勝)")
+        st.line_chart(chart.pivot(index='date', columns='strategy', values='cum_win_roi'))
+        st.markdown("##### 累積回収率 (複勝)")
+        st.line_chart(chart.pivot(index='date', columns='strategy', values='cum_place_roi'))
+        with st.expander("日別の集計", expanded=False):
+            st.dataframe(chart.rename(columns={'date': '日付', 'strategy': '戦略', 'bets': '購入', 'hit_count': '的中(3着内)',
+                                               'hit_rate': '的中率', 'win_roi': '単勝回収率', 'place_roi': '複勝回収率',
+                                               'cum_hit_rate': '累積的中率', 'cum_win_roi': '累積単勝回収率', 'cum_place_roi': '累積複勝回収率'}),
+                         hide_index=True, use_container_width=True)
+
+# ---------------------------------------------------------
+# ★追加: 判定ルールのグリッドサーチ (保存済みの予測・オッズ・払戻だけを使い、スクレイピングもモデルも通さない)
+# ---------------------------------------------------------
+RULE_GRID = {
+    'min_prob': np.round(np.arange(0.04, 0.305, 0.01), 2),
+    'odds_min': np.array([1.5, 2.0, 3.0, 4.0, 5.0, 7.0, 10.0, 15.0, 20.0, 30.0, 50.0]),
+    'odds_max': np.array([10.0, 15.0, 20.0, 30.0, 50.0, 80.0, 100.0, 150.0, 200.0]),
+}
+
+def load_backtest_table(model):
+    """保存済みのバックテスト予測 (このモデルバージョンの全日付。as-of 特徴量で予測したもの) をまとめて読む"""
+    day_dir = os.path.dirname(backtest_day_path('x', model))
+    if not os.path.isdir(day_dir): return pd.DataFrame()
+    files = sorted(f for f in os.listdir(day_dir) if f.endswith('.parquet'))
+    if not files: return pd.DataFrame()
+    return pd.concat([pd.read_parquet(os.path.join(day_dir, f)) for f in files], ignore_index=True)
+
+def rule_grid(strategy, grid=None):
+    """(min_prob, odds_min, odds_max) の全組み合わせ。鉄板はオッズ帯だけ (min_prob=0)"""
+    g = grid or RULE_GRID
+    probs = np.array([0.0]) if strategy == 'ai' else g['min_prob']
+    P, LO, HI = np.meshgrid(probs, g['odds_min'], g['odds_max'], indexing='ij')
+    keep = LO < HI
+    return np.column_stack([P[keep], LO[keep], HI[keep]])
+
+def grid_search_rules(table, strategy, combos=None, rules=None, chunk=256):
+    """
+    strategy ('pace' / 'hole' / 'ai') のしきい値を combos の全組み合わせで評価する。
+    他の戦略のルールは rules (既定: BET_RULES) に固定 (穴は展開ブースト該当馬を除く・鉄板は展開ブーストが先頭に来る並び順を使うため)。
+    組み合わせ × 出走馬 の真偽行列を作り、レースごとの「最初に条件を満たす馬」を np.minimum.reduceat で一度に求める。
+    """
+    rules = rules or BET_RULES
+    combos = rule_grid(strategy) if combos is None else np.asarray(combos, dtype=float).reshape(-1, 3)
+    table = table[table['has_result']].reset_index(drop=True)
+    cols = ['min_prob', 'odds_min', 'odds_max', 'bets', 'hit_count', 'hit_rate', 'win_roi', 'place_roi']
+    if table.empty or len(combos) == 0: return pd.DataFrame(columns=cols)
+
+    race_codes = pd.factorize(table['race_id'])[0]
+    probs = table['AIスコア'].to_numpy(dtype=float)
+    raw = table['raw_preds'].to_numpy(dtype=float)
+    odds = table['odds'].to_numpy(dtype=float)
+    pace_adv = table['is_pace_advantage'].to_numpy()
+    rank = table['rank'].to_numpy()
+    is_pace_base = evaluate_bet_rules(probs, odds, pace_adv, rules)[0] == REC_PACE
+
+    if strategy == 'ai':
+        # 候補は各レースの表示順の先頭1頭だけ。条件はそのオッズだけ
+        order = group_first(np.lexsort((-raw, -probs, -is_pace_base.astype(int), race_codes)), race_codes)
+        base_mask = np.ones(len(order), dtype=bool)
+        starts = np.arange(len(order))
+    else:
+        order = np.lexsort((-raw, -probs, race_codes))
+        base_mask = (pace_adv[order] == 1) if strategy == 'pace' else ~is_pace_base[order]
+        starts = np.flatnonzero(np.r_[True, race_codes[order][1:] != race_codes[order][:-1]])
+
+    p, o, r = probs[order], odds[order], rank[order]
+    n = len(order)
+    # 末尾に「該当なし」用の 0 を足しておき、番兵 n で引けるようにする
+    hit = np.r_[(r <= 3).astype(int), 0]
+    win_ret = np.r_[np.where(r == 1, table['win_pay'].to_numpy()[order], 0), 0]
+    place_ret = np.r_[np.where(r <= 3, table['place_pay'].to_numpy()[order], 0), 0]
+
+    out = []
+    for i in range(0, len(combos), chunk):
+        c = combos[i:i + chunk]
+        eligible = base_mask & (p >= c[:, [0]]) & (o >= c[:, [1]]) & (o <= c[:, [2]])
+        first = np.minimum.reduceat(np.where(eligible, np.arange(n), n), starts, axis=1)
+        bets = (first < n).sum(axis=1)
+        out.append(np.column_stack([c, bets, hit[first].sum(axis=1), win_ret[first].sum(axis=1), place_ret[first].sum(axis=1)]))
+    res = pd.DataFrame(np.vstack(out), columns=['min_prob', 'odds_min', 'odds_max', 'bets', 'hit_count', 'win_ret', 'place_ret'])
+    res[['bets', 'hit_count']] = res[['bets', 'hit_count']].astype(int)
+    stake = (res['bets'] * 100).where(res['bets'] > 0)
+    res['hit_rate'] = (res['hit_count'] / res['bets'].where(res['bets'] > 0) * 100).fillna(0)
+    res['win_roi'] = (res['win_ret'] / stake * 100).fillna(0)
+    res['place_roi'] = (res['place_ret'] / stake * 100).fillna(0)
+    return res[cols]
+
+def split_holdout(table, holdout_days):
+    """日付順に分け、最後の holdout_days 日を検証期間にする。戻り値: (調整期間の表, 検証期間の表)"""
+    days = np.sort(table['date'].unique())
+    is_holdout = table['date'].isin(days[len(days) - holdout_days:]) if holdout_days > 0 else np.zeros(len(table), dtype=bool)
+    return table[~is_holdout].reset_index(drop=True), table[is_holdout].reset_index(drop=True)
+
+def baseline_rule(strategy, rules=None):
+    r = (rules or BET_RULES)[strategy]
+    return [r.get('min_prob', 0.0), r['odds_min'], r['odds_max']]
+
+def render_rule_optimizer(model):
+    with st.expander("🎛 判定ルールの最適化", expanded=False):
+        table = load_backtest_table(model)
+        if table.empty:
+            st.info("保存済みの予測がありません。先に「📊 期間バックテスト」を実行してください"); return
+        n_days = table['date'].nunique()
+        st.caption(f"保存済みの予測 {n_days}日 / {table['race_id'].nunique()}レース (as-of 特徴量) で、しきい値の組み合わせを一括評価します (スクレイピング・モデル計算なし)")
+        if n_days < 2:
+            st.info("検証期間を取るため、2日以上のバックテストを実行してください"); return
+        c1, c2, c3, c4 = st.columns(4)
+        with c1: strategy = st.selectbox("戦略", list(STRATEGY_LABELS.keys()), format_func=STRATEGY_LABELS.get, key="opt_strategy")
+        with c2: objective = st.selectbox("目的", ['win_roi', 'place_roi', 'hit_rate'], format_func={'win_roi': '単勝回収率', 'place_roi': '複勝回収率', 'hit_rate': '的中率'}.get, key="opt_objective")
+        with c3: min_bets = st.number_input("最低購入数", min_value=1, value=30, step=10, key="opt_min_bets")
+        with c4: holdout_days = st.number_input("検証期間 (直近の日数)", min_value=1, max_value=n_days - 1, value=max(1, n_days // 3), key="opt_holdout_days")
+        if not st.button("🔎 探索する", key="opt_run"): return
+
+        # ★追加: しきい値は前半 (調整期間) だけで選び、その後の検証期間の成績は選択に使わない
+        t0 = time.time()
+        tune, holdout = split_holdout(table, int(holdout_days))
+        combos = rule_grid(strategy)
+        grid = grid_search_rules(tune, strategy, combos)
+        ranked = grid[grid['bets'] >= min_bets].sort_values([objective, 'bets'], ascending=False).head(20).reset_index(drop=True)
+        checked = grid_search_rules(holdout, strategy, ranked[['min_prob', 'odds_min', 'odds_max']].to_numpy())
+        ranked = ranked.join(checked[['bets', 'hit_rate', 'win_roi', 'place_roi']].add_prefix('holdout_'))
+        baseline = pd.concat([grid_search_rules(t, strategy, [baseline_rule(strategy)]).assign(period=label)
+                              for t, label in [(tune, '調整'), (holdout, '検証')]], ignore_index=True)
+        st.caption(f"{len(combos):,} 通りを {time.time() - t0:.2f} 秒で評価 / 調整 {tune['date'].min()}～{tune['date'].max()} ・ 検証 {holdout['date'].min()}～{holdout['date'].max()}")
+
+        names = {'min_prob': '最低勝率', 'odds_min': 'オッズ下限', 'odds_max': 'オッズ上限', 'bets': '購入数',
+                 'hit_count': '的中(3着内)', 'hit_rate': '的中率', 'win_roi': '単勝回収率', 'place_roi': '複勝回収率', 'period': '期間',
+                 'holdout_bets': '検証: 購入数', 'holdout_hit_rate': '検証: 的中率', 'holdout_win_roi': '検証: 単勝回収率', 'holdout_place_roi': '検証: 複勝回収率'}
+        st.markdown("**現在のルール (ベースライン)**")
+        st.dataframe(baseline.rename(columns=names), hide_index=True, use_container_width=True)
+        st.markdown(f"**調整期間の上位 {len(ranked)} 件 (検証期間の成績つき)**")
+        st.dataframe(ranked.rename(columns=names), hide_index=True, use_container_width=True)
+        st.caption("※ 順位は調整期間だけで決めています。検証期間でもベースラインを上回るものだけ BET_RULES に反映してください")
+
+# ---------------------------------------------------------
+# ★変更: スキャン結果の表示 (回収率カード + 3つのリスト)
+# スキャン中は render_scan_job_progress から途中結果を渡して呼ぶ (live=True: ウィジェットのキーを分け、スクロールしない)
+# ---------------------------------------------------------
+def get_rois(d):
+    b = d['bets']; 
+    if b == 0: return 0, 0, 0.0, 0.0
+    return d['hit_count'], b, (d['win_ret']/(b*100))*100, (d['place_ret']/(b*100))*100
+
+def render_roi_cards(stats, hits_details, live=False, simulation=None):
+    if not stats: return
+    prefix = 'live_' if live else ''
+    st.markdown(f"### 📈 回収率シミュレーション" + (" (集計中)" if live else ""))
+    for col, (cat, label) in zip(st.columns(3), [('pace', "🚀 展開ブースト"), ('ai', "🦄 鉄板の軸"), ('hole', "💣 穴馬ブースト")]):
+        w, b, roi_w, roi_p = get_rois(stats[cat])
+        with col:
+            st.markdown(render_report_card_dual(label, w, b, roi_w, roi_p), unsafe_allow_html=True)
+            sim = (simulation or {}).get(cat)
+            if sim: # ★追加: レース前でも見られる予測値 (モンテカルロの90%区間)
+                st.caption(f"🎲 予測 単勝回収率 {sim['roi_mean']:.0f}% ({sim['roi_lo']:.0f}〜{sim['roi_hi']:.0f}%) · "
+                           f"的中(3着内) {sim['hits_mean']:.1f}/{sim['bets']} ({sim['hits_lo']:.0f}〜{sim['hits_hi']:.0f}) · プラス収支 {sim['p_profit']:.0%}")
+            if st.button("🔽 リストを開く", key=f"{prefix}jump_{cat}", on_click=toggle_expander, args=(cat,), use_container_width=True): pass
+            if st.session_state.expander_states[cat] and not live: js_scroll_to(f'section_{cat}')
+    
+    with st.expander("🏆 的中実績の詳細", expanded=False):
+        if hits_details:
+            df_hits = pd.DataFrame(hits_details)
+            for tab, cat in zip(st.tabs(["🚀 展開ブースト", "🦄 鉄板", "💣 穴馬"]), ['pace', 'ai', 'hole']):
+                with tab:
+                    sub = df_hits[df_hits['戦略'] == cat]
+                    if not sub.empty: st.dataframe(sub, hide_index=True)
+                    else: st.info("該当なし")
+        else: st.info("的中なし")
+    st.divider()
+
+def render_scan_list(hits_list, mode, live=False):
+    prefix = 'live_' if live else ''
+    if not hits_list: st.info("集計中..." if live else "該当なし"); return
+    for item in hits_list:
+        hits_df = item['hits'].copy()
+        hits_df = hits_df.sort_values('馬番')
+        
+        with st.container():
+            c1, c2 = st.columns([0.15, 0.85])
+            with c1: st.markdown(render_grade_badge_html(item['grade']), unsafe_allow_html=True)
+            with c2: st.markdown(f"#### {item['race']}")
+            
+            for idx, row in hits_df.iterrows():
+                st.markdown(render_ai_list_item(row, row.get('overlap_badges', [])), unsafe_allow_html=True)
+                    
+            if st.button(f"詳細を見る ➡️", key=f"{prefix}btn_{mode}_{item['race']}"):
+                st.session_state.selected_race_url = item['url']
+                st.session_state.selected_race_name = item['race']
+                st.session_state.view_mode = 'detail' # Switch to detail mode
+                st.session_state.auto_predict = True
+                st.rerun()
+        st.divider()
+    
+    if st.button(f"🔼 リストを閉じる", key=f"{prefix}close_{mode}", on_click=toggle_expander, args=(mode,), use_container_width=True): pass
+
+def render_scan_lists(results, live=False):
+    st.markdown(render_ev_legend(), unsafe_allow_html=True)
+    st.markdown(render_badge_legend(), unsafe_allow_html=True)
+    for mode, title in [('pace', "🚀 展開ブースト (ROI 110%〜)"), ('ai', "🦄 鉄板の軸 (ROI 80%)"), ('hole', "💣 穴馬ブースト (ROI 87%)")]:
+        if not live: st.markdown(f'<div id="section_{mode}"></div>', unsafe_allow_html=True)
+        with st.expander(title, expanded=st.session_state.expander_states[mode]):
+            # スキャン中は届いた順に増えていくので、毎回発走時刻で並べ直す (元のリストはスキャン側が更新中なのでコピー)
+            hits = sorted(list(results[mode]), key=lambda x: x.get('time', '99:99')) if live else results[mode]
+            render_scan_list(hits, mode, live)
 
 def toggle_expander(key):
     if key in st.session_state.expander_states:
         st.session_state.expander_states[key] = not st.session_state.expander_states[key]
 
 def main():
+    warmup = start_warmup() # ★追加: 最初のセッションでモデル等の読み込みを裏で始める
     load_custom_css()
+    start_metrics_exporter() # ★追加: data/metrics/app.prom (と METRICS_PORT の /metrics)
     
-    video_files = ["resource/競馬シーン_サイト埋め込み用動画.mp4", "resource/競馬シーン_サイト埋め込み用動画_2.mp4", "resource/競馬シーン_サイト埋め込み用動画_3.mp4","resource/競馬シーン_サイト埋め込み用動画_4.mp4"]
-    b64 = get_base64_video(video_files)
-    video_src = f"data:video/mp4;base64,{b64}" if b64 else "https://videos.pexels.com/video-files/5230349/5230349-uhd_2560_1440_25fps.mp4"
+    video_files = ["競馬シーン_サイト埋め込み用動画.mp4", "競馬シーン_サイト埋め込み用動画_2.mp4", "競馬シーン_サイト埋め込み用動画_3.mp4", "競馬シーン_サイト埋め込み用動画_4.mp4"]
+    video_src = header_video_url(video_files) # ★変更: static/ の URL (base64 埋め込みをやめた)
     
     # YouTube random
     yt_ids = ["TZXtiFh3AM8", "7omyMKRLIrc", "tMHitvVB4lU"]
@@ -1997,7 +4423,7 @@ def main():
     st.markdown(f"""
         <div class="header-container">
             <div class="video-background">
-                <video src="{video_src}" autoplay loop muted playsinline></video>
+                <video src="{video_src}" autoplay loop muted playsinline preload="auto"></video>
             </div>
             <div class="header-overlay"></div>
             <div class="header-content">
@@ -2009,12 +4435,23 @@ def main():
     
     with st.sidebar:
         st.header("System Status")
-        model, encoders, engine, logs = load_resources(0)
+        if warmup.done.is_set(): model, encoders, engine, logs = load_resources(model_artifact_mtime())
+        else:
+            with st.spinner("モデルとデータを準備中…"): model, encoders, engine, logs = load_resources(model_artifact_mtime())
         if model: 
-            model_name = os.path.basename(MODEL_PATH)
-            st.success(f"✅ Model Loaded: {model_name}")
+            model_name = COMPACT_MODEL_DIR if logs.get('format') == 'compact' else os.path.basename(MODEL_PATH)
+            st.success(f"✅ Model Loaded: {model_name} ({model.get('version', '-')})")
             render_feature_importance_sidebar(model)
+            st.checkbox("⚡ 解析をマルチプロセスで実行", key='use_process_pool',
+                        help=f"出馬表の解析と特徴量作成を {SCAN_PROCESS_WORKERS} プロセスで並列実行します (初回はプロセス起動に数秒かかります)")
         else: st.error("Model Load Failed")
+        # ★追加: 予測キャッシュの状況 (全セッション共通)
+        prediction_cache = get_prediction_cache().view((model or {}).get('version', '-'))
+        cs = get_prediction_cache().stats()
+        st.caption(f"🗃 予測キャッシュ: {cs['entries']}件 / {cs['mb']:.0f}MB (上限 {PREDICTION_CACHE_MB}MB) · ヒット率 {cs['hit_rate']:.0%} · 追い出し {cs['evictions']}")
+        # ★追加: 処理時間のトレース (全セッション共通の設定。次のスキャンから有効)
+        set_tracing(st.checkbox("⏱ 処理時間を計測 (トレース)", value=tracing_enabled(),
+                                help="ステージ・通信・SQL・推論ごとの時間を記録し、スキャン後に内訳を表示します (data/traces に JSON lines も保存)"))
 
     if 'race_list' not in st.session_state: st.session_state.race_list = []
     if 'selected_race_url' not in st.session_state: st.session_state.selected_race_url = ""
@@ -2027,7 +4464,13 @@ def main():
     if 'expander_states' not in st.session_state: st.session_state.expander_states = {'pace': True, 'hole': False, 'ai': False}
     if 'missing_data' not in st.session_state: st.session_state.missing_data = {'jockey': set(), 'trainer': set()}
     if 'trainer_debug_all' not in st.session_state: st.session_state.trainer_debug_all = pd.DataFrame()
-    if 'prediction_cache' not in st.session_state: st.session_state.prediction_cache = {}
+    if 'scanned_race_urls' not in st.session_state: st.session_state.scanned_race_urls = []
+    if 'scan_job_key' not in st.session_state: st.session_state.scan_job_key = None
+    if 'applied_scan_job' not in st.session_state: st.session_state.applied_scan_job = None
+    if 'missing_races' not in st.session_state: st.session_state.missing_races = []
+    if 'scan_cancelled' not in st.session_state: st.session_state.scan_cancelled = False
+    if 'roi_simulation' not in st.session_state: st.session_state.roi_simulation = {}
+    if 'scan_trace' not in st.session_state: st.session_state.scan_trace = None
     
     st.markdown('<div class="input-panel">', unsafe_allow_html=True)
     st.markdown("### 📅 Race Selection")
@@ -2041,6 +4484,7 @@ def main():
                 # Reset view but keep nothing until scan
                 st.session_state.scan_results = None 
                 st.session_state.report_stats = None
+                st.session_state.scan_job_key = None
                 st.session_state.view_mode = 'list'
                 if not st.session_state.race_list: st.toast("レース情報なし", icon="⚠️")
                 else: st.toast(f"{len(st.session_state.race_list)} 件取得", icon="✅")
@@ -2048,6 +4492,12 @@ def main():
         st.markdown("<br>", unsafe_allow_html=True)
         
         scan_label = "🚀 全レース一括スキャン"
+        stored_job = get_scan_job_manager().get_or_load(target_date, model) if model else None
+        has_stored = bool(stored_job and stored_job.status == 'done' and stored_job.state.get('race_list'))
+        if has_stored:
+            # ★追加: 事前スキャン済み (scan_daemon.py) ならそれを表示する。再スキャンは明示的に選んだときだけ
+            st.caption(f"🗂 事前スキャン済み ({datetime.datetime.fromtimestamp(stored_job.finished).strftime('%m/%d %H:%M')} 更新)")
+            scan_label = "🔁 全レースを再スキャン"
         if st.button(scan_label, use_container_width=True):
             with st.spinner("開催情報を取得中..."):
                 current_race_list = get_race_list_by_date(target_date)
@@ -2059,16 +4509,34 @@ def main():
                 st.session_state.race_list = current_race_list
                 st.session_state.report_stats = None 
                 st.session_state.scan_results = None
+                st.session_state.applied_scan_job = None # 完了済みジョブに合流した場合も結果を反映し直す
                 
-                # ★変更: len(current_race_list) ではなく len(scan_targets) を表示
-                with st.spinner(f"AIが全集中で予想中... (対象: {len(scan_targets)}レース)"):
-                    results = scan_races(target_date, current_race_list, model, encoders, engine)
-                    st.session_state.scan_results = results
-                    st.session_state.view_mode = 'list'
-                    st.rerun()
+                # ★変更: バックグラウンドのジョブとして開始 (同じ日付が実行中/完了済みならそれに合流する)
+                pool = get_process_pool() if st.session_state.get('use_process_pool') else None
+                job = get_scan_job_manager().submit(target_date, current_race_list, model, encoders, engine, pool=pool, force=has_stored)
+                st.session_state.scan_job_key = job.key
+                st.toast(f"スキャン開始 (対象: {len(scan_targets)}レース)", icon="🚀")
             else:
                 st.error("レース情報が見つかりませんでした。開催日を確認してください。")
 
+    # ★追加: 他のセッションが同じ日付をスキャン済み/スキャン中なら合流する (ブラウザ更新後もここで復帰)
+    scan_manager = get_scan_job_manager()
+    if model and not st.session_state.scan_job_key and scan_manager.get_or_load(target_date, model):
+        st.session_state.scan_job_key = scan_job_key(target_date, model)
+    scan_job = scan_manager.get(st.session_state.scan_job_key) if st.session_state.scan_job_key else None
+    if scan_job and scan_job.status != 'running' and model and scan_job.key == scan_job_key(scan_job.target_date, model):
+        scan_job = scan_manager.get_or_load(scan_job.target_date, model) or scan_job # 事前スキャンが更新されていれば差し替える
+    if scan_job:
+        if scan_job.status == 'running':
+            st.info(f"🏇 AIが全集中で予想中... ({scan_job.target_date.strftime('%Y/%m/%d')} / 対象: {scan_job.total or '-'}レース)")
+            render_scan_job_progress(scan_job)
+            render_waiting_trivia()
+        elif scan_job.status in ('done', 'cancelled') and st.session_state.applied_scan_job != (scan_job.key, scan_job.finished):
+            apply_scan_job(scan_job)
+        elif scan_job.status == 'error':
+            st.error(f"スキャンに失敗しました: {scan_job.error}")
+    with st.sidebar: render_trace_sidebar() # ★追加: 反映したスキャンの処理時間の内訳
+
     # --- View Mode Control ---
     if st.session_state.view_mode == 'list' and st.session_state.scan_results:
         # Show Results
@@ -2077,6 +4545,12 @@ def main():
             st.session_state.scan_results = None
             st.session_state.report_stats = None
             st.rerun()
+        # ★追加: 予測はキャッシュを使い、最新オッズで判定・BUY対象だけを再計算する
+        if st.button("💹 最新オッズで再判定 (予測は再計算しません)", key="reprice_scan"):
+            with st.spinner("オッズを取得中..."):
+                st.session_state.scan_results = reprice_scan_results(st.session_state.scanned_race_urls, prediction_cache)
+                st.session_state.roi_simulation = simulate_scan_roi(st.session_state.scan_results, prediction_cache)
+            st.rerun()
         
         missing = st.session_state.missing_data
         if missing['jockey'] or missing['trainer']:
@@ -2103,89 +4577,15 @@ def main():
                         code_str += f'"{m}": "???", # 候補: {cands}\n'
                 st.code(code_str, language='python')
 
-        stats = st.session_state.report_stats
-        if stats:
-            st.markdown(f"### 📈 回収率シミュレーション")
-            r1, r2, r3 = st.columns(3)
-            def get_rois(d):
-                b = d['bets']; 
-                if b == 0: return 0, 0, 0.0, 0.0
-                return d['hit_count'], b, (d['win_ret']/(b*100))*100, (d['place_ret']/(b*100))*100
-
-            w1, b1, roi_w1, roi_p1 = get_rois(stats['pace'])
-            with r1:
-                st.markdown(render_report_card_dual("🚀 展開ブースト", w1, b1, roi_w1, roi_p1), unsafe_allow_html=True)
-                if st.button("🔽 リストを開く", key="jump_pace", on_click=toggle_expander, args=('pace',), use_container_width=True): pass
-                if st.session_state.expander_states['pace']: js_scroll_to('section_pace')
-
-            w3, b3, roi_w3, roi_p3 = get_rois(stats['ai'])
-            with r2:
-                st.markdown(render_report_card_dual("🦄 鉄板の軸", w3, b3, roi_w3, roi_p3), unsafe_allow_html=True)
-                if st.button("🔽 リストを開く", key="jump_ai", on_click=toggle_expander, args=('ai',), use_container_width=True): pass
-                if st.session_state.expander_states['ai']: js_scroll_to('section_ai')
-
-            w2, b2, roi_w2, roi_p2 = get_rois(stats['hole'])
-            with r3:
-                st.markdown(render_report_card_dual("💣 穴馬ブースト", w2, b2, roi_w2, roi_p2), unsafe_allow_html=True)
-                if st.button("🔽 リストを開く", key="jump_hole", on_click=toggle_expander, args=('hole',), use_container_width=True): pass
-                if st.session_state.expander_states['hole']: js_scroll_to('section_hole')
-            
-            with st.expander("🏆 的中実績の詳細", expanded=False):
-                if st.session_state.hits_details:
-                    df_hits = pd.DataFrame(st.session_state.hits_details)
-                    t1, t2, t3 = st.tabs(["🚀 展開ブースト", "🦄 鉄板", "💣 穴馬"])
-                    with t1:
-                        sub = df_hits[df_hits['戦略'] == 'pace']
-                        if not sub.empty: st.dataframe(sub, hide_index=True)
-                        else: st.info("該当なし")
-                    with t2:
-                        sub = df_hits[df_hits['戦略'] == 'ai']
-                        if not sub.empty: st.dataframe(sub, hide_index=True)
-                        else: st.info("該当なし")
-                    with t3:
-                        sub = df_hits[df_hits['戦略'] == 'hole']
-                        if not sub.empty: st.dataframe(sub, hide_index=True)
-                        else: st.info("該当なし")
-                else: st.info("的中なし")
-            st.divider()
-
-        results = st.session_state.scan_results
-        st.markdown(render_ev_legend(), unsafe_allow_html=True)
-        st.markdown(render_badge_legend(), unsafe_allow_html=True)
-        
-        def render_scan_list(hits_list, mode):
-            if not hits_list: st.info("該当なし"); return
-            for item in hits_list:
-                hits_df = item['hits'].copy()
-                hits_df = hits_df.sort_values('馬番')
-                
-                with st.container():
-                    c1, c2 = st.columns([0.15, 0.85])
-                    with c1: st.markdown(render_grade_badge_html(item['grade']), unsafe_allow_html=True)
-                    with c2: st.markdown(f"#### {item['race']}")
-                    
-                    for idx, row in hits_df.iterrows():
-                        st.markdown(render_ai_list_item(row, row.get('overlap_badges', [])), unsafe_allow_html=True)
-                            
-                    if st.button(f"詳細を見る ➡️", key=f"btn_{mode}_{item['race']}"):
-                        st.session_state.selected_race_url = item['url']
-                        st.session_state.selected_race_name = item['race']
-                        st.session_state.view_mode = 'detail' # Switch to detail mode
-                        st.session_state.auto_predict = True
-                        st.rerun()
-                st.divider()
-            
-            if st.button(f"🔼 リストを閉じる", key=f"close_{mode}", on_click=toggle_expander, args=(mode,), use_container_width=True): pass
+        # ★追加: 部分結果の明示 (タイムアウト・中止・エラーで結果が出なかったレース)
+        if st.session_state.missing_races:
+            head = "⏹ スキャンを中止しました。" if st.session_state.scan_cancelled else ""
+            st.warning(f"{head}⚠️ {len(st.session_state.missing_races)}レースは結果がありません (以下は取得できたレースのみの集計です)")
+            with st.expander("未取得のレース一覧", expanded=False):
+                st.dataframe(pd.DataFrame(st.session_state.missing_races).drop(columns=['url']), hide_index=True, use_container_width=True)
 
-        st.markdown('<div id="section_pace"></div>', unsafe_allow_html=True)
-        with st.expander("🚀 展開ブースト (ROI 110%〜)", expanded=st.session_state.expander_states['pace']):
-            render_scan_list(results['pace'], 'pace')
-        st.markdown('<div id="section_ai"></div>', unsafe_allow_html=True)
-        with st.expander("🦄 鉄板の軸 (ROI 80%)", expanded=st.session_state.expander_states['ai']):
-            render_scan_list(results['ai'], 'ai')
-        st.markdown('<div id="section_hole"></div>', unsafe_allow_html=True)
-        with st.expander("💣 穴馬ブースト (ROI 87%)", expanded=st.session_state.expander_states['hole']):
-            render_scan_list(results['hole'], 'hole')
+        render_roi_cards(st.session_state.report_stats, st.session_state.hits_details, simulation=st.session_state.roi_simulation)
+        render_scan_lists(st.session_state.scan_results)
 
 
 
@@ -2210,7 +4610,8 @@ def main():
 
     st.markdown('</div>', unsafe_allow_html=True)
     
-
+    render_backtest_panel(model, encoders, engine) # ★追加
+    if model: render_rule_optimizer(model)
 
     st.markdown("<br>", unsafe_allow_html=True)
     
@@ -2228,12 +4629,22 @@ def main():
                 st.rerun()
         
         st.markdown(f"### 🎯 AI Forecast: {st.session_state.selected_race_name or '指定レース'}")
+
+        # ★追加: キャッシュ済みの予測に最新オッズだけを当て直す
+        cached_data = prediction_cache.detail(target) # ★変更: 圧縮した予測データをここで元に戻す
+        if cached_data:
+            if st.button("💹 最新オッズで再判定", key="reprice_detail"):
+                rid_match = re.search(r'race_id=(\d+)', target)
+                odds_map = fetch_win_odds(rid_match.group(1) if rid_match else None)
+                if odds_map:
+                    cached_data = {**cached_data, 'res': reprice_race(cached_data['res'], odds_map)}
+                    prediction_cache[target] = cached_data
+                    st.toast("オッズを更新しました", icon="💹")
+                else: st.toast("オッズを取得できませんでした", icon="⚠️")
         
         # 予測実行
         with st.status("🔮 AIが全集中で予想中...", expanded=True) as status:
             # ★追加: キャッシュがあればそれを利用
-            cached_data = st.session_state.prediction_cache.get(target)
-            
             if cached_data:
                 st.write("📁 キャッシュからデータを読み込んでいます...")
                 res = cached_data['res']
@@ -2242,6 +4653,7 @@ def main():
                 diag_data = cached_data['diag_data']
                 missing_info = cached_data['missing_info']
                 trace_df = cached_data['trace_df']
+                contrib = cached_data.get('contrib', {})
             else:
                 st.write("📡 最新のレースデータを取得しています...")
                 render_waiting_trivia()
@@ -2249,7 +4661,11 @@ def main():
                 if df_in is not None and not df_in.empty:
                     try:
                         st.write("🧠 特徴量を生成し、AIモデルで評価しています...")
-                        res, debug, X_renamed, diag_data, missing_info, trace_df = predict_race(df_in, model, encoders, engine)
+                        res, debug, X_renamed, diag_data, missing_info, trace_df, contrib = predict_race(df_in, model, encoders, engine)
+                        prediction_cache[target] = {
+                            'res': res, 'debug': debug, 'X_renamed': X_renamed, 'diag_data': diag_data,
+                            'missing_info': missing_info, 'trace_df': trace_df, 'contrib': contrib
+                        }
                     except Exception as e:
                         st.error(f"予測エラー: {e}")
                         res = pd.DataFrame()
@@ -2324,19 +4740,17 @@ def main():
                         </div>
                         """, unsafe_allow_html=True)
                         
-                        pace_hits = res[res['判定'] == "🚀 展開ブースト"]
+                        pace_hits = res[res['判定'] == REC_PACE]
                         if not pace_hits.empty:
                             st.markdown("### 🚀 展開ブースト (ROI 110%↑🏆)")
                             for _, row in pace_hits.iterrows():
-                                ev_val = row['AIスコア'] * float(str(row['オッズ']).replace('-','0'))
-                                st.success(f"**#{row['馬番']} {row['馬名']}** ({row['騎手']}) - 単勝{row['オッズ']}倍 (EV: {ev_val:.2f}) - {row['BoostReason']}")
+                                st.success(f"**#{row['馬番']} {row['馬名']}** ({row['騎手']}) - 単勝{row['オッズ']}倍 (EV: {row['EV']:.2f}) - {row['BoostReason']}")
 
-                        hole_hits = res[res['判定_穴'] == "💣 穴馬ブースト"]
+                        hole_hits = res[res['判定_穴'] == REC_HOLE]
                         if not hole_hits.empty:
                             st.markdown("### 💣 穴馬ブースト")
                             for _, row in hole_hits.iterrows():
-                                ev_val = row['AIスコア'] * float(str(row['オッズ']).replace('-','0'))
-                                st.error(f"**#{row['馬番']} {row['馬名']}** ({row['騎手']}) - 単勝{row['オッズ']}倍 (EV: {ev_val:.2f})")
+                                st.error(f"**#{row['馬番']} {row['馬名']}** ({row['騎手']}) - 単勝{row['オッズ']}倍 (EV: {row['EV']:.2f})")
 
                         st.markdown("##### 📊 全頭診断リスト")
                         st.markdown(render_ev_legend(), unsafe_allow_html=True)
@@ -2353,7 +4767,7 @@ def main():
                         disp = disp.rename(columns={'sire_name':'父', 'bms_name':'母父', 'sire_win_rate':'父勝率', 'bms_win_rate':'母父勝率', 'trainer_win_rate':'厩舎勝率', 'jockey_win_rate': '騎手勝率', 'オッズ':'単勝'})
                         
                         st.dataframe(
-                            disp[['枠', '番', '馬名', '騎手', '騎手勝率', '調教師', '単勝', '判定', '判定_穴', 'AI Rating', 'AIスコア', 'BoostReason', '父', '父勝率', '母父', '母父勝率', '厩舎勝率']],
+                            disp[['枠', '番', '馬名', '騎手', '騎手勝率', '調教師', '単勝', '判定', '判定_穴', 'AI Rating', 'AIスコア', 'BoostReason', 'AI根拠', '父', '父勝率', '母父', '母父勝率', '厩舎勝率']],
                             column_config={
                                 "AI Rating": st.column_config.ProgressColumn("AI Rating (偏差値)", min_value=0, max_value=100),
                                 "AIスコア": st.column_config.NumberColumn("AI自信度(%)", format="%.1f%%"),
@@ -2361,10 +4775,18 @@ def main():
                                 "母父勝率": st.column_config.NumberColumn("母父勝率", format="%.1f%%"),
                                 "厩舎勝率": st.column_config.NumberColumn("厩舎勝率", format="%.1f%%"),
                                 "騎手勝率": st.column_config.NumberColumn("騎手勝率", format="%.1f%%"),
-                                "BoostReason": "注目点"
+                                "BoostReason": "注目点",
+                                "AI根拠": "AI根拠 (寄与上位)"
                             },
                             hide_index=True, use_container_width=True
                         )
+
+                        if contrib:
+                            render_contribution_detail(res, contrib)
+                        race_info = next((r for r in st.session_state.race_list if r['url'] == target), {})
+                        render_odds_drift(res, target, race_post_timestamp(target_date, race_info.get('time')), race_date=target_date)
+                        render_exotic_bets(res, target)
+                        render_race_simulation(res)
                         
                         csv = disp.to_csv(index=False).encode('utf-8_sig')
                         st.download_button(label="📥 予想結果をCSVでダウンロード", data=csv, file_name=f"prediction_{datetime.date.today()}.csv", mime="text/csv")
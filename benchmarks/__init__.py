@@ -0,0 +1,8 @@
+"""
+ベンチマーク一式
+
+fixtures.py : 合成の出馬表・オッズ・結果ページ、合成DB (SQLite)、合成モデル / 実ページの録画
+replay.py   : 録画したページを返すローカルHTTPサーバーと、netkeiba の URL をそこへ書き換える差し替え
+bench.py    : ステージ別の計測 (レイテンシ分位・レース/秒・ピークメモリ) と JSON 出力・ベースライン比較
+loadtest.py : 複数セッションの負荷試験 (フローごとのレイテンシ・メモリ・DB プールの飽和をセッション数ごとに)
+"""
@@ -0,0 +1,195 @@
+"""
+ステージ別ベンチマーク
+
+録画 (または合成) ページを replay サーバーから返し、合成DB (または --db-url の実DB) に対して
+取得 → 解析 → 過去走集計 → 特徴量 → 推論 → 結果取得、と scan_races 全体を計測する。
+各ステージ: レイテンシの分位 (p50/p90/p99)、レース/秒、ピークメモリ (tracemalloc)。結果は JSON。
+
+使い方:
+    python -m benchmarks.bench synth                          # 合成フィクスチャを作る (data/bench/fixtures)
+    python -m benchmarks.bench record --date 20240505         # 実ページを録画する
+    python -m benchmarks.bench run --out data/bench/result.json --baseline benchmarks/baseline.json
+    python -m benchmarks.bench run --save-baseline benchmarks/baseline.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import streamlit as st
+
+import app
+from benchmarks import fixtures, replay
+
+STAGES = ('race_list', 'fetch_page', 'fetch_odds', 'parse', 'horse_history', 'features', 'score', 'predict', 'result', 'scan')
+REGRESSION_THRESHOLD = 0.2 # p50 / スループット / ピークメモリが 20% 以上悪化したら回帰とみなす
+
+
+def percentile_summary(latencies, units, wall, peak_bytes):
+    lat = np.asarray(latencies) * 1000
+    return {'n': len(lat), 'mean_ms': float(lat.mean()), 'p50_ms': float(np.percentile(lat, 50)), 'p90_ms': float(np.percentile(lat, 90)),
+            'p99_ms': float(np.percentile(lat, 99)), 'max_ms': float(lat.max()), 'races_per_sec': units / wall if wall else 0.0,
+            'peak_mb': peak_bytes / 1024 / 1024 if peak_bytes is not None else None}
+
+
+def measure(fn, items, repeat=1, units=None, memory=True, memory_items=3):
+    """items を repeat 周まわして1件ずつ計る。各周の頭で st.cache_data を空にする (1周目と同じ冷えた状態から)"""
+    latencies = []
+    wall = 0.0
+    for _ in range(repeat):
+        st.cache_data.clear()
+        t_pass = time.perf_counter()
+        for item in items:
+            t0 = time.perf_counter()
+            fn(item)
+            latencies.append(time.perf_counter() - t0)
+        wall += time.perf_counter() - t_pass
+    peak = None
+    if memory:
+        st.cache_data.clear()
+        tracemalloc.start()
+        for item in items[:memory_items]: fn(item)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return percentile_summary(latencies, (units or len(items)) * repeat, wall, peak)
+
+
+def run(args):
+    index = fixtures.load_index(args.fixtures)
+    date = datetime.datetime.strptime(index['meta']['date'], '%Y%m%d').date()
+    engine = fixtures.sqlite_engine(os.path.join(args.fixtures, 'bench.db')) if not args.db_url else app.create_engine(args.db_url)
+    app.instrument_engine(engine) # 本番と同じく SQL のトレース用フックを付けておく (無効時のオーバーヘッドも計測に入る)
+    app.set_tracing(args.trace)
+    model, encoders = fixtures.load_model(args.fixtures)
+    server = replay.ReplayServer(args.fixtures, delay=args.delay).start()
+    stages = args.stages.split(',') if args.stages else STAGES
+    results = {}
+    with replay.install(app, server):
+        race_list = app.get_race_list_by_date(date)[:args.races]
+        if not race_list: sys.exit("レース一覧がフィクスチャにありません")
+        pages = [(r, app.get_html_content(r['url']), app.fetch_win_odds(r['id'], record=False)) for r in race_list]
+        frames = [app.parse_race_page(html, r['url'], odds) for r, html, odds in pages]
+        frames = [(r, df) for (r, _, _), df in zip(pages, frames) if df is not None and not df.empty]
+        features = [app.build_race_features(df.copy(), encoders, engine) for _, df in frames]
+
+        bench = {
+            'race_list': (lambda _: app.get_race_list_by_date(date), [None]),
+            'fetch_page': (lambda r: app.get_html_content(r['url']), race_list),
+            'fetch_odds': (lambda r: app.fetch_win_odds(r['id'], record=False), race_list), # 通信だけを測る (オッズ記録の書き出しは含めない)
+            'parse': (lambda p: app.parse_race_page(p[1], p[0]['url'], p[2]), pages),
+            'horse_history': (lambda f: app.calc_horse_history(engine, tuple(f[1]['馬名'].tolist()), f[1]['date'].iloc[0]), frames),
+            'features': (lambda f: app.build_race_features(f[1].copy(), encoders, engine), frames),
+            'score': (lambda f: app.score_race(f[0].copy(), model, *f[1:]), features),
+            'predict': (lambda f: app.predict_race(f[1].copy(), model, encoders, engine), frames),
+            'result': (lambda r: app.scrape_race_result(r['id']), race_list),
+        }
+        for name in stages:
+            if name == 'scan' or name not in bench: continue
+            fn, items = bench[name]
+            t0 = time.time()
+            results[name] = measure(fn, items, repeat=args.repeat, memory=not args.no_memory)
+            print(f"  {name:<14} p50 {results[name]['p50_ms']:8.1f}ms  p90 {results[name]['p90_ms']:8.1f}ms  "
+                  f"{results[name]['races_per_sec']:8.1f} races/s  ({time.time() - t0:.1f}s)", flush=True)
+
+        if 'scan' in stages:
+            def scan(_):
+                job = app.ScanJob('bench', date)
+                state = app.scan_races(job, race_list, model, encoders, engine)
+                app.clear_checkpoints(app.checkpoint_dir(date, model)) # 次の周も最初から
+                return state
+            results['scan'] = measure(scan, [None], repeat=args.repeat, units=len(race_list), memory=not args.no_memory, memory_items=1)
+            print(f"  {'scan':<14} {results['scan']['p50_ms'] / 1000:8.1f}s / {len(race_list)} races  {results['scan']['races_per_sec']:.2f} races/s", flush=True)
+    server.stop()
+    if server.misses: print(f"⚠ 録画に無いページ {server.misses} 件 (その分は取得失敗として計測されています)")
+
+    output = {'meta': {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': git_commit(), 'python': platform.python_version(),
+                       'platform': platform.platform(), 'fixtures': index['meta'].get('source'), 'races': len(race_list), 'repeat': args.repeat,
+                       'model_version': model.get('version', '-'), 'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                       'replay_hits': server.hits, 'replay_misses': server.misses, 'trace': args.trace},
+              'stages': results}
+    if args.out:
+        os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+        with open(args.out, 'w', encoding='utf-8') as f: json.dump(output, f, ensure_ascii=False, indent=1)
+        print(f"saved {args.out}")
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f: json.dump(output, f, ensure_ascii=False, indent=1)
+        print(f"saved baseline {args.save_baseline}")
+    if args.baseline:
+        regressions = compare(output, args.baseline, args.threshold)
+        if regressions and args.fail_on_regression: sys.exit(1)
+    return output
+
+
+def compare(current, baseline_path, threshold=REGRESSION_THRESHOLD):
+    """ベースラインとの比較を表示し、回帰したステージ名のリストを返す"""
+    with open(baseline_path, encoding='utf-8') as f: baseline = json.load(f)
+    print(f"\nvs baseline {baseline['meta'].get('commit', '-')[:10]} ({baseline['meta'].get('timestamp', '-')})")
+    regressions = []
+    for name, cur in current['stages'].items():
+        base = baseline['stages'].get(name)
+        if not base: continue
+        checks = [('p50', cur['p50_ms'] / base['p50_ms'] - 1 if base['p50_ms'] else 0.0),
+                  ('races/s', 1 - cur['races_per_sec'] / base['races_per_sec'] if base['races_per_sec'] else 0.0)]
+        if cur.get('peak_mb') and base.get('peak_mb'): checks.append(('peak', cur['peak_mb'] / base['peak_mb'] - 1))
+        worse = [f"{label} {delta:+.0%}" for label, delta in checks if delta > threshold]
+        if worse: regressions.append(name)
+        print(f"  {name:<14} p50 {base['p50_ms']:8.1f} → {cur['p50_ms']:8.1f}ms  races/s {base['races_per_sec']:7.1f} → {cur['races_per_sec']:7.1f}  "
+              + (f"⚠ {', '.join(worse)}" if worse else "ok"))
+    return regressions
+
+
+def git_commit():
+    try: return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception: return '-'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ステージ別ベンチマーク")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_synth = sub.add_parser('synth', help="合成フィクスチャ (ページ・DB・モデル) を作る")
+    p_synth.add_argument('--fixtures', default=fixtures.FIXTURE_DIR)
+    p_synth.add_argument('--races', type=int, default=36)
+    p_synth.add_argument('--horses', type=int, default=2000)
+    p_synth.add_argument('--history-races', type=int, default=3000, help="合成DBに入れる過去レース数")
+    p_synth.add_argument('--seed', type=int, default=0)
+
+    p_record = sub.add_parser('record', help="実ページを録画する")
+    p_record.add_argument('--fixtures', default=fixtures.FIXTURE_DIR)
+    p_record.add_argument('--date', required=True, help="YYYYMMDD")
+
+    p_run = sub.add_parser('run', help="計測する")
+    p_run.add_argument('--fixtures', default=fixtures.FIXTURE_DIR)
+    p_run.add_argument('--db-url', default=None, help="実DBで計測する場合 (省略時は合成DB)")
+    p_run.add_argument('--races', type=int, default=36)
+    p_run.add_argument('--repeat', type=int, default=3)
+    p_run.add_argument('--stages', default=None, help=f"カンマ区切り ({','.join(STAGES)})")
+    p_run.add_argument('--delay', type=float, default=0.0, help="replay サーバーの擬似遅延(秒)")
+    p_run.add_argument('--no-memory', action='store_true', help="tracemalloc によるピークメモリ計測を省く")
+    p_run.add_argument('--trace', action='store_true', help="トレースを有効にして計測する (オーバーヘッドの確認用)")
+    p_run.add_argument('--out', default='data/bench/result.json')
+    p_run.add_argument('--baseline', default=None)
+    p_run.add_argument('--save-baseline', default=None)
+    p_run.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    p_run.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args()
+
+    if args.command == 'synth':
+        races = fixtures.build(args.fixtures, n_races=args.races, n_horses=args.horses, history_races=args.history_races, seed=args.seed)
+        print(f"saved {len(races)} races -> {args.fixtures}")
+    elif args.command == 'record':
+        races = fixtures.record(args.fixtures, datetime.datetime.strptime(args.date, '%Y%m%d').date())
+        print(f"recorded {len(races)} races -> {args.fixtures}")
+    else:
+        run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""
+ベンチマーク用のフィクスチャ
+
+- 合成DB: raw_race_results / horses を持つ SQLite ファイル (REGEXP_REPLACE は Python 関数で代用)
+- 合成ページ: レース一覧・出馬表・単勝オッズAPI・結果ページを、app のパーサーが読める形で生成する
+- 合成モデル: DEFAULT_FEATURES で学習した小さな LightGBM + isotonic (本番モデルが無い環境用)
+- 録画: 実際の netkeiba のページを取得して同じ形式で保存する (replay.py でそのまま再生できる)
+
+ページは index.json に {正規化URL: ファイル名} で登録する。URL の正規化はキャッシュ回避用の "_" パラメータを落とすだけ。
+"""
+import datetime
+import json
+import os
+import re
+import urllib.parse
+
+import joblib
+import numpy as np
+import pandas as pd
+import requests
+from sqlalchemy import create_engine, event
+
+import app
+
+FIXTURE_DIR = 'data/bench/fixtures'
+JOCKEYS = ['川田将雅', 'ルメール', '横山武史', '戸崎圭太', '松山弘平', '岩田望来', '坂井瑠星', '武豊']
+TRAINERS = ['[東] 堀宣行', '[西] 友道康夫', '[東] 手塚貴久', '[西] 矢作芳人', '[西] 中内田充', '[東] 国枝栄']
+SIRES = ['ディープインパクト', 'キタサンブラック', 'ロードカナロア', 'エピファネイア', 'ドゥラメンテ']
+BMS = ['キングカメハメハ', 'サンデーサイレンス', 'クロフネ', 'シンボリクリスエス']
+
+
+def normalize_url(url):
+    parts = urllib.parse.urlsplit(url)
+    query = [(k, v) for k, v in urllib.parse.parse_qsl(parts.query) if k != '_']
+    return urllib.parse.urlunsplit(('https', parts.netloc, parts.path, urllib.parse.urlencode(sorted(query)), ''))
+
+
+def sqlite_engine(path, **kwargs):
+    """合成DBへの接続 (スレッドごとに別コネクション。Postgres の REGEXP_REPLACE を Python で代用)。kwargs はプール設定など"""
+    engine = create_engine(f"sqlite:///{path}", connect_args={'check_same_thread': False}, **kwargs)
+
+    @event.listens_for(engine, 'connect')
+    def _register(conn, _):
+        conn.create_function('REGEXP_REPLACE', 4, lambda s, p, r, f: re.sub(p, r, s) if s is not None else None)
+    return engine
+
+
+def make_synthetic_db(path, n_horses=2000, n_races=3000, field=14, seed=0):
+    """過去 n_races レース分の成績 (1レース field 頭) と血統表を持つ SQLite を作る。戻り値: 馬名リスト"""
+    rng = np.random.default_rng(seed)
+    horses = [f"ベンチホース{i:05d}" for i in range(n_horses)]
+    start = pd.Timestamp('2022-01-01')
+    places = list(app.PLACE_MAP.values())
+    rows = []
+    for r in range(n_races):
+        date = (start + pd.Timedelta(days=int(r * 900 / n_races))).strftime('%Y-%m-%d')
+        dist = int(rng.choice([1200, 1400, 1600, 1800, 2000, 2400]))
+        course = str(rng.choice(['芝', 'ダ']))
+        place_code = rng.integers(1, 11)
+        for k, h in enumerate(rng.choice(n_horses, field, replace=False)):
+            rows.append({'date': date, 'race_id': f"{date[:4]}{place_code:02d}{r:06d}", '馬名': horses[h], '着順': str(k + 1),
+                         '上り': f"{rng.uniform(33, 39):.1f}", '着差': str(rng.choice(['クビ', 'ハナ', '1/2', '1', '2'])),
+                         '通過': f"{rng.integers(1, field + 1)}-{rng.integers(1, field + 1)}", '賞金(万円)': str(int(rng.integers(100, 3000))) if k < 5 else '0',
+                         '距離': dist, 'コース区分': course, '騎手': str(rng.choice(JOCKEYS)), '調教師': str(rng.choice(TRAINERS)),
+                         '開催場所': places[place_code - 1], '枠番': str(k // 2 + 1), '馬番': str(k + 1)})
+    if os.path.exists(path): os.remove(path)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    engine = sqlite_engine(path)
+    pd.DataFrame(rows).to_sql('raw_race_results', engine, index=False, chunksize=5000)
+    pd.DataFrame({'horse_name': horses, 'sire_name': rng.choice(SIRES, n_horses), 'bms_name': rng.choice(BMS, n_horses)}).to_sql('horses', engine, index=False)
+    with engine.begin() as conn:
+        conn.exec_driver_sql('CREATE INDEX idx_results_horse ON raw_race_results ("馬名")')
+    engine.dispose()
+    return horses
+
+
+# ---------------------------------------------------------
+# 合成ページ
+# ---------------------------------------------------------
+def race_list_html(races):
+    items = "".join(f'<li class="RaceList_DataItem"><a href="../race/shutuba.html?race_id={r["id"]}">'
+                    f'<div class="Race_Num">{int(r["id"][10:12])}R</div><span class="ItemTitle">{r["title"]}</span> {r["time"]} {r["course"]}{r["distance"]}m</a></li>'
+                    for r in races)
+    return f'<html><body><div class="RaceList_Box"><dl class="RaceList_DataList"><dd><ul>{items}</ul></dd></dl></div></body></html>'
+
+
+def shutuba_html(race, date):
+    rows = "".join(f'<tr class="HorseList"><td class="Waku">{(u - 1) // 2 + 1}</td><td class="Umaban">{u}</td><td class="CheckMark"></td>'
+                   f'<td class="HorseInfo"><span class="HorseName"><a>{h["name"]}</a></span></td><td class="Barei">牡{h["age"]}</td>'
+                   f'<td>{h["weight"]}</td><td class="Jockey"><a>{h["jockey"]}</a></td><td class="Trainer"><a title="{h["trainer"]}">{h["trainer"]}</a></td>'
+                   f'<td>480(0)</td><td><span id="odds-1_{u:02d}">{h["odds"]}</span></td></tr>'
+                   for u, h in enumerate(race['horses'], start=1))
+    return (f'<html><head><title>{race["title"]} 出馬表 | {date.year}年{date.month}月{date.day}日 {race["place"]}{int(race["id"][10:12])}R</title></head><body>'
+            f'<div class="RaceName">{race["title"]}</div><div class="RaceData01">{race["time"]}発走 / {race["course"]}{race["distance"]}m (左 A)</div>'
+            f'<table class="Shutuba_Table RaceTable01"><tbody>{rows}</tbody></table></body></html>')
+
+
+def odds_json(race):
+    return json.dumps({'status': 'result', 'data': {'odds': {'1': {f"{u:02d}": [h['odds'], '', str(u)] for u, h in enumerate(race['horses'], start=1)}}}})
+
+
+def result_html(race, rng):
+    order = rng.permutation(len(race['horses'])) + 1
+    rows = "".join(f'<tr><td>{rank}</td><td>{(u - 1) // 2 + 1}</td><td>{u}</td><td>{race["horses"][u - 1]["name"]}</td></tr>'
+                   for rank, u in enumerate(order, start=1))
+    win = order[0]
+    place = order[:3]
+    pay_win = int(float(race['horses'][win - 1]['odds']) * 100)
+    pay_place = [max(110, pay_win // 3)] + [int(float(race['horses'][u - 1]['odds']) * 30) + 100 for u in place[1:]]
+    return (f'<html><body><table class="RaceTable01"><tr><th>着順</th><th>枠</th><th>馬番</th><th>馬名</th></tr>{rows}</table>'
+            f'<table class="Payout_Detail_Table"><tr class="Tansho"><th>単勝</th><td class="Result">{win}</td><td class="Payout">{pay_win:,}円</td></tr>'
+            f'<tr class="Fukusho"><th>複勝</th><td class="Result">{"<br>".join(map(str, place))}</td><td class="Payout">{"<br>".join(f"{p:,}円" for p in pay_place)}</td></tr></table></body></html>')
+
+
+def synthesize_pages(fixture_dir, date, horses, n_races=36, seed=0):
+    """1開催日ぶん (n_races レース) のページを書き出して index.json を作る"""
+    rng = np.random.default_rng(seed)
+    pages = os.path.join(fixture_dir, 'pages')
+    os.makedirs(pages, exist_ok=True)
+    date_str = date.strftime('%Y%m%d')
+    index = {}
+
+    def put(url, name, body):
+        with open(os.path.join(pages, name), 'w', encoding='utf-8') as f: f.write(body)
+        index[normalize_url(url)] = name
+
+    races = []
+    for i in range(n_races):
+        place_code = ['05', '08', '03'][i // 12 % 3]
+        race_id = f"{date.year}{place_code}0301{i % 12 + 1:02d}"
+        field = int(rng.integers(10, 19))
+        names = rng.choice(horses, field, replace=False)
+        odds = np.round(rng.uniform(0.8, 1.2) / rng.dirichlet(np.ones(field) * 0.8), 1).clip(1.1, 999.9)
+        races.append({'id': race_id, 'place': app.PLACE_MAP[place_code], 'time': f"{10 + i % 12 // 2}:{(i % 2) * 30 + 5:02d}",
+                      'title': str(rng.choice(['3歳未勝利', '1勝クラス', '2勝クラス', 'ベンチステークス(G3)', '4歳以上3勝クラス'])),
+                      'course': str(rng.choice(['芝', 'ダ'])), 'distance': int(rng.choice([1200, 1400, 1600, 1800, 2000])),
+                      'horses': [{'name': str(n), 'age': int(rng.integers(3, 7)), 'weight': '57.0', 'jockey': str(rng.choice(JOCKEYS)),
+                                  'trainer': str(rng.choice(TRAINERS)).split('] ')[-1], 'odds': f"{o:.1f}"} for n, o in zip(names, odds)]})
+
+    put(f"https://race.netkeiba.com/top/race_list_sub.html?kaisai_date={date_str}", f"race_list_{date_str}.html", race_list_html(races))
+    for r in races:
+        put(f"https://race.netkeiba.com/race/shutuba.html?race_id={r['id']}", f"shutuba_{r['id']}.html", shutuba_html(r, date))
+        put(f"https://race.netkeiba.com/api/api_get_jra_odds.html?race_id={r['id']}&type=1&action=init", f"odds_{r['id']}.json", odds_json(r))
+        put(f"https://race.netkeiba.com/race/result.html?race_id={r['id']}", f"result_{r['id']}.html", result_html(r, rng))
+    write_index(fixture_dir, index, {'date': date_str, 'races': [r['id'] for r in races], 'source': 'synthetic'})
+    return races
+
+
+def write_index(fixture_dir, index, meta):
+    with open(os.path.join(fixture_dir, 'index.json'), 'w', encoding='utf-8') as f:
+        json.dump({'meta': meta, 'pages': index}, f, ensure_ascii=False, indent=1)
+
+
+def load_index(fixture_dir):
+    with open(os.path.join(fixture_dir, 'index.json'), encoding='utf-8') as f: return json.load(f)
+
+
+# ---------------------------------------------------------
+# 合成モデル
+# ---------------------------------------------------------
+def make_model_pack(encoders, seed=0, n=5000):
+    """DEFAULT_FEATURES で学習した小さなモデル (精度は見ない。推論コストを本番に近づけるため木の数だけ合わせる)"""
+    import lightgbm as lgb
+    from sklearn.isotonic import IsotonicRegression
+    from build_dataset import DEFAULT_FEATURES
+    rng = np.random.default_rng(seed)
+    X = pd.DataFrame(rng.normal(size=(n, len(DEFAULT_FEATURES))), columns=DEFAULT_FEATURES)
+    for col in DEFAULT_FEATURES:
+        if col in encoders: X[col] = rng.integers(0, len(encoders[col].classes_), n)
+    y = (X['jockey_win_rate'] + X['prev_rank'] * -0.5 + rng.normal(size=n) > 1.2).astype(int)
+    booster = lgb.train({'objective': 'binary', 'verbose': -1, 'num_leaves': 31}, lgb.Dataset(X, y), 300)
+    calibrator = IsotonicRegression(out_of_bounds='clip').fit(booster.predict(X), y)
+    return {'model': booster, 'calibrator': calibrator, 'features': DEFAULT_FEATURES,
+            'output_transform': app.detect_output_transform(booster), 'version': 'bench-synthetic'}
+
+
+def load_model(fixture_dir):
+    """本番モデルがあればそれ、無ければ synth で作った合成モデル"""
+    model_pack, encoders, _, _ = app.load_resources(app.model_artifact_mtime())
+    if model_pack is not None: return model_pack, encoders
+    return joblib.load(os.path.join(fixture_dir, 'model.pkl')), joblib.load(app.ENCODER_PATH)
+
+
+def build(fixture_dir=FIXTURE_DIR, date=None, n_races=36, n_horses=2000, history_races=3000, seed=0):
+    """合成フィクスチャ一式 (ページ・DB・モデル) を作る"""
+    date = date or datetime.date(2024, 5, 5)
+    os.makedirs(fixture_dir, exist_ok=True)
+    horses = make_synthetic_db(os.path.join(fixture_dir, 'bench.db'), n_horses=n_horses, n_races=history_races, seed=seed)
+    races = synthesize_pages(fixture_dir, date, horses, n_races=n_races, seed=seed)
+    joblib.dump(make_model_pack(joblib.load(app.ENCODER_PATH), seed=seed), os.path.join(fixture_dir, 'model.pkl'))
+    return races
+
+
+# ---------------------------------------------------------
+# 録画 (実ページ)
+# ---------------------------------------------------------
+def record(fixture_dir, date, with_results=True):
+    """指定日のレース一覧・出馬表・単勝オッズ・結果ページを取得して保存する (DB は実DBか synth のものを使う)"""
+    pages = os.path.join(fixture_dir, 'pages')
+    os.makedirs(pages, exist_ok=True)
+    index = {}
+    date_str = date.strftime('%Y%m%d')
+
+    def put(url, name, body):
+        if not body: return
+        with open(os.path.join(pages, name), 'w', encoding='utf-8') as f: f.write(body)
+        index[normalize_url(url)] = name
+
+    list_url = f"https://race.netkeiba.com/top/race_list_sub.html?kaisai_date={date_str}"
+    put(list_url, f"race_list_{date_str}.html", app.get_html_content(list_url))
+    race_list = app.get_race_list_by_date(date)
+    for r in race_list:
+        put(r['url'], f"shutuba_{r['id']}.html", app.get_html_content(r['url']))
+        api = f"https://race.netkeiba.com/api/api_get_jra_odds.html?race_id={r['id']}&type=1&action=init"
+        try: put(api, f"odds_{r['id']}.json", requests.get(api, headers=app.HEADERS, timeout=5).text)
+        except Exception: pass
+        if with_results:
+            result_url = f"https://race.netkeiba.com/race/result.html?race_id={r['id']}"
+            put(result_url, f"result_{r['id']}.html", app.get_html_content(result_url))
+    write_index(fixture_dir, index, {'date': date_str, 'races': [r['id'] for r in race_list], 'source': 'recorded'})
+    return race_list
@@ -0,0 +1,258 @@
+"""
+複数セッションの負荷試験
+
+N 個の擬似セッションが画面と同じ流れ (レース一覧を取得 → 全レース一括スキャン → 詳細を開く) を並行して実行する。
+通信は replay サーバー、DB は合成DB (または --db-url の Postgres)。セッション数を段階的に増やし、各段階で
+フローごとのレイテンシ分位・RSS の推移と最大値・1セッションあたりの状態サイズ・DB プールの使用数と飽和率・スレッド数を記録する。
+
+セッションは main() と同じ関数を呼ぶ (Streamlit の描画は除く)。スキャンは既定では画面と同じく ScanJobManager で
+同じ開催日を1本にまとめる。--scan per-session にすると各セッションが自分でスキャンする (合流しない場合の最悪値)。
+
+使い方:
+    python -m benchmarks.bench synth                              # フィクスチャが無ければ先に作る
+    python -m benchmarks.loadtest --sessions 1,2,4,8,16
+    python -m benchmarks.loadtest --sessions 1,4,8 --scan per-session --pool-size 5 --max-overflow 10
+    python -m benchmarks.loadtest --db-url postgresql://localhost/keiba --sessions 1,8,32 --out data/bench/load.json
+"""
+import argparse
+import csv
+import datetime
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+import numpy as np
+import streamlit as st
+
+import app
+from benchmarks import fixtures, replay
+
+FLOWS = ('race_list', 'scan', 'detail')
+SAMPLE_SECONDS = 0.1 # RSS・プール使用数を記録する間隔
+
+
+class Sampler:
+    """RSS・DB プールの使用数・スレッド数・実行中スキャン数を一定間隔で記録する"""
+    def __init__(self, engine, interval=SAMPLE_SECONDS):
+        self.engine, self.interval = engine, interval
+        self.rows = []
+        self.stop_event = threading.Event()
+        self.t0 = time.time()
+
+    def sample(self):
+        pool = self.engine.pool
+        jobs = list(app.get_scan_job_manager().jobs.values())
+        self.rows.append({'t': round(time.time() - self.t0, 2), 'rss_mb': (app.process_rss_bytes() or 0) / 1024 / 1024,
+                          'pool_checked_out': pool.checkedout() if hasattr(pool, 'checkedout') else 0,
+                          'threads': threading.active_count(), 'scans_running': sum(j.status == 'running' for j in jobs)})
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.sample()
+            self.stop_event.wait(self.interval)
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        self.thread.join()
+        self.sample()
+
+
+def pool_capacity(engine):
+    pool = engine.pool
+    if not hasattr(pool, 'size'): return None
+    return pool.size() + max(getattr(pool, '_max_overflow', 0), 0)
+
+
+def open_detail(url, model, encoders, engine, use_cache=True):
+    """詳細画面と同じ: 共有キャッシュにあればそれ、無ければ取得して予測し、着順シミュレーションまで行う"""
+    cache = app.get_prediction_cache().view(model.get('version', '-'))
+    cached = cache.detail(url) if use_cache else None # 詳細画面と同じく圧縮した予測データを元に戻す
+    if cached: res = cached['res']
+    else:
+        df = app.scrape_race_data(url)
+        if df is None or df.empty: raise RuntimeError("出馬表を取得できません")
+        res, debug, X_renamed, diag_data, missing_info, trace_df, contrib = app.predict_race(df, model, encoders, engine)
+        cache[url] = {'res': res, 'debug': debug, 'X_renamed': X_renamed, 'diag_data': diag_data,
+                      'missing_info': missing_info, 'trace_df': trace_df, 'contrib': contrib}
+    horses = res.drop_duplicates(subset=['馬番'])
+    app.simulate_race(horses['AIスコア'].to_numpy(dtype=float))
+    return res
+
+
+def run_session(i, args, date, model, encoders, engine, out):
+    """1セッション分のフロー。session は session_state の代わり (スキャン結果は画面と同じく job.state を参照で持つ)"""
+    rng = random.Random(args.seed + i)
+    session = {}
+    latencies = {k: [] for k in FLOWS}
+    errors = []
+
+    def timed(flow, fn):
+        t0 = time.perf_counter()
+        try: return fn()
+        except Exception as e: errors.append(f"{flow}: {type(e).__name__}: {e}")
+        finally: latencies[flow].append(time.perf_counter() - t0)
+
+    def think():
+        if args.think: time.sleep(rng.uniform(0, args.think))
+
+    session['race_list'] = timed('race_list', lambda: app.get_race_list_by_date(date)) or []
+    think()
+
+    def scan():
+        if args.scan == 'shared':
+            job = app.get_scan_job_manager().submit(date, session['race_list'], model, encoders, engine)
+        else:
+            job = app.ScanJob(f"load-{i}", date)
+            threading.Thread(target=app.run_scan_job, args=(job, session['race_list'], model, encoders, engine), daemon=True).start()
+        while job.status == 'running': time.sleep(args.poll)
+        if job.status == 'error': raise RuntimeError(job.error)
+        session.update(job.state) # apply_scan_job と同じ
+        return job
+    if session['race_list']: timed('scan', scan)
+    think()
+
+    urls = list(session.get('scanned_race_urls') or [r['url'] for r in session['race_list']])
+    for url in rng.sample(urls, min(args.details, len(urls))):
+        timed('detail', lambda: open_detail(url, model, encoders, engine, use_cache=not args.no_cache_detail))
+        think()
+    out[i] = {'latencies': latencies, 'errors': errors, 'state_mb': app.estimate_bytes(session) / 1024 / 1024}
+
+
+def quantiles(values):
+    if not values: return {'n': 0}
+    ms = np.asarray(values) * 1000
+    return {'n': len(ms), 'p50_ms': float(np.percentile(ms, 50)), 'p90_ms': float(np.percentile(ms, 90)),
+            'p99_ms': float(np.percentile(ms, 99)), 'max_ms': float(ms.max())}
+
+
+def metric_total(name):
+    m = app.get_metrics()
+    with m.lock:
+        values = sum(v for (n, _), v in m.values.items() if n == name)
+        hist = [h for (n, _), h in m.histograms.items() if n == name]
+    return values, sum(h[-2] for h in hist), sum(h[-1] for h in hist)
+
+
+def reset_shared_state(warm):
+    """段階ごとに前の段階の結果を持ち越さない (--warm なら st.cache_data と予測キャッシュは残す)"""
+    with app.get_scan_job_manager().lock: app.get_scan_job_manager().jobs.clear()
+    for d in (app.SCAN_STORE_DIR, app.CHECKPOINT_DIR):
+        if os.path.isdir(d): app.shutil.rmtree(d, ignore_errors=True)
+    if warm: return
+    st.cache_data.clear()
+    cache = app.get_prediction_cache()
+    with cache.lock:
+        cache.entries.clear()
+        cache.latest.clear()
+        cache.bytes = 0
+
+
+def run_level(n, args, date, model, encoders, engine):
+    reset_shared_state(args.warm)
+    _, db_sec0, db_n0 = metric_total('keiba_db_query_seconds')
+    http0 = metric_total('keiba_http_requests_total')[0]
+    out = {}
+    t0 = time.time()
+    with Sampler(engine) as sampler:
+        threads = []
+        for i in range(n):
+            t = threading.Thread(target=run_session, args=(i, args, date, model, encoders, engine, out), daemon=True)
+            t.start()
+            threads.append(t)
+            if args.ramp: time.sleep(args.ramp / max(n, 1))
+        for t in threads: t.join(timeout=args.timeout)
+    wall = time.time() - t0
+    _, db_sec, db_n = metric_total('keiba_db_query_seconds')
+    timeline = sampler.rows
+    capacity = pool_capacity(engine)
+    checked_out = [r['pool_checked_out'] for r in timeline]
+    result = {
+        'sessions': n, 'wall_sec': wall, 'completed': len(out),
+        'flows': {flow: quantiles([v for s in out.values() for v in s['latencies'][flow]]) for flow in FLOWS},
+        'errors': [e for s in out.values() for e in s['errors']][:20],
+        'error_count': sum(len(s['errors']) for s in out.values()),
+        'rss_start_mb': timeline[0]['rss_mb'] if timeline else None, 'rss_peak_mb': max((r['rss_mb'] for r in timeline), default=None),
+        'rss_end_mb': timeline[-1]['rss_mb'] if timeline else None,
+        'state_mb_per_session': float(np.mean([s['state_mb'] for s in out.values()])) if out else None,
+        'pool_capacity': capacity, 'pool_peak': max(checked_out, default=0),
+        'pool_saturated_pct': float(np.mean([c >= capacity for c in checked_out]) * 100) if capacity and checked_out else None,
+        'threads_peak': max((r['threads'] for r in timeline), default=0),
+        'db_queries': db_n - db_n0, 'db_avg_ms': (db_sec - db_sec0) / (db_n - db_n0) * 1000 if db_n > db_n0 else None,
+        'http_requests': metric_total('keiba_http_requests_total')[0] - http0,
+    }
+    return result, timeline
+
+
+def print_level(r):
+    f = r['flows']
+    fmt = lambda q: f"{q['p50_ms']:7.0f}/{q['p90_ms']:7.0f}" if q.get('n') else f"{'-':>15}"
+    print(f"{r['sessions']:>4} | {fmt(f['race_list'])} | {fmt(f['scan'])} | {fmt(f['detail'])} | "
+          f"{r['rss_peak_mb'] or 0:7.0f} {r['state_mb_per_session'] or 0:6.1f} | {r['pool_peak']:>3}/{r['pool_capacity'] or '-':<3} "
+          f"{r['pool_saturated_pct'] or 0:5.0f}% | {r['threads_peak']:>4} | {r['db_avg_ms'] or 0:6.1f} | {r['error_count']:>3} | {r['wall_sec']:6.1f}s", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="複数セッションの負荷試験")
+    parser.add_argument('--fixtures', default=fixtures.FIXTURE_DIR)
+    parser.add_argument('--db-url', default=None, help="Postgres などで試す場合 (省略時は合成DB)")
+    parser.add_argument('--sessions', default='1,2,4,8', help="同時セッション数 (カンマ区切りで段階的に)")
+    parser.add_argument('--scan', choices=['shared', 'per-session'], default='shared', help="shared: 画面と同じく同じ日付のスキャンに合流 / per-session: 各自スキャン")
+    parser.add_argument('--details', type=int, default=3, help="1セッションが開く詳細画面の数")
+    parser.add_argument('--no-cache-detail', action='store_true', help="詳細画面で共有キャッシュを使わず毎回予測する")
+    parser.add_argument('--think', type=float, default=0.5, help="操作の間の待ち時間の上限(秒)")
+    parser.add_argument('--ramp', type=float, default=1.0, help="この秒数をかけてセッションを順に開始する")
+    parser.add_argument('--poll', type=float, default=0.5, help="スキャン完了を確認する間隔(秒)")
+    parser.add_argument('--delay', type=float, default=0.0, help="replay サーバーの擬似遅延(秒)")
+    parser.add_argument('--pool-size', type=int, default=5, help="DB プールの常設コネクション数 (SQLAlchemy の既定値)")
+    parser.add_argument('--max-overflow', type=int, default=10)
+    parser.add_argument('--pool-timeout', type=float, default=30)
+    parser.add_argument('--warm', action='store_true', help="段階の間で st.cache_data と予測キャッシュを消さない")
+    parser.add_argument('--timeout', type=float, default=600, help="1段階の上限(秒)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='data/bench/loadtest.json')
+    args = parser.parse_args()
+
+    index = fixtures.load_index(args.fixtures)
+    date = datetime.datetime.strptime(index['meta']['date'], '%Y%m%d').date()
+    pool_args = {'pool_size': args.pool_size, 'max_overflow': args.max_overflow, 'pool_timeout': args.pool_timeout}
+    engine = app.create_engine(args.db_url, **pool_args) if args.db_url else fixtures.sqlite_engine(os.path.join(args.fixtures, 'bench.db'), **pool_args)
+    app.instrument_engine(engine)
+    model, encoders = fixtures.load_model(args.fixtures)
+    run_dir = os.path.join(os.path.dirname(args.out) or '.', 'loadtest_run')
+    app.SCAN_STORE_DIR, app.CHECKPOINT_DIR, app.TRACE_DIR = (os.path.join(run_dir, d) for d in ('scans', 'checkpoints', 'traces'))
+
+    levels, timelines = [], []
+    server = replay.ReplayServer(args.fixtures, delay=args.delay).start()
+    print(f"{'N':>4} | {'一覧 p50/p90 ms':>15} | {'スキャン p50/p90':>15} | {'詳細 p50/p90':>15} | {'RSS MB':>7} {'状態MB':>6} | {'DBプール':>7} {'飽和':>5} | "
+          f"{'thr':>4} | {'SQL ms':>6} | {'err':>3} | 所要")
+    with replay.install(app, server):
+        for n in [int(x) for x in args.sessions.split(',') if x.strip()]:
+            result, timeline = run_level(n, args, date, model, encoders, engine)
+            levels.append(result)
+            timelines += [{'sessions': n, **row} for row in timeline]
+            print_level(result)
+    server.stop()
+
+    os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+    meta = {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'), 'fixtures': index['meta'].get('source'), 'db': 'postgres' if args.db_url else 'sqlite',
+            'scan': args.scan, 'details': args.details, 'pool_size': args.pool_size, 'max_overflow': args.max_overflow, 'races': len(index['meta'].get('races', [])),
+            'model_version': model.get('version', '-'), 'python': sys.version.split()[0]}
+    with open(args.out, 'w', encoding='utf-8') as f: json.dump({'meta': meta, 'levels': levels}, f, ensure_ascii=False, indent=1)
+    timeline_path = os.path.splitext(args.out)[0] + '_timeline.csv'
+    with open(timeline_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=['sessions', 't', 'rss_mb', 'pool_checked_out', 'threads', 'scans_running'])
+        writer.writeheader()
+        writer.writerows(timelines)
+    print(f"saved {args.out} / {timeline_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+録画ページの再生 (ネットワークなしで取得系のステージを動かす)
+
+ReplayServer は index.json のページを返すローカルHTTPサーバー。無いページは 404。
+install() は app の requests を差し替え、netkeiba の URL を http://127.0.0.1:<port>/<host>/<path> に書き換えて本物の HTTP で取りに行く
+(ソケット・デコード・パースまで本番と同じ経路を通る)。Chrome は起動させず、フォールバックは即失敗にする。
+再生中に記録されるオッズは一時ディレクトリの OddsStore に入れ、本番の data/odds には書かない。
+"""
+import contextlib
+import http.server
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import requests
+
+from benchmarks.fixtures import load_index, normalize_url
+
+REPLAY_HOSTS = ('race.netkeiba.com', 'db.netkeiba.com')
+
+
+class _QuietServer(http.server.ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], ConnectionError): return # 負荷試験でクライアント側が先にタイムアウトした
+        super().handle_error(request, client_address)
+
+
+class ReplayServer:
+    def __init__(self, fixture_dir, delay=0.0):
+        self.fixture_dir = fixture_dir
+        self.pages = load_index(fixture_dir)['pages']
+        self.delay = delay # 擬似的な通信遅延(秒)
+        self.hits = 0
+        self.misses = 0
+        self.httpd = None
+
+    def start(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                parts = urllib.parse.urlsplit(self.path)
+                host, _, path = parts.path.lstrip('/').partition('/')
+                name = server.pages.get(normalize_url(f"https://{host}/{path}?{parts.query}"))
+                if server.delay: time.sleep(server.delay)
+                if name is None:
+                    server.misses += 1
+                    self.send_response(404); self.end_headers(); return
+                server.hits += 1
+                with open(os.path.join(server.fixture_dir, 'pages', name), 'rb') as f: body = f.read()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json' if name.endswith('.json') else 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args): pass
+
+        self.httpd = _QuietServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def base(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def rewrite(self, url):
+        parts = urllib.parse.urlsplit(url)
+        if parts.netloc not in REPLAY_HOSTS: return url
+        return f"{self.base}/{parts.netloc}{parts.path}" + (f"?{parts.query}" if parts.query else "")
+
+    def stop(self):
+        if self.httpd: self.httpd.shutdown()
+
+
+class _RequestsShim:
+    """app.requests の代わり。get だけ URL を書き換え、それ以外は本物の requests に渡す"""
+    def __init__(self, server):
+        self.server = server
+
+    def get(self, url, **kwargs):
+        return requests.get(self.server.rewrite(url), **kwargs) # 本番と同じく1回ごとに接続する
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+
+def _no_browser():
+    raise RuntimeError("replay: Chrome は使えません (録画に無いページ)")
+
+
+@contextlib.contextmanager
+def install(app_module, server):
+    """with install(app, server): の間だけ app の通信を再生サーバーへ向ける"""
+    odds_dir = tempfile.mkdtemp(prefix='replay-odds-')
+    odds_store = app_module.OddsStore(root=odds_dir)
+    saved = app_module.requests, app_module.create_chrome_driver, app_module.get_odds_store
+    app_module.requests, app_module.create_chrome_driver = _RequestsShim(server), _no_browser
+    app_module.get_odds_store = lambda: odds_store
+    try: yield server
+    finally:
+        app_module.requests, app_module.create_chrome_driver, app_module.get_odds_store = saved
+        shutil.rmtree(odds_dir, ignore_errors=True)
@@ -0,0 +1,175 @@
+"""
+学習データ生成 & 再学習スクリプト
+
+predict_race と同じ特徴量を、過去の全レースについてまとめて作る。
+1レースずつ SQL を投げる代わりに、raw_race_results を一度だけ読み込み、
+騎手・調教師・血統・過去走の統計を「前日までの累積」(as-of) として集合演算で計算する
+(app.build_asof_frame。期間バックテストも同じ関数で特徴量を作る)。
+as-of 集計から parquet 書き出しまでを年ごとのワーカープロセスで並列に行う。
+派生特徴量 (ペース予測・偏差など) は app.derive_race_features をそのまま使う。
+
+使い方:
+    python build_dataset.py build --years 2019-2024 --out data/train
+    python build_dataset.py train --data data/train --out models/lgbm_pace_tuned.pkl
+    python build_dataset.py export   # 既存モデルを models/compact に変換
+"""
+import argparse
+import concurrent.futures
+import glob
+import json
+import os
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+
+import app
+
+# 既存のモデルパックが無いときに使う特徴量 (すべて predict_race が作る列)
+DEFAULT_FEATURES = [
+    'interval_weeks', 'prev_rank', 'prev_3f', 'prev_margin', 'prev_distance', 'dist_change',
+    'is_dist_shorten', 'is_dist_extend', 'course_change', 'is_same_jockey',
+    'recent_3f_avg', 'recent_rank_avg', 'std_recent_3f', 'std_recent_rank',
+    'run_style_ratio', 'nige_rate', 'senko_rate', 'avg_pos_rate',
+    'total_wins', 'total_money', 'win_ratio',
+    'jockey_win_rate', 'jockey_rentai_rate', 'std_jockey_win', 'trainer_win_rate', 'std_trainer_win',
+    'sire_win_rate', 'sire_rentai_rate', 'std_sire_win', 'bms_win_rate', 'bms_rentai_rate', 'sire_surface_win_rate',
+    'crs_rate', 'jockey_course_win_rate', 'jockey_course_rentai_rate', 'tag_win_rate', 'course_waku_win_rate',
+    'nige_count', 'senko_count', 'senko_ratio_in_race', 'horse_count',
+    'is_high_pace_forecast', 'is_slow_pace_forecast', 'dist_to_first_corner', 'dist_to_corner_x_waku',
+    'is_pace_advantage', '枠番', '距離', '開催場所', 'コース区分', '回り', 'クラス',
+]
+
+# ---------------------------------------------------------
+# 1. 年ごとの as-of 集計と仕上げ (プロセス並列)
+# ---------------------------------------------------------
+def build_year(year, db_url, encoders, out_dir):
+    """1年分をワーカープロセスで作る。その年の末日までの結果を読み、その年の出走行だけに as-of 統計を付ける"""
+    engine = create_engine(db_url)
+    hist = app.load_asof_results(engine, f"{year + 1}-01-01")
+    frame = app.build_asof_frame(hist, app.load_horse_pedigree(engine), since=f"{year}-01-01")
+    if frame.empty: return year, 0, None
+    return finalize_year(year, frame, encoders, out_dir)
+
+def finalize_year(year, frame, encoders, out_dir):
+    """派生特徴量とカテゴリ変換を predict_race と同じ関数で行い、列指向(parquet)で保存する"""
+    frame = app.derive_race_features(frame)
+    frame = app.encode_categoricals(frame, encoders)
+    frame['target'] = (frame['着順_num'] == 1).astype(int)
+    frame['date'] = frame['date'].dt.strftime('%Y-%m-%d')
+    keep = ['race_id', 'date', '馬名', '馬番', '着順_num', 'target'] + [c for c in DEFAULT_FEATURES if c in frame.columns]
+    extra = [c for c in frame.columns if c not in keep and pd.api.types.is_numeric_dtype(frame[c])]
+    path = os.path.join(out_dir, f"year={year}.parquet")
+    frame[keep + extra].to_parquet(path, index=False)
+    return year, len(frame), path
+
+def build(args):
+    t0 = time.time()
+    start_year, end_year = [int(y) for y in args.years.split('-')]
+    db_url = args.db_url or app.DATABASE_URL
+    encoders = joblib.load(args.encoders)
+    os.makedirs(args.out, exist_ok=True)
+
+    # 重い as-of 集計も年ごとにワーカーで行う (各ワーカーは自分の年の末日までの結果だけを読む)
+    years = range(start_year, end_year + 1)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(build_year, y, db_url, encoders, args.out) for y in years]
+        for f in concurrent.futures.as_completed(futures):
+            year, n, path = f.result()
+            print(f"  {year}: {n:,} rows -> {path}" if path else f"  {year}: no races")
+    print(f"done ({time.time() - t0:.1f}s)")
+
+
+# ---------------------------------------------------------
+# 2. 再学習 + キャリブレーション
+# ---------------------------------------------------------
+def load_dataset(path):
+    files = sorted(glob.glob(os.path.join(path, '*.parquet'))) if os.path.isdir(path) else [path]
+    return pd.concat([pd.read_parquet(f) for f in files], ignore_index=True)
+
+def resolve_features(args):
+    if args.features_from and os.path.exists(args.features_from):
+        return list(joblib.load(args.features_from)['features'])
+    return DEFAULT_FEATURES
+
+def train(args):
+    import lightgbm as lgb
+    from sklearn.isotonic import IsotonicRegression
+    from sklearn.metrics import log_loss, roc_auc_score
+
+    data = load_dataset(args.data)
+    data['date'] = pd.to_datetime(data['date'])
+    features = resolve_features(args)
+    missing = [c for c in features if c not in data.columns]
+    if missing: raise SystemExit(f"dataset is missing features: {missing}")
+
+    split = data['date'].max() - pd.DateOffset(months=args.valid_months)
+    tr, va = data[data['date'] <= split], data[data['date'] > split]
+    # 推論 (app.score_race) と同じく欠損は 0 で埋める
+    X_tr, X_va = app.feature_matrix(tr, features), app.feature_matrix(va, features)
+    print(f"train {len(tr):,} rows / valid {len(va):,} rows (split {split.date()})")
+
+    params = {'objective': 'binary', 'learning_rate': 0.05, 'num_leaves': 31, 'min_data_in_leaf': 50,
+              'feature_fraction': 0.8, 'bagging_fraction': 0.8, 'bagging_freq': 1, 'verbose': -1}
+    if args.params: params.update(json.loads(args.params))
+    d_tr = lgb.Dataset(X_tr, tr['target'])
+    d_va = lgb.Dataset(X_va, va['target'], reference=d_tr)
+    model = lgb.train(params, d_tr, num_boost_round=args.rounds, valid_sets=[d_va],
+                      callbacks=[lgb.early_stopping(100, verbose=False), lgb.log_evaluation(100)])
+
+    # 検証期間の予測で isotonic キャリブレーション (predict_race は calibrator.transform を使う)
+    raw_va = model.predict(X_va, num_iteration=model.best_iteration)
+    calibrator = IsotonicRegression(out_of_bounds='clip', y_min=0.0, y_max=1.0).fit(raw_va, va['target'])
+    prob_va = calibrator.transform(raw_va)
+    print(f"valid AUC {roc_auc_score(va['target'], raw_va):.4f} / logloss {log_loss(va['target'], np.clip(prob_va, 1e-6, 1 - 1e-6)):.4f}")
+
+    model = lgb.Booster(model_str=model.model_to_string(num_iteration=model.best_iteration))
+    os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+    pack = {'model': model, 'calibrator': calibrator, 'features': features}
+    joblib.dump(pack, args.out)
+    print(f"saved {args.out}")
+    if args.compact_out:
+        meta = app.export_compact_model(pack, joblib.load(args.encoders), args.compact_out)
+        print(f"saved {args.compact_out} (version {meta['version']})")
+
+def export(args):
+    """既存の joblib モデルパックを軽量形式 (app.load_compact_model で読める形) に変換する"""
+    meta = app.export_compact_model(joblib.load(args.model), joblib.load(args.encoders), args.out)
+    print(f"saved {args.out} (version {meta['version']}, {len(meta['features'])} features)")
+
+def main():
+    parser = argparse.ArgumentParser(description="学習データ生成 & 再学習")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_build = sub.add_parser('build', help="過去レースから学習データ(parquet)を作る")
+    p_build.add_argument('--years', required=True, help="例: 2019-2024")
+    p_build.add_argument('--out', default='data/train')
+    p_build.add_argument('--db-url', default=None, help="省略時は secrets の DATABASE_URL")
+    p_build.add_argument('--encoders', default=app.ENCODER_PATH)
+    p_build.add_argument('--workers', type=int, default=os.cpu_count())
+    p_build.set_defaults(func=build)
+
+    p_train = sub.add_parser('train', help="学習 + キャリブレーションしてモデルパックを書き出す")
+    p_train.add_argument('--data', default='data/train')
+    p_train.add_argument('--out', default=app.MODEL_PATH)
+    p_train.add_argument('--features-from', default=app.MODEL_PATH, help="特徴量リストを引き継ぐモデルパック")
+    p_train.add_argument('--valid-months', type=int, default=6)
+    p_train.add_argument('--rounds', type=int, default=3000)
+    p_train.add_argument('--params', default=None, help="LightGBM パラメータ (JSON)")
+    p_train.add_argument('--encoders', default=app.ENCODER_PATH)
+    p_train.add_argument('--compact-out', default=app.COMPACT_MODEL_DIR, help="軽量形式の出力先 (空文字で書き出さない)")
+    p_train.set_defaults(func=train)
+
+    p_export = sub.add_parser('export', help="joblib のモデルパックを軽量形式に変換する")
+    p_export.add_argument('--model', default=app.MODEL_PATH)
+    p_export.add_argument('--encoders', default=app.ENCODER_PATH)
+    p_export.add_argument('--out', default=app.COMPACT_MODEL_DIR)
+    p_export.set_defaults(func=export)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
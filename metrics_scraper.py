@@ -0,0 +1,135 @@
+"""
+メトリクスの簡易スクレイパー (Prometheus の代わり)
+
+app.py / scan_daemon.py が書き出す data/metrics/*.prom か、METRICS_PORT の /metrics を定期的に読み、
+前回との差分から「1分あたりのリクエスト数・Selenium フォールバック率・キャッシュヒット率・SQL の平均時間・スキャン時間・Gemini の枠切れ」を表示する。
+--out を付けると、読み取った生の値を JSON lines で追記する (あとから pandas で読める)。
+
+使い方:
+    python metrics_scraper.py                                        # data/metrics/*.prom を 15秒ごとに読む
+    python metrics_scraper.py --url http://127.0.0.1:9108/metrics --interval 5
+    python metrics_scraper.py --once                                 # 現在の累計を1回だけ表示
+    python metrics_scraper.py --out data/metrics/history.jsonl
+"""
+import argparse
+import datetime
+import glob
+import json
+import os
+import re
+import time
+import urllib.request
+
+LINE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)$')
+LABEL_RE = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+
+def parse_prometheus_text(text):
+    """{(名前, ((ラベル, 値), ...)): 値}"""
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'): continue
+        m = LINE_RE.match(line.strip())
+        if not m: continue
+        labels = tuple(sorted((k, v.replace('\\"', '"').replace('\\n', '\n').replace('\\\\', '\\')) for k, v in LABEL_RE.findall(m.group(2) or '')))
+        try: samples[(m.group(1), labels)] = float(m.group(3))
+        except ValueError: continue
+    return samples
+
+
+def scrape(args):
+    """ファイル (複数なら instance ラベルを付けて合算) か URL から読む"""
+    if args.url:
+        with urllib.request.urlopen(args.url, timeout=5) as r: return parse_prometheus_text(r.read().decode('utf-8'))
+    samples = {}
+    for path in sorted(glob.glob(args.files)):
+        instance = os.path.splitext(os.path.basename(path))[0]
+        with open(path, encoding='utf-8') as f:
+            for (name, labels), v in parse_prometheus_text(f.read()).items():
+                samples[(name, labels + (('instance', instance),))] = v
+    return samples
+
+
+def total(samples, name, **match):
+    return sum(v for (n, labels), v in samples.items() if n == name and all(dict(labels).get(k) == w for k, w in match.items()))
+
+
+def by_label(samples, name, label):
+    out = {}
+    for (n, labels), v in samples.items():
+        if n == name: out[dict(labels).get(label, '')] = out.get(dict(labels).get(label, ''), 0) + v
+    return out
+
+
+def ratio(a, b):
+    return a / b if b else None
+
+
+def summarize(cur, prev=None, seconds=None):
+    """累計 (prev なし) か、前回からの差分で主要な指標をまとめる"""
+    d = (lambda name, **m: total(cur, name, **m) - total(prev, name, **m)) if prev else (lambda name, **m: total(cur, name, **m))
+    per_min = (60 / seconds) if prev and seconds else None
+    fetches = d('keiba_page_fetch_total')
+    cache_calls, cache_misses = d('keiba_cache_calls_total'), d('keiba_cache_misses_total')
+    pc_hits = d('keiba_prediction_cache_hits_total') + d('keiba_prediction_cache_disk_hits_total')
+    pc_lookups = pc_hits + d('keiba_prediction_cache_misses_total')
+    queries = d('keiba_db_queries_total')
+    scans = d('keiba_scan_duration_seconds_count')
+    return {
+        'http_requests': d('keiba_http_requests_total'),
+        'http_per_min': d('keiba_http_requests_total') * per_min if per_min else None,
+        'http_errors': sum(v for s, v in by_label(cur, 'keiba_http_requests_total', 'status').items() if not s.startswith('2'))
+                       - (sum(v for s, v in by_label(prev, 'keiba_http_requests_total', 'status').items() if not s.startswith('2')) if prev else 0),
+        'selenium_rate': ratio(d('keiba_page_fetch_total', via='selenium'), fetches),
+        'fetch_failed_rate': ratio(d('keiba_page_fetch_total', via='failed'), fetches),
+        'db_queries': queries,
+        'db_avg_ms': ratio(d('keiba_db_query_seconds_sum') * 1000, queries),
+        'db_pool_in_use': total(cur, 'keiba_db_pool_checked_out'),
+        'cache_data_hit_rate': ratio(cache_calls - cache_misses, cache_calls),
+        'prediction_cache_hit_rate': ratio(pc_hits, pc_lookups),
+        'scans': scans,
+        'scan_avg_sec': ratio(d('keiba_scan_duration_seconds_sum'), scans),
+        'scans_running': total(cur, 'keiba_scans_running'),
+        'gemini_quota_failures': d('keiba_gemini_requests_total', result='quota'),
+        'rss_mb': total(cur, 'keiba_process_resident_bytes') / 1024 / 1024,
+    }
+
+
+def format_summary(s):
+    pct = lambda v: '-' if v is None else f"{v:.0%}"
+    num = lambda v, f='.1f': '-' if v is None else format(v, f)
+    return (f"http {s['http_requests']:.0f} ({num(s['http_per_min'])}/min, err {s['http_errors']:.0f}) | selenium {pct(s['selenium_rate'])} "
+            f"failed {pct(s['fetch_failed_rate'])} | db {s['db_queries']:.0f}q avg {num(s['db_avg_ms'])}ms pool {s['db_pool_in_use']:.0f} | "
+            f"cache_data {pct(s['cache_data_hit_rate'])} pred {pct(s['prediction_cache_hit_rate'])} | scans {s['scans']:.0f} "
+            f"avg {num(s['scan_avg_sec'])}s running {s['scans_running']:.0f} | gemini quota {s['gemini_quota_failures']:.0f} | rss {s['rss_mb']:.0f}MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="メトリクスの簡易スクレイパー")
+    parser.add_argument('--files', default='data/metrics/*.prom', help="読み込む .prom ファイル (glob)")
+    parser.add_argument('--url', default=None, help="/metrics の URL (指定時はファイルより優先)")
+    parser.add_argument('--interval', type=float, default=15, help="読み込む間隔(秒)")
+    parser.add_argument('--once', action='store_true', help="現在の累計を1回だけ表示して終了")
+    parser.add_argument('--out', default=None, help="読み取った値を追記する JSON lines")
+    args = parser.parse_args()
+
+    prev, prev_t = None, None
+    while True:
+        try:
+            cur, now = scrape(args), time.time()
+            if not cur: print("メトリクスがまだありません", flush=True)
+            else:
+                print(f"[{datetime.datetime.now().strftime('%H:%M:%S')}] {format_summary(summarize(cur, prev, now - prev_t if prev_t else None))}", flush=True)
+                if args.out:
+                    os.makedirs(os.path.dirname(args.out) or '.', exist_ok=True)
+                    with open(args.out, 'a', encoding='utf-8') as f:
+                        f.write(json.dumps({'ts': now, 'samples': [[n, dict(l), v] for (n, l), v in cur.items()]}, ensure_ascii=False) + "\n")
+                prev, prev_t = cur, now
+        except Exception as e:
+            print(f"読み込みエラー: {e}", flush=True)
+        if args.once: return
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
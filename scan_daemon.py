@@ -0,0 +1,166 @@
+"""
+事前スキャンの常駐スクリプト
+
+開催前日の夜に翌日分を一括スキャンし、当日は定時 (出走取消の反映) にスキャンし直し、
+各レースの発走前には最新オッズで判定だけをやり直す。結果は app の共有ストア (data/scans/YYYYMMDD.pkl) に書き、
+アプリはそれを読むだけで一覧を表示できる (利用者がスキャンを待つ必要がなくなる)。
+未発走レースの単勝オッズも数分おきに記録する (app.OddsStore, data/odds)。
+メトリクスは data/metrics/daemon.prom に書き出す (metrics_scraper.py で読める)。
+
+使い方:
+    python scan_daemon.py                                   # 常駐 (前日20:00 / 当日08:30 / 発走30分前・10分前)
+    python scan_daemon.py --prescan-at 19:00 --refresh-at 08:30,11:00 --before-race 20
+    python scan_daemon.py --once 20261020                   # 指定日を1回だけスキャンして保存
+    python scan_daemon.py --once 20261020 --trace           # 処理時間の内訳も記録 (data/traces)
+"""
+import argparse
+import concurrent.futures
+import datetime
+import time
+
+import app
+
+
+def log(message):
+    print(f"[{datetime.datetime.now().strftime('%m/%d %H:%M:%S')}] {message}", flush=True)
+
+
+def parse_hhmm(value):
+    return datetime.datetime.strptime(value.strip(), '%H:%M').time()
+
+
+def load_model():
+    model_pack, encoders, engine, logs = app.load_resources(app.model_artifact_mtime())
+    if model_pack is None: raise RuntimeError(f"モデルを読み込めません: {logs.get('error', 'ファイルがありません')}")
+    return model_pack, encoders, engine
+
+
+def full_scan(target_date, pool=None):
+    """開催日の全レースをスキャンしてストアに保存する"""
+    model, encoders, engine = load_model()
+    t0 = time.time()
+    race_list = app.get_race_list_by_date(target_date)
+    if not race_list:
+        log(f"{target_date:%Y/%m/%d}: レース情報なし")
+        return False
+    job = app.ScanJob(app.scan_job_key(target_date, model), target_date)
+    app.run_scan_job(job, race_list, model, encoders, engine, pool)
+    if job.status != 'done':
+        log(f"{target_date:%Y/%m/%d}: スキャン失敗 ({job.status} {job.error or ''})")
+        return False
+    log(f"{target_date:%Y/%m/%d}: {job.completed}/{job.total} レースをスキャン, 欠損 {len(job.state['missing_races'])} ({time.time() - t0:.0f}s)")
+    if job.state.get('scan_trace'):
+        top = app.summarize_spans(job.state['scan_trace']['spans']).head(5)
+        log("処理時間: " + " / ".join(f"{r['区間']} {r['合計(s)']:.1f}s" for _, r in top.iterrows()))
+    return True
+
+
+def reprice(target_date, pool=None):
+    """保存済みの予測はそのままに、最新オッズで判定し直す (ストアが無ければフルスキャン)"""
+    model = load_model()[0]
+    state = app.load_scan_state(target_date, model)
+    if state is None: return full_scan(target_date, pool)
+    t0 = time.time()
+    state['scan_results'] = app.reprice_scan_results(state['scanned_race_urls'], state['prediction_cache'])
+    app.save_scan_state(target_date, model, state)
+    log(f"{target_date:%Y/%m/%d}: オッズ再判定 {len(state['scanned_race_urls'])} レース ({time.time() - t0:.0f}s)")
+    return True
+
+
+def race_start(target_date, race):
+    try: return datetime.datetime.combine(target_date, parse_hhmm(race.get('time', '')))
+    except ValueError: return None # "99:99" (発走時刻不明)
+
+
+def stored_since(target_date, moment):
+    """ストアの結果が moment 以降に書かれていれば True (再起動時に同じスキャンを繰り返さない)"""
+    mtime = app.scan_store_mtime(target_date)
+    return mtime is not None and mtime >= moment.timestamp()
+
+
+_race_lists = {}
+
+def stored_race_list(target_date):
+    """ストアに保存された出走表 (ファイルが更新されたときだけ読み直す)"""
+    mtime = app.scan_store_mtime(target_date)
+    if mtime is None: return []
+    if _race_lists.get(target_date, (None,))[0] != mtime:
+        state = app.load_scan_state(target_date, load_model()[0]) or {}
+        _race_lists[target_date] = (mtime, state.get('race_list', []))
+    return _race_lists[target_date][1]
+
+
+def run_forever(args, pool=None):
+    done = set()
+    last_odds = 0.0
+    while True:
+        now = datetime.datetime.now()
+        today = now.date()
+        tomorrow = today + datetime.timedelta(days=1)
+        try:
+            # 前日夜: 翌日分を先にスキャンしておく
+            prescan_at = datetime.datetime.combine(today, args.prescan_at)
+            if now >= prescan_at and ('prescan', tomorrow) not in done:
+                if stored_since(tomorrow, prescan_at) or full_scan(tomorrow, pool): done.add(('prescan', tomorrow))
+
+            # 当日の定時: 出走取消・騎手変更を反映するためスキャンし直す (過ぎた時刻はまとめて1回)
+            due = [t for t in args.refresh_at if now >= datetime.datetime.combine(today, t) and ('refresh', today, t) not in done]
+            if due:
+                latest = datetime.datetime.combine(today, max(due))
+                if stored_since(today, latest) or full_scan(today, pool): done.update(('refresh', today, t) for t in due)
+
+            # 発走前: 発走 N 分前を過ぎた未発走レースがあれば、オッズだけ取り直す
+            if args.before_race:
+                due = []
+                for race in stored_race_list(today):
+                    start = race_start(today, race)
+                    if start is None or now >= start: continue
+                    due += [(race['url'], m) for m in args.before_race
+                            if now >= start - datetime.timedelta(minutes=m) and ('odds', race['url'], m) not in done]
+                if due and reprice(today, pool): done.update(('odds', url, m) for url, m in due)
+
+            # オッズの時系列: 未発走レースの単勝オッズを定期的に記録する (fetch_win_odds が OddsStore に追記)
+            if args.odds_every and now.timestamp() - last_odds >= args.odds_every * 60:
+                last_odds = now.timestamp()
+                ids = [r['id'] for r in stored_race_list(today) if (race_start(today, r) or now) > now and r.get('id')]
+                with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor: list(executor.map(app.fetch_win_odds, ids))
+                app.get_odds_store().flush()
+
+            # 前日分のオッズ記録を1ファイルにまとめる
+            yesterday = today - datetime.timedelta(days=1)
+            if ('compact', yesterday) not in done:
+                app.get_odds_store().compact(yesterday)
+                done.add(('compact', yesterday))
+        except Exception as e:
+            log(f"エラー: {e}")
+        time.sleep(args.poll)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="事前スキャンの常駐スクリプト")
+    parser.add_argument('--prescan-at', type=parse_hhmm, default=parse_hhmm('20:00'), help="前日に翌日分をスキャンする時刻")
+    parser.add_argument('--refresh-at', default='08:30', help="当日にスキャンし直す時刻 (カンマ区切り)")
+    parser.add_argument('--before-race', default='30,10', help="発走の何分前にオッズで再判定するか (カンマ区切り, 空で無効)")
+    parser.add_argument('--odds-every', type=int, default=5, help="未発走レースのオッズを記録する間隔(分, 0で無効)")
+    parser.add_argument('--poll', type=int, default=30, help="時刻を確認する間隔(秒)")
+    parser.add_argument('--process-pool', action='store_true', help="解析をマルチプロセスで実行する")
+    parser.add_argument('--once', default=None, help="指定日 (YYYYMMDD) を1回だけスキャンして終了")
+    parser.add_argument('--trace', action='store_true', help="ステージ・通信・SQL の処理時間を記録する (data/traces/*.jsonl)")
+    parser.add_argument('--metrics-file', default='data/metrics/daemon.prom', help="メトリクスの書き出し先 (Prometheus テキスト形式)")
+    parser.add_argument('--metrics-port', type=int, default=0, help="/metrics を返すポート (0 で無効)")
+    args = parser.parse_args()
+    if args.trace: app.set_tracing(True)
+    app.start_metrics_exporter(args.metrics_file, port=args.metrics_port)
+    args.refresh_at = [parse_hhmm(t) for t in args.refresh_at.split(',') if t.strip()]
+    args.before_race = [int(m) for m in args.before_race.split(',') if m.strip()]
+
+    pool = app.get_process_pool() if args.process_pool else None
+    if args.once:
+        full_scan(datetime.datetime.strptime(args.once, '%Y%m%d').date(), pool)
+        return
+    log(f"起動: 前日 {args.prescan_at:%H:%M} / 当日 {', '.join(f'{t:%H:%M}' for t in args.refresh_at)} / 発走 {args.before_race} 分前")
+    run_forever(args, pool)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+スキャン用のプロセスワーカー
+
+parse / feature (/ predict) ステージを別プロセスで動かすための関数群。
+streamlit run の app は __main__ として読み込まれ pickle できないため、ワーカー側の処理はこのモジュールに置き、
+子プロセスの中で app を import する (spawn 起動)。モデル・エンコーダー・DB接続は initializer で1プロセス1回だけ読み込む。
+DataFrame はそのまま送らず、列ごとの numpy 配列にして受け渡す。
+"""
+import pandas as pd
+
+_resources = {}
+
+
+def init_worker():
+    """ProcessPoolExecutor の initializer。子プロセスごとに1回だけ呼ばれる"""
+    import app
+    model_pack, encoders, engine, logs = app.load_resources(app.model_artifact_mtime())
+    _resources.update({'app': app, 'model': model_pack, 'encoders': encoders, 'engine': engine})
+
+
+def frame_to_arrays(df):
+    """DataFrame → {'columns': [...], 'arrays': [ndarray, ...]} (pickle が軽い形)"""
+    if df is None: return None
+    return {'columns': list(df.columns), 'arrays': [df[c].to_numpy() for c in df.columns]}
+
+
+def arrays_to_frame(packed):
+    if packed is None: return None
+    return pd.DataFrame(dict(zip(packed['columns'], packed['arrays'])), columns=packed['columns'])
+
+
+def warmup_task():
+    """initializer の読み込みが終わったかどうか (プールの起動確認用)"""
+    return _resources.get('model') is not None
+
+
+def parse_task(content, url, odds_map):
+    return frame_to_arrays(_resources['app'].parse_race_page(content, url, odds_map))
+
+
+def feature_task(packed_df):
+    df, diag_data, missing_info = _resources['app'].build_race_features(
+        arrays_to_frame(packed_df), _resources['encoders'], _resources['engine'])
+    return frame_to_arrays(df), diag_data, missing_info
+
+
+def predict_task(packed_df, diag_data, missing_info):
+    """特徴量済みの出走馬をワーカー側のモデルでスコアリングする"""
+    res, debug, X_renamed, diag_data, missing_info, trace_df, contrib = _resources['app'].score_race(
+        arrays_to_frame(packed_df), _resources['model'], diag_data, missing_info)
+    return (frame_to_arrays(res), frame_to_arrays(debug), frame_to_arrays(X_renamed),
+            diag_data, missing_info, frame_to_arrays(trace_df), contrib)
+
+
+def unpack_prediction(packed):
+    res, debug, X_renamed, diag_data, missing_info, trace_df, contrib = packed
+    return (arrays_to_frame(res), arrays_to_frame(debug), arrays_to_frame(X_renamed),
+            diag_data, missing_info, arrays_to_frame(trace_df), contrib)